@@ -41,7 +41,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'offers.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'offers.middleware.HTMLMinifyMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -60,6 +62,7 @@ TAILWIND_APP_NAME = 'theme'
 # CRISPY_TEMPLATE_TYPE = 'tailwind'
 
 ROOT_URLCONF = 'cashback_zone.urls'
+WSGI_APPLICATION = 'cashback_zone.wsgi.application'
 
 
 TEMPLATES = [
@@ -83,6 +86,62 @@ TEMPLATES = [
        },
    ]
 
+# Rendering performance profile (on whenever DEBUG is off): explicitly cached
+# template loaders, no browser-reload middleware and whitespace-minified HTML.
+PERFORMANCE_MODE = not DEBUG
+HTML_MINIFY = PERFORMANCE_MODE
+
+if PERFORMANCE_MODE:
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+    MIDDLEWARE.remove('django_browser_reload.middleware.BrowserReloadMiddleware')
+    # collectstatic writes content-hashed names plus .gz/.br siblings, served
+    # by cashback_zone.static_serving with immutable caching headers
+    STORAGES = {
+        'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+        'staticfiles': {'BACKEND': 'cashback_zone.storage.CompressedManifestStaticFilesStorage'},
+    }
+
+# Lifetime of {% cache %} fragments in offer_detail.html. Keys include the offer
+# version (updated_at), so edits never serve stale fragments.
+OFFER_FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Request instrumentation (offers.middleware.RequestMetricsMiddleware).
+# Budgets are per URL name; views without an entry use DEFAULT_VIEW_BUDGET.
+DEFAULT_VIEW_BUDGET = {'queries': 50, 'ms': 1000}
+VIEW_BUDGETS = {
+    'home': {'queries': 10, 'ms': 200},
+    'offer_search': {'queries': 5, 'ms': 100},
+    'offer_detail': {'queries': 25, 'ms': 300},
+    'offer_detail_with_referral': {'queries': 30, 'ms': 300},
+    'grab_offer': {'queries': 25, 'ms': 300},
+    # Includes the replay guard's single INSERT (offers.replay)
+    'postback': {'queries': 6, 'ms': 100},
+    'dashboard': {'queries': 30, 'ms': 500},
+    'ops_health': {'queries': 5, 'ms': 100},
+}
+# Query budget overruns fail the request instead of logging (the tests turn this on)
+VIEW_BUDGETS_RAISE = False
+# Clients allowed to scrape /metrics/ without a staff login
+METRICS_ALLOWED_IPS = ['127.0.0.1']
+
+CACHES = {
+    'default': {
+        'BACKEND': 'offers.metrics.InstrumentedLocMemCache',
+    },
+    # Seen by every worker process (and host): the 'shared' cache namespaces
+    # (CACHE_SHARED_ALIAS). Create the table with `python manage.py createcachetable`.
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'cashback_shared_cache',
+    },
+}
+
 # Session configuration
 SESSION_ENGINE = 'django.contrib.sessions.backends.db'  # Use database-backed sessions
 SESSION_COOKIE_AGE = 1209600  # 2 weeks in seconds
@@ -155,14 +214,26 @@ SOCIALACCOUNT_PROVIDERS = {
     }
 }
 
+# Logs are JSON lines written by a background thread (offers.log), rotated by
+# size or age and gzipped. High-volume events are sampled via LOG_SAMPLE_RATES.
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'filters': {
+        'sampling': {
+            '()': 'offers.log.ClickSamplingFilter',
+        },
+    },
     'handlers': {
         'file': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'offers.log.QueuedRotatingFileHandler',
             'filename': 'click_logs.log',
+            'max_bytes': 50 * 1024 * 1024,
+            'interval': 24 * 60 * 60,
+            'backup_count': 14,
+            'compress': True,
+            'filters': ['sampling'],
         },
     },
     'loggers': {
@@ -174,6 +245,13 @@ LOGGING = {
     },
 }
 
+# Fraction of records kept per `event` extra (missing events are always kept)
+LOG_SAMPLE_RATES = {
+    'click_duplicate': 0.1,
+    'grab_offer_view': 0.1,
+    'request': 0.01,
+}
+
 # Static files settings
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [BASE_DIR / 'static']
@@ -183,9 +261,144 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'  # Removed duplicate definition
 # MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# User uploads only their owner (or staff) may fetch: cashback_zone.static_serving
+# leaves them to offers.private_media, which hands the file to the front-end
+# server with PRIVATE_MEDIA_SENDFILE ('x-accel-redirect' to the internal nginx
+# location PRIVATE_MEDIA_INTERNAL_URL, or 'x-sendfile'), or streams it itself.
+MEDIA_PRIVATE_PREFIXES = ('conversion_proofs/',)
+PRIVATE_MEDIA_SENDFILE = None
+PRIVATE_MEDIA_INTERNAL_URL = '/protected-media/'
 
 # Remove LOCALE_PATHS if not using internationalization
 # LOCALE_PATHS = [BASE_DIR / 'locale']
 
 # Tailwind settings for Windows
-NPM_BIN_PATH = "C:/Program Files/nodejs/npm.cmd"
\ No newline at end of file
+NPM_BIN_PATH = "C:/Program Files/nodejs/npm.cmd"
+
+# Click fraud scoring (offers.fraud). Clicks scoring at or above FRAUD_FLAG_SCORE
+# are stored as flagged and not counted; at FRAUD_DISCARD_SCORE they are dropped.
+# FRAUD_RULES overrides offers.fraud.DEFAULT_RULES per rule, e.g.
+# {'ip_velocity': {'limit': 20}}. Each worker snapshots its features to
+# FRAUD_STATE_FILE.<pid> every FRAUD_SNAPSHOT_INTERVAL seconds; all snapshots
+# are merged when a worker starts.
+FRAUD_FLAG_SCORE = 0.5
+FRAUD_DISCARD_SCORE = 0.8
+FRAUD_RULES = {}
+FRAUD_STATE_FILE = BASE_DIR / 'fraud_state.json'
+FRAUD_SNAPSHOT_INTERVAL = 60
+
+# Postback authentication (offers.postback_auth): signed postbacks are accepted
+# within POSTBACK_REPLAY_WINDOW seconds of their timestamp, once each. Cached
+# advertiser secrets are dropped in every worker when an advertiser changes
+# (CACHE_BUS_URL) and reloaded at least every POSTBACK_KEY_CACHE_TTL seconds.
+# Used signatures are rows of the UsedToken table (offers.replay); delete the
+# expired ones with `python manage.py purge_used_tokens`.
+POSTBACK_REPLAY_WINDOW = 300
+POSTBACK_KEY_CACHE_TTL = 300
+
+# Cashback payouts (offers.ledger.create_payout_batch): balances at or above
+# PAYOUT_MINIMUM are paid out, and batch CSV files are written to PAYOUT_DIR.
+PAYOUT_MINIMUM = '10.00'
+PAYOUT_DIR = BASE_DIR / 'payouts'
+
+# Referral graph (offers.referral_graph): ancestry is materialized this many
+# levels up; deeper referrers are not credited with the downline.
+REFERRAL_GRAPH_MAX_DEPTH = 20
+
+# Client IPs (offers.ipintel): X-Forwarded-For is only read when the request
+# comes from one of these proxies (addresses or CIDR networks), and only back to
+# the first hop that is not one of them. Add the load balancer's range here.
+TRUSTED_PROXIES = ['127.0.0.1', '::1']
+# Compiled IP range database (python manage.py build_ip_database <source>);
+# without it clicks are stored with no country or ASN.
+GEOIP_DATABASE = BASE_DIR / 'geoip'
+
+# Offer lifecycle (offers.lifecycle): cap counters are kept in this cache alias.
+# With more than one worker process it must be a shared backend (Redis,
+# Memcached), or each process counts only its own clicks.
+OFFER_CAPS_CACHE = 'default'
+
+# Offer ranking (offers.ranking): scores are recomputed from the referral,
+# click and proof rollups at most this many seconds apart. RANKING_VARIANTS
+# replaces offers.ranking.DEFAULT_VARIANTS; each variant has feature weights
+# and a traffic 'share', e.g. {'control': {'share': 50}, 'balanced': {...}}.
+# Each worker refreshes in a background thread; requests only read the last
+# published scores. With RANKING_BACKGROUND_REFRESH = False only the
+# rank_offers command (or refresh()) recomputes them.
+RANKING_REFRESH_INTERVAL = 900
+RANKING_BACKGROUND_REFRESH = True
+RANKING_RECENCY_HALF_LIFE_DAYS = 30
+RANKING_VARIANTS = {}
+
+# Offer search index: rebuilt when another worker changes the catalog
+# (CACHE_BUS_URL), and at most this many seconds after it was built.
+OFFER_SEARCH_INDEX_TTL = 300
+
+# Admin changelists on the large tables (offers.admin_scaling): above this many
+# rows the unfiltered count shown is the database's table statistic; filtered
+# lists count at most ADMIN_COUNT_LIMIT matches and show "About N".
+ADMIN_ESTIMATED_COUNT_THRESHOLD = 100000
+ADMIN_COUNT_LIMIT = 10000
+# Date filters on those lists read a primary-key range; ids this far outside the
+# first and last row of the period are still checked against the date
+ADMIN_DATE_PK_SLACK = 1000
+
+# Email verification codes (offers.verification_codes): a code is valid for
+# EMAIL_CODE_TTL seconds and EMAIL_CODE_MAX_ATTEMPTS wrong guesses. Sends and
+# checks are counted per email and client IP over EMAIL_CODE_THROTTLE_WINDOW
+# seconds in VERIFICATION_THROTTLE_CACHE (a shared backend with several workers).
+# Purge expired codes from cron: python manage.py purge_verification_codes
+EMAIL_CODE_TTL = 600
+EMAIL_CODE_MAX_ATTEMPTS = 5
+EMAIL_CODE_THROTTLE_WINDOW = 3600
+EMAIL_CODE_SENDS_PER_EMAIL = 5
+EMAIL_CODE_SENDS_PER_IP = 20
+EMAIL_CODE_CHECKS_PER_IP = 50
+VERIFICATION_THROTTLE_CACHE = 'default'
+
+# Contact-form CAPTCHA (offers.captcha): signed challenges expire after
+# CAPTCHA_TTL seconds and show CAPTCHA_CHOICES tiles in an image drawn for
+# each challenge. Answered tokens are UsedToken rows (offers.replay).
+CAPTCHA_TTL = 600
+CAPTCHA_CHOICES = 6
+
+# Offline mobile number pre-validation (offers.phone_validation): numbers are
+# normalized to E.164 and checked against the bundled calling-code and mobile
+# prefix metadata (PHONE_METADATA overrides its path) before any paid lookup.
+# Numbers typed without a country code are read as PHONE_DEFAULT_REGION numbers.
+PHONE_DEFAULT_REGION = 'IN'
+PHONE_METADATA = None
+
+# Cross-worker cache invalidation (offers.caching): namespace versions are
+# published on CACHE_BUS_URL, a file:// path shared by the workers of a host
+# (default BASE_DIR/cache_bus.json) or redis://host:port/db across hosts, and
+# picked up within CACHE_BUS_POLL_INTERVAL seconds. Namespaced values live in a
+# per-process LRU of CACHE_LOCAL_MAX_ENTRIES or in the CACHE_SHARED_ALIAS cache
+# (not a local-memory one), where a miss is filled by one worker while others
+# wait up to CACHE_FILL_LOCK_TIMEOUT seconds.
+CACHE_BUS_URL = None
+CACHE_BUS_POLL_INTERVAL = 0.005
+CACHE_LOCAL_MAX_ENTRIES = 10000
+CACHE_SHARED_ALIAS = 'shared'
+CACHE_FILL_LOCK_TIMEOUT = 10
+
+# Staff ops page (/ops/, offers.ops_health): the database figures are collected
+# in a background thread at most every OPS_SNAPSHOT_INTERVAL seconds and kept in
+# OPS_SNAPSHOT_CACHE (a shared backend collects once for all workers). API log
+# error rates cover OPS_ERROR_WINDOW seconds, the click rate OPS_CLICK_RATE_WINDOW.
+OPS_SNAPSHOT_INTERVAL = 60
+OPS_SNAPSHOT_CACHE = 'default'
+OPS_ERROR_WINDOW = 86400
+OPS_CLICK_RATE_WINDOW = 300
+
+# Per-visitor funnel state (offers.funnel): offer_detail reads one FunnelState
+# row per user or visitor and offer. FUNNEL_STATE_CACHE names a cache every
+# worker shares (Redis, Memcached) to put in front of that lookup; each funnel
+# write replaces only its own entry. None reads the row every time.
+FUNNEL_STATE_CACHE = None
+FUNNEL_STATE_CACHE_TIMEOUT = 3600
+
+# Offer feed import (offers.bulk_import): media paths in a feed are read
+# relative to this directory, and never from outside it. None disables media
+# copying from feeds uploaded through the admin.
+OFFER_FEED_MEDIA_ROOT = None
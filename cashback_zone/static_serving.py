@@ -0,0 +1,224 @@
+"""
+In-process static and media serving for the WSGI application.
+
+Static files are indexed once at startup from STATIC_ROOT (after
+collectstatic), and their precompressed .br/.gz siblings are picked by the
+request's Accept-Encoding. Content-hashed names from the staticfiles manifest
+get a one-year immutable Cache-Control. Media files are looked up on disk per
+request, because uploads can appear at any time; those under
+MEDIA_PRIVATE_PREFIXES (user uploads such as conversion proofs) are never
+served here and go to Django, which checks who is asking
+(offers.private_media). Full responses go out through wsgi.file_wrapper (sendfile where the server supports it), and single byte
+ranges are supported. Anything not found falls through to Django.
+"""
+import json
+import mimetypes
+import os
+import re
+from email.utils import formatdate
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.utils._os import safe_join
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+STATIC_CACHE_CONTROL = 'public, max-age=3600'
+MEDIA_CACHE_CONTROL = 'public, max-age=86400'
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def _file_headers(path, stat, content_type=None):
+    content_type = content_type or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json', 'image/svg+xml'):
+        content_type += '; charset=utf-8'
+    return [
+        ('Content-Type', content_type),
+        ('Last-Modified', formatdate(stat.st_mtime, usegmt=True)),
+        ('ETag', f'"{int(stat.st_mtime):x}-{stat.st_size:x}"'),
+    ]
+
+
+class StaticFile:
+    def __init__(self, path, immutable):
+        stat = os.stat(path)
+        self.path = path
+        self.size = stat.st_size
+        self.headers = _file_headers(path, stat)
+        self.etag = dict(self.headers)['ETag']
+        self.cache_control = IMMUTABLE_CACHE_CONTROL if immutable else STATIC_CACHE_CONTROL
+        # (Content-Encoding, path, size) for every precompressed sibling, best first
+        self.variants = []
+        for encoding, suffix in ENCODINGS:
+            if os.path.isfile(path + suffix):
+                self.variants.append((encoding, path + suffix, os.path.getsize(path + suffix)))
+
+    def select(self, accept_encoding):
+        # The acceptable variant with the highest q-value; ties go to br, then gzip
+        accepted = parse_accept_encoding(accept_encoding)
+        best, best_q = (None, self.path, self.size), 0
+        for encoding, path, size in self.variants:
+            q = accepted.get(encoding, accepted.get('*', 0))
+            if q > best_q:
+                best, best_q = (encoding, path, size), q
+        return best
+
+
+def parse_accept_encoding(header):
+    """{coding: q} from an Accept-Encoding header; codings with q=0 are refused."""
+    accepted = {}
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+class StaticFilesLayer:
+    def __init__(self, application, static_root=None, static_url=None, media_root=None, media_url=None):
+        self.application = application
+        self.static_root = str(static_root or settings.STATIC_ROOT or '')
+        self.static_prefix = self._prefix(static_url or settings.STATIC_URL)
+        self.media_root = str(media_root or settings.MEDIA_ROOT or '')
+        self.media_prefix = self._prefix(media_url or settings.MEDIA_URL)
+        self.private_media = tuple(getattr(settings, 'MEDIA_PRIVATE_PREFIXES', ()))
+        self.files = self._scan() if self.static_root and os.path.isdir(self.static_root) else {}
+
+    @staticmethod
+    def _prefix(url):
+        if not url or '://' in url:
+            return None
+        return '/' + url.strip('/') + '/'
+
+    def _hashed_names(self):
+        try:
+            with open(os.path.join(self.static_root, 'staticfiles.json')) as fh:
+                return set(json.load(fh).get('paths', {}).values())
+        except (OSError, ValueError):
+            return set()
+
+    def _scan(self):
+        hashed = self._hashed_names()
+        files = {}
+        for root, dirs, names in os.walk(self.static_root):
+            for name in names:
+                if name.endswith(('.gz', '.br')) and os.path.isfile(os.path.join(root, name[:-3])):
+                    continue
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, self.static_root).replace(os.sep, '/')
+                files[self.static_prefix + rel] = StaticFile(path, immutable=rel in hashed)
+        return files
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if self.static_prefix and path.startswith(self.static_prefix):
+            static_file = self.files.get(path)
+            if static_file is not None:
+                return self.serve_static(static_file, environ, start_response)
+        elif self.media_prefix and self.media_root and path.startswith(self.media_prefix):
+            try:
+                media_path = safe_join(self.media_root, unquote(path[len(self.media_prefix):]))
+            except (ValueError, SuspiciousFileOperation):
+                media_path = None
+            if media_path and os.path.isfile(media_path):
+                rel = os.path.relpath(media_path, self.media_root).replace(os.sep, '/')
+                # Private uploads need an authenticated Django view
+                if not rel.startswith(self.private_media):
+                    return self.serve_media(media_path, environ, start_response)
+        return self.application(environ, start_response)
+
+    def _precheck(self, environ, start_response, etag, cache_control):
+        # Returns an empty body if the request was answered with a 405 or 304
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Allow', 'GET, HEAD'), ('Content-Length', '0')])
+            return []
+        if etag in environ.get('HTTP_IF_NONE_MATCH', ''):
+            start_response('304 Not Modified', [('ETag', etag), ('Cache-Control', cache_control)])
+            return []
+        return None
+
+    def serve_static(self, static_file, environ, start_response):
+        encoding, path, size = static_file.select(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        # Each encoded representation gets its own strong ETag
+        etag = static_file.etag[:-1] + f'-{encoding}"' if encoding else static_file.etag
+        response = self._precheck(environ, start_response, etag, static_file.cache_control)
+        if response is not None:
+            return response
+
+        headers = [(name, etag if name == 'ETag' else value) for name, value in static_file.headers] + [
+            ('Content-Length', str(size)),
+            ('Cache-Control', static_file.cache_control),
+        ]
+        if static_file.variants:
+            headers.append(('Vary', 'Accept-Encoding'))
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        start_response('200 OK', headers)
+        return self._body(environ, path)
+
+    def serve_media(self, path, environ, start_response, cache_control=MEDIA_CACHE_CONTROL):
+        stat = os.stat(path)
+        headers = _file_headers(path, stat) + [('Cache-Control', cache_control), ('Accept-Ranges', 'bytes')]
+        response = self._precheck(environ, start_response, dict(headers)['ETag'], cache_control)
+        if response is not None:
+            return response
+
+        size = stat.st_size
+        match = RANGE_RE.match(environ.get('HTTP_RANGE', '').strip())
+        if match and match.group(1) + match.group(2):
+            start, end = match.groups()
+            if start:
+                start, end = int(start), min(int(end) if end else size - 1, size - 1)
+            else:
+                # Suffix range: the last N bytes
+                start, end = max(size - int(end), 0), size - 1
+            if start > end or start >= size:
+                start_response('416 Range Not Satisfiable', [('Content-Range', f'bytes */{size}'), ('Content-Length', '0')])
+                return []
+            length = end - start + 1
+            start_response('206 Partial Content', headers + [
+                ('Content-Range', f'bytes {start}-{end}/{size}'),
+                ('Content-Length', str(length)),
+            ])
+            return self._body(environ, path, start, length)
+
+        start_response('200 OK', headers + [('Content-Length', str(size))])
+        return self._body(environ, path)
+
+    def _body(self, environ, path, offset=0, length=None):
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        fh = open(path, 'rb')
+        if length is None:
+            file_wrapper = environ.get('wsgi.file_wrapper')
+            if file_wrapper is not None:
+                return file_wrapper(fh, CHUNK_SIZE)
+            return _read_chunks(fh, None)
+        fh.seek(offset)
+        return _read_chunks(fh, length)
+
+
+def _read_chunks(fh, length):
+    try:
+        remaining = length
+        while remaining is None or remaining > 0:
+            chunk = fh.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+    finally:
+        fh.close()
@@ -0,0 +1,64 @@
+import gzip
+import logging
+import os
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+try:
+    import brotli
+except ImportError:  # .br siblings are skipped when brotli isn't installed
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_EXTENSIONS = {
+    '.css', '.js', '.mjs', '.map', '.json', '.svg', '.html', '.htm', '.txt', '.xml', '.ico', '.md',
+}
+
+
+def compress_file(path):
+    """Write .gz (and .br when available) siblings next to a text asset.
+
+    Siblings that would not be smaller than the original are not kept.
+    """
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    written = []
+    variants = [('.gz', lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', lambda d: brotli.compress(d, quality=11)))
+    for suffix, compress in variants:
+        compressed = compress(data)
+        if len(compressed) >= len(data):
+            continue
+        with open(path + suffix, 'wb') as fh:
+            fh.write(compressed)
+        written.append(path + suffix)
+    return written
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Manifest-hashed static files with precompressed .gz/.br siblings.
+
+    collectstatic writes content-hashed names (css/tailwind.55e7cbb9ba48.css),
+    then every text asset, hashed or not, gets compressed copies that
+    cashback_zone.static_serving serves without compressing per request.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        processed = set()
+        for name, hashed_name, result in super().post_process(paths, dry_run, **options):
+            yield name, hashed_name, result
+            if isinstance(result, Exception):
+                continue
+            processed.add(name)
+            if hashed_name:
+                processed.add(hashed_name)
+
+        if dry_run:
+            return
+        count = 0
+        for name in processed:
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+                count += len(compress_file(self.path(name)))
+        logger.info(f"Precompressed static files: {count} siblings written")
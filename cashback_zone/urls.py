@@ -3,7 +3,12 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from offers import private_media
+
 urlpatterns = [
+    # Ahead of the public media route: private uploads are checked per request
+    *[path(f"{settings.MEDIA_URL.lstrip('/')}{prefix}<path:path>", private_media.serve, {'prefix': prefix})
+      for prefix in settings.MEDIA_PRIVATE_PREFIXES],
     path('admin/', admin.site.urls),
     path('', include('offers.urls')),
     path('accounts/', include('allauth.urls')),
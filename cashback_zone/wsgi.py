@@ -13,4 +13,7 @@ from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cashback_zone.settings')
 
-application = get_wsgi_application()
+from cashback_zone.static_serving import StaticFilesLayer  # noqa: E402 (needs settings)
+
+# Static and media requests are answered before they reach Django
+application = StaticFilesLayer(get_wsgi_application())
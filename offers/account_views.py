@@ -0,0 +1,34 @@
+"""
+allauth view subclasses, kept out of offers.views so loading the URLconf does
+not import allauth's account views.
+"""
+from allauth.account.models import EmailAddress
+from allauth.account.views import EmailView, SignupView
+from django.contrib import messages
+
+from .forms import CustomSignupForm
+from .models import UserProfile
+from .utils import send_verification_email
+
+
+class CustomEmailView(EmailView):
+    def post(self, request, *args, **kwargs):
+        response = super().post(request, *args, **kwargs)
+        if 'email' in request.POST and request.POST.get('action') == 'add_email':
+            email = request.POST['email']
+            email_address = EmailAddress.objects.filter(user=request.user, email=email).first()
+            if email_address:
+                email_address.verified = False
+                email_address.save()
+                UserProfile.objects.update_for(request.user, email_verified=False)
+                send_verification_email(request.user, request)
+                messages.info(request, "A verification email has been sent to your new email address.")
+        return response
+
+class CustomSignupView(SignupView):
+    form_class = CustomSignupForm
+
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['request'] = self.request
+        return kwargs
@@ -1,6 +1,19 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin.utils import label_for_field
+from django.core.exceptions import PermissionDenied
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.http import Http404, JsonResponse
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
 from django.utils.html import format_html
-from .models import Advertiser, ApiLog, ApiUsage, MobileValidationCache, Offer, AdBanner, PendingVerification, TutorialVideo, Referral, ReferralClick, UserProfile, ContactInfo, GoogleFormSubmission, ConversionProof
+from .admin_scaling import CURSOR_VAR, ExactValueFilter, IndexedDateFilter, LargeTableAdmin
+from . import funnel
+from .bulk_import import import_offers, load_feed
+from .ledger import post_approved_proofs
+from .forms import OfferFeedImportForm
+from .models import Advertiser, ApiLog, ApiUsage, LedgerEntry, LedgerTransaction, MobileValidationCache, Offer, AdBanner, Payout, PayoutBatch, PendingVerification, TutorialVideo, Referral, ReferralClick, UserBalance, UserProfile, ContactInfo, GoogleFormSubmission, ConversionProof, generate_postback_secret
 
 # Inline for AdBanner to be displayed in Offer admin
 class AdBannerInline(admin.TabularInline):
@@ -16,29 +29,12 @@ class TutorialVideoInline(admin.TabularInline):
     fields = ('title', 'description', 'url')
     readonly_fields = ('title', 'description', 'url')
 
-# Inline for ContactInfo to be displayed in Offer admin
-class ContactInfoInline(admin.TabularInline):
-    model = ContactInfo
-    extra = 0
-    fields = ('user', 'visitor_identifier', 'referral', 'name', 'email', 'mobile', 'created_at')
-    readonly_fields = ('user', 'visitor_identifier', 'referral', 'name', 'email', 'mobile', 'created_at')
-    can_delete = False
-
-# Inline for GoogleFormSubmission to be displayed in Offer admin
-class GoogleFormSubmissionInline(admin.TabularInline):
-    model = GoogleFormSubmission
-    extra = 0
-    fields = ('user', 'visitor_identifier', 'submitted', 'created_at')
-    readonly_fields = ('user', 'visitor_identifier', 'submitted', 'created_at')
-    can_delete = False
-
-# Inline for ConversionProof to be displayed in Offer admin
-class ConversionProofInline(admin.TabularInline):
-    model = ConversionProof
-    extra = 0
-    fields = ('user', 'status', 'image', 'submitted_at')
-    readonly_fields = ('user', 'status', 'image', 'submitted_at')
-    can_delete = False
+def rotate_postback_secret(modeladmin, request, queryset):
+    # save() rather than update(), so the post_save signal drops the cached keys
+    for advertiser in queryset:
+        advertiser.postback_secret = generate_postback_secret()
+        advertiser.save(update_fields=['postback_secret', 'updated_at'])
+rotate_postback_secret.short_description = "Rotate postback secret of selected advertisers"
 
 @admin.register(Advertiser)
 class AdvertiserAdmin(admin.ModelAdmin):
@@ -47,30 +43,128 @@ class AdvertiserAdmin(admin.ModelAdmin):
     search_fields = ('name', 'base_url')
     date_hierarchy = 'created_at'
     ordering = ('-created_at',)
+    actions = [rotate_postback_secret]
 
 @admin.register(Offer)
 class OfferAdmin(admin.ModelAdmin):
-    list_display = ('name', 'advertiser', 'price', 'is_active', 'requires_contact_info', 'requires_conversion_proof', 'created_at', 'updated_at')
-    list_filter = ('is_active', 'theme', 'requires_google_form', 'requires_contact_info', 'requires_conversion_proof', 'created_at', 'updated_at')
+    list_display = ('name', 'advertiser', 'price', 'cashback_amount', 'is_active', 'paused_reason', 'requires_contact_info', 'requires_conversion_proof', 'created_at', 'updated_at')
+    list_filter = ('is_active', 'paused_reason', 'theme', 'requires_google_form', 'requires_contact_info', 'requires_conversion_proof', 'created_at', 'updated_at')
     search_fields = ('name', 'description', 'advertiser__name')
     date_hierarchy = 'created_at'
     ordering = ('-created_at',)
-    inlines = [AdBannerInline, TutorialVideoInline, ContactInfoInline, GoogleFormSubmissionInline, ConversionProofInline]
+    inlines = [AdBannerInline, TutorialVideoInline]
+    # Leads, form submissions and proofs grow without bound, so the change page
+    # shows them as panels loaded a page at a time from related_view
+    related_panels = {
+        'contact_infos': ('Contact info', ContactInfo, ('id', 'user__username', 'visitor_identifier', 'referral', 'name', 'email', 'mobile', 'created_at')),
+        'google_form_submissions': ('Google form submissions', GoogleFormSubmission, ('id', 'user__username', 'visitor_identifier', 'submitted', 'created_at')),
+        'conversion_proofs': ('Conversion proofs', ConversionProof, ('id', 'user__username', 'status', 'image', 'submitted_at')),
+    }
+    related_per_page = 25
     fieldsets = (
         (None, {
-            'fields': ('name', 'advertiser', 'price', 'image', 'logo', 'link')
+            'fields': ('name', 'advertiser', 'price', 'cashback_amount', 'image', 'logo', 'link')
         }),
         ('Details', {
-            'fields': ('description', 'terms', 'theme', 'is_active')
+            'fields': ('external_id', 'description', 'terms', 'theme', 'is_active')
         }),
         ('Requirements', {
             'fields': ('requires_google_form', 'google_form_url', 'requires_contact_info', 'requires_conversion_proof')
         }),
+        ('Schedule and caps', {
+            'fields': ('starts_at', 'ends_at', 'click_cap', 'daily_click_cap', 'conversion_cap', 'daily_conversion_cap', 'paused_reason')
+        }),
     )
 
+    def get_urls(self):
+        urls = [
+            path('import-feed/', self.admin_site.admin_view(self.import_feed_view), name='offers_offer_import_feed'),
+            path('<int:object_id>/related/<str:kind>/', self.admin_site.admin_view(self.related_view), name='offers_offer_related'),
+        ]
+        return urls + super().get_urls()
+
+    def related_counts(self, object_id):
+        """{panel: rows} for one offer, in a single query of indexed counts."""
+        def count(model):
+            return Coalesce(Subquery(model.objects.filter(offer=OuterRef('pk')).order_by()
+                                     .values('offer').annotate(rows=Count('id')).values('rows')), 0)
+        row = Offer.objects.filter(pk=object_id).values(
+            **{f'{kind}_count': count(model) for kind, (_, model, _) in self.related_panels.items()}
+        ).first() or {}
+        return {kind: row.get(f'{kind}_count', 0) for kind in self.related_panels}
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        extra_context = extra_context or {}
+        if object_id and object_id.isdigit():
+            counts = self.related_counts(object_id)
+            extra_context['related_panels'] = [
+                {
+                    'title': title,
+                    'count': counts.get(kind, 0),
+                    'columns': [label_for_field(field.split('__')[0], model) for field in fields],
+                    'url': reverse('admin:offers_offer_related', args=[object_id, kind]),
+                }
+                for kind, (title, model, fields) in self.related_panels.items()
+                if request.user.has_perm(f'{model._meta.app_label}.view_{model._meta.model_name}')
+            ]
+        return super().change_view(request, object_id, form_url, extra_context)
+
+    def related_view(self, request, object_id, kind):
+        """One page of an offer's related rows as JSON, newest first; ?cursor= is the last id seen."""
+        if kind not in self.related_panels:
+            raise Http404
+        _, model, fields = self.related_panels[kind]
+        if not self.has_view_permission(request) or not request.user.has_perm(f'{model._meta.app_label}.view_{model._meta.model_name}'):
+            raise PermissionDenied
+        rows = model.objects.filter(offer_id=object_id).order_by('-id')
+        cursor = request.GET.get(CURSOR_VAR, '')
+        if cursor.isdigit():
+            rows = rows.filter(id__lt=int(cursor))
+        rows = list(rows.values(*fields)[:self.related_per_page])
+        for row in rows:
+            row['url'] = reverse(f'admin:{model._meta.app_label}_{model._meta.model_name}_change', args=[row['id']])
+        return JsonResponse({
+            'fields': fields,
+            'results': rows,
+            'next_cursor': rows[-1]['id'] if len(rows) == self.related_per_page else None,
+        })
+
+    def import_feed_view(self, request):
+        if not self.has_add_permission(request) or not self.has_change_permission(request):
+            return redirect('admin:offers_offer_changelist')
+
+        diff = None
+        if request.method == 'POST':
+            form = OfferFeedImportForm(request.POST, request.FILES)
+            if form.is_valid():
+                feed = form.cleaned_data['feed']
+                try:
+                    rows = load_feed(feed, name=feed.name)
+                    result = import_offers(rows, dry_run=form.cleaned_data['dry_run'])
+                except ValueError as e:
+                    messages.error(request, f"Could not import feed: {e}")
+                else:
+                    if result['dry_run']:
+                        diff = result
+                    else:
+                        messages.success(request, f"Imported {result['offers']} offers from {result['advertisers']} advertisers.")
+                        return redirect('admin:offers_offer_changelist')
+        else:
+            form = OfferFeedImportForm()
+
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Import offer feed',
+            'form': form,
+            'diff': diff,
+        }
+        return TemplateResponse(request, 'admin/offers/offer/import_feed.html', context)
+
 @admin.register(AdBanner)
 class AdBannerAdmin(admin.ModelAdmin):
     list_display = ('title', 'offer', 'image_preview', 'description')
+    list_select_related = ('offer',)
     list_filter = ('offer__name',)
     search_fields = ('title', 'description', 'offer__name')
     ordering = ('offer__name',)
@@ -84,45 +178,50 @@ class AdBannerAdmin(admin.ModelAdmin):
 @admin.register(TutorialVideo)
 class TutorialVideoAdmin(admin.ModelAdmin):
     list_display = ('title', 'offer', 'url', 'description')
+    list_select_related = ('offer',)
     list_filter = ('offer__name',)
     search_fields = ('title', 'description', 'offer__name', 'url')
     ordering = ('offer__name',)
 
 @admin.register(Referral)
-class ReferralAdmin(admin.ModelAdmin):
+class ReferralAdmin(LargeTableAdmin):
     list_display = ('id', 'user', 'offer', 'visitor_identifier', 'working_state', 'click_count', 'created_at', 'updated_at')
-    list_filter = ('working_state', 'created_at', 'updated_at')
-    search_fields = ('user__username', 'offer__name', 'visitor_identifier')
-    date_hierarchy = 'created_at'
-    ordering = ('-created_at',)
+    list_select_related = ('user', 'offer')
+    list_filter = ('working_state', ('created_at', IndexedDateFilter), ('offer', ExactValueFilter), ('user', ExactValueFilter))
+    search_fields = ('id', 'visitor_identifier', 'user__username')
+    raw_id_fields = ('user',)
+    autocomplete_fields = ('offer',)
 
 @admin.register(ReferralClick)
-class ReferralClickAdmin(admin.ModelAdmin):
-    list_display = ('referral', 'ip_address', 'clicked_at')
-    list_filter = ('referral',)
+class ReferralClickAdmin(LargeTableAdmin):
+    list_display = ('referral', 'ip_address', 'country', 'asn', 'clicked_at')
+    list_select_related = ('referral__offer',)
+    list_filter = (('referral', ExactValueFilter), ('country', ExactValueFilter), 'flagged', ('clicked_at', IndexedDateFilter))
     search_fields = ('ip_address', 'referral__id')
-    date_hierarchy = 'clicked_at'
-    ordering = ('-clicked_at',)
+    raw_id_fields = ('referral',)
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'profile_level', 'email_verified', 'mobile_verified')
+    list_select_related = ('user',)
     list_filter = ('email_verified', 'mobile_verified', 'profile_level')
     search_fields = ('user__username', 'user__email')
     ordering = ('user__username',)
 
 @admin.register(ContactInfo)
-class ContactInfoAdmin(admin.ModelAdmin):
+class ContactInfoAdmin(LargeTableAdmin):
     list_display = ('user', 'visitor_identifier', 'offer', 'referral', 'name', 'email', 'mobile', 'created_at')
-    list_filter = ('created_at',)
-    search_fields = ('name', 'email', 'mobile', 'user__username', 'offer__name')
-    date_hierarchy = 'created_at'
-    ordering = ('-created_at',)
+    list_select_related = ('user', 'offer', 'referral__offer')
+    list_filter = (('created_at', IndexedDateFilter), ('offer', ExactValueFilter))
+    search_fields = ('email', 'mobile', 'user__username')
     readonly_fields = ('created_at',)
+    raw_id_fields = ('user', 'referral')
+    autocomplete_fields = ('offer',)
 
 @admin.register(GoogleFormSubmission)
 class GoogleFormSubmissionAdmin(admin.ModelAdmin):
     list_display = ('user', 'offer', 'visitor_identifier', 'submitted', 'created_at')
+    list_select_related = ('user', 'offer')
     list_filter = ('submitted', 'created_at')
     search_fields = ('user__username', 'offer__name', 'visitor_identifier')
     date_hierarchy = 'created_at'
@@ -130,18 +229,27 @@ class GoogleFormSubmissionAdmin(admin.ModelAdmin):
     readonly_fields = ('created_at',)
 
 # Custom actions for ConversionProof
+def _refresh_funnel_states(queryset):
+    for user_id, offer_id in queryset.values_list('user_id', 'offer_id').distinct():
+        funnel.refresh(offer_id, user_id)
+
 def approve_proofs(modeladmin, request, queryset):
     queryset.update(status='approved')
+    # update() skips the post_save signals that credit cashback and refresh the funnel state
+    post_approved_proofs(queryset.filter(status='approved'))
+    _refresh_funnel_states(queryset)
 approve_proofs.short_description = "Mark selected proofs as approved"
 
 def reject_proofs(modeladmin, request, queryset):
     queryset.update(status='rejected')
+    _refresh_funnel_states(queryset)
 reject_proofs.short_description = "Mark selected proofs as rejected"
 
 @admin.register(ConversionProof)
 class ConversionProofAdmin(admin.ModelAdmin):
     list_display = ('user', 'offer', 'status', 'image_preview', 'submitted_at')
-    list_filter = ('status', 'offer')
+    list_select_related = ('user', 'offer')
+    list_filter = ('status', ('offer', ExactValueFilter))
     search_fields = ('user__username', 'offer__name')
     date_hierarchy = 'submitted_at'
     ordering = ('-submitted_at',)
@@ -156,6 +264,7 @@ class ConversionProofAdmin(admin.ModelAdmin):
 @admin.register(PendingVerification)
 class PendingVerificationAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'mobile_number', 'created_at', 'is_processed')
+    list_select_related = ('user',)
     list_filter = ('is_processed', 'created_at')
     search_fields = ('user__username', 'mobile_number')
     date_hierarchy = 'created_at'
@@ -170,12 +279,10 @@ class PendingVerificationAdmin(admin.ModelAdmin):
     actions = [mark_as_processed]
 
 @admin.register(ApiLog)
-class ApiLogAdmin(admin.ModelAdmin):
+class ApiLogAdmin(LargeTableAdmin):
     list_display = ('timestamp', 'api_name', 'level', 'message')
-    list_filter = ('api_name', 'level', 'timestamp')
-    search_fields = ('message',)
-    date_hierarchy = 'timestamp'
-    ordering = ('-timestamp',)
+    list_filter = (('api_name', ExactValueFilter), 'level', ('timestamp', IndexedDateFilter))
+    search_fields = ('api_name', 'message__icontains')
 
 @admin.register(ApiUsage)
 class ApiUsageAdmin(admin.ModelAdmin):
@@ -190,4 +297,71 @@ class MobileValidationCacheAdmin(admin.ModelAdmin):
     list_filter = ('is_valid', 'validated_at')
     search_fields = ('mobile_number',)
     date_hierarchy = 'validated_at'
-    ordering = ('-validated_at',)
\ No newline at end of file
+    ordering = ('-validated_at',)
+
+# Ledger rows are append-only: visible in the admin, never edited there
+class LedgerEntryInline(admin.TabularInline):
+    model = LedgerEntry
+    extra = 0
+    fields = ('account', 'user', 'amount', 'created_at')
+    readonly_fields = ('account', 'user', 'amount', 'created_at')
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+@admin.register(LedgerTransaction)
+class LedgerTransactionAdmin(LargeTableAdmin):
+    list_display = ('idempotency_key', 'kind', 'user', 'offer', 'created_at')
+    list_select_related = ('user', 'offer')
+    list_filter = ('kind', ('created_at', IndexedDateFilter), ('user', ExactValueFilter))
+    search_fields = ('idempotency_key', 'user__username')
+    raw_id_fields = ('user', 'offer', 'referral')
+    inlines = [LedgerEntryInline]
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(UserBalance)
+class UserBalanceAdmin(admin.ModelAdmin):
+    list_display = ('user', 'balance', 'lifetime_earned', 'updated_at')
+    list_select_related = ('user',)
+    search_fields = ('user__username', 'user__email')
+    ordering = ('-balance',)
+    readonly_fields = ('user', 'balance', 'lifetime_earned', 'updated_at')
+
+    def has_add_permission(self, request):
+        return False
+
+@admin.register(PayoutBatch)
+class PayoutBatchAdmin(admin.ModelAdmin):
+    list_display = ('id', 'created_at', 'payout_count', 'total_amount', 'file_path')
+    date_hierarchy = 'created_at'
+    ordering = ('-created_at',)
+    readonly_fields = ('payout_count', 'total_amount', 'file_path', 'payouts')
+
+    # A batch holds every eligible user, so its payouts are linked rather than inlined
+    @admin.display(description='Payouts')
+    def payouts(self, obj):
+        if obj.pk is None:
+            return '-'
+        url = reverse('admin:offers_payout_changelist') + f'?batch__id__exact={obj.pk}'
+        return format_html('<a href="{}">{} payouts</a>', url, obj.payout_count)
+
+@admin.register(Payout)
+class PayoutAdmin(LargeTableAdmin):
+    list_display = ('id', 'batch', 'user', 'amount', 'status')
+    list_select_related = ('batch', 'user')
+    list_filter = (('batch', ExactValueFilter), 'status', ('user', ExactValueFilter))
+    search_fields = ('user__username',)
+    fields = ('batch', 'user', 'amount', 'status')
+    readonly_fields = ('batch', 'user', 'amount')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
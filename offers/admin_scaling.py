@@ -0,0 +1,247 @@
+"""
+Admin changelists for tables with millions of rows.
+
+Stock changelists run an exact COUNT(*) on every page load, page with
+OFFSET (which reads and discards every row before the page), and render
+foreign-key filters as a list of every related object. LargeTableAdmin
+replaces those with:
+
+* EstimatedCountPaginator: the unfiltered count comes from the database's
+  table statistics (pg_class.reltuples, information_schema.TABLES,
+  MAX(rowid) on SQLite); filtered counts stop at ADMIN_COUNT_LIMIT rows.
+* KeysetChangeList: while the list is in its default newest-first order,
+  pages are `id < cursor` range reads on the primary key, so page 10,000
+  costs what page 1 does.
+* ExactValueFilter: takes an id (or, for a plain column, the value) in a
+  text box instead of enumerating the related table or DISTINCT values.
+* IndexedDateFilter: date drill-down that also bounds the primary key, found
+  through the date column's index, so a period is a range read.
+* Search fields matched exactly (and case-sensitively), so a search is an
+  index lookup; a field may name its own lookup instead ('message__icontains'),
+  which then reads the newest rows until a page of matches is found.
+"""
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.utils import build_q_object_from_lookup_parameters, get_fields_from_path
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.db.models.constants import LOOKUP_SEP
+from django.utils.functional import cached_property
+
+# Query parameter holding the id the next page starts below
+CURSOR_VAR = 'cursor'
+
+
+def estimated_row_count(model, using='default'):
+    """Approximate number of rows in the model's table from statistics, or None if unavailable."""
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                "SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s",
+                [table],
+            )
+        elif connection.vendor == 'sqlite':
+            # The largest rowid is read from the end of the b-tree; it overcounts by the rows deleted
+            cursor.execute(f"SELECT MAX(rowid) FROM {connection.ops.quote_name(table)}")
+        else:
+            return None
+        row = cursor.fetchone()
+    # reltuples is -1 on PostgreSQL until the table is first analyzed
+    if not row or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator whose count never scans a large table.
+
+    `estimated` is True when count is a statistic or a lower bound rather
+    than the exact number of rows.
+    """
+
+    estimated = False
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= getattr(settings, 'ADMIN_ESTIMATED_COUNT_THRESHOLD', 100000):
+                self.estimated = True
+                return estimate
+        # Counting a LIMITed subquery stops at the limit instead of reading every match
+        limit = getattr(settings, 'ADMIN_COUNT_LIMIT', 10000)
+        count = queryset.order_by()[:limit + 1].count()
+        if count > limit:
+            self.estimated = True
+            return limit
+        return count
+
+
+class KeysetChangeList(ChangeList):
+    """ChangeList that pages by primary key while sorted newest first.
+
+    Any other ordering (a column header was clicked) falls back to the stock
+    offset pagination, still with the estimated count.
+    """
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # Changing a filter, search or ordering starts again from the first page
+        if not new_params or CURSOR_VAR not in new_params:
+            remove = [*(remove or []), CURSOR_VAR]
+        return super().get_query_string(new_params, remove)
+
+    def _keyset_ordering(self):
+        pk = self.lookup_opts.pk.attname
+        # get_ordering() appends the primary key when it is already there
+        return list(dict.fromkeys(self.queryset.query.order_by)) in (['-pk'], [f'-{pk}'])
+
+    def get_results(self, request):
+        self.keyset = False
+        self.count_estimated = False
+        if self.show_all or not self._keyset_ordering():
+            super().get_results(request)
+            self.count_estimated = getattr(self.paginator, 'estimated', False)
+            return
+
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        self.cursor = None
+        if request.GET.get(CURSOR_VAR, '').isdigit():
+            self.cursor = int(request.GET[CURSOR_VAR])
+        queryset = self.queryset.filter(pk__lt=self.cursor) if self.cursor else self.queryset
+        result_list = queryset[:self.list_per_page]
+        # Evaluated here so the template reuses the rows; a full page may have more after it
+        rows = list(result_list)
+        next_cursor = rows[-1].pk if len(rows) == self.list_per_page else None
+
+        self.keyset = True
+        self.result_count = paginator.count
+        self.count_estimated = paginator.estimated
+        self.show_full_result_count = False
+        self.full_result_count = None
+        self.show_admin_actions = True
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = bool(self.cursor or next_cursor)
+        self.paginator = paginator
+        self.first_page_url = self.get_query_string() if self.cursor else None
+        self.next_page_url = self.get_query_string({CURSOR_VAR: next_cursor}) if next_cursor else None
+
+
+class ExactValueFilter(admin.FieldListFilter):
+    """Filter that takes a value in a text box: the related id for a foreign key."""
+
+    template = 'admin/offers/exact_value_filter.html'
+
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        if field.is_relation:
+            self.lookup_kwarg = f'{field_path}__{field.target_field.name}__exact'
+        else:
+            self.lookup_kwarg = f'{field_path}__exact'
+        super().__init__(field, request, params, model, model_admin, field_path)
+        value = self.used_parameters.get(self.lookup_kwarg)
+        self.lookup_val = value[-1] if isinstance(value, list) else value
+
+    def expected_parameters(self):
+        return [self.lookup_kwarg]
+
+    def choices(self, changelist):
+        yield {
+            'selected': self.lookup_val is None,
+            'query_string': changelist.get_query_string(remove=[self.lookup_kwarg]),
+            'display': 'All',
+            'lookup_kwarg': self.lookup_kwarg,
+            'value': self.lookup_val or '',
+            # The rest of the current query, so submitting the box keeps other filters
+            'hidden_params': [(key, value) for key, values in changelist.filter_params.items()
+                              if key not in (self.lookup_kwarg, CURSOR_VAR) for value in values],
+        }
+
+
+class IndexedDateFilter(admin.DateFieldListFilter):
+    """Date drill-down for a column that grows with the primary key (auto_now_add).
+
+    Left alone, the database reads every row of the period through the date
+    index and sorts them by id to show the newest page. The ids of the first
+    and last rows of the period (one index lookup each) are added as a
+    primary-key range, which the newest-first page reads directly. Ids are
+    only roughly in date order (transactions commit out of order), so each
+    bound is widened by ADMIN_DATE_PK_SLACK ids; the date condition is kept,
+    so the extra rows are read but never listed. A row of the period whose id
+    is further out of order than that is left out.
+    """
+
+    def queryset(self, request, queryset):
+        queryset = super().queryset(request, queryset)
+        slack = getattr(settings, 'ADMIN_DATE_PK_SLACK', 1000)
+        for lookup, order, bound, pad in ((self.lookup_kwarg_since, self.field_path, 'pk__gte', -slack),
+                                          (self.lookup_kwarg_until, f'-{self.field_path}', 'pk__lte', slack)):
+            if lookup not in self.used_parameters:
+                continue
+            edge = (queryset.model._default_manager
+                    .filter(build_q_object_from_lookup_parameters({lookup: self.used_parameters[lookup]}))
+                    .order_by(order).values_list('pk', flat=True).first())
+            if edge is None:
+                return queryset.none()
+            queryset = queryset.filter(**{bound: edge + pad})
+        return queryset
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Base ModelAdmin for the high-volume tables."""
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    change_list_template = 'admin/offers/large_change_list.html'
+    ordering = ('-id',)
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def _search_lookups(self, request):
+        """(path, field, lookup) per search field: the lookup the field names, else exact."""
+        lookups = []
+        for path in self.get_search_fields(request):
+            field_path, _, lookup = path.rpartition(LOOKUP_SEP)
+            if field_path:
+                field = get_fields_from_path(self.model, field_path)[-1]
+                if lookup in field.get_lookups():
+                    lookups.append((field_path, field, lookup))
+                    continue
+            lookups.append((path, get_fields_from_path(self.model, path)[-1], 'exact'))
+        return lookups
+
+    def get_search_results(self, request, queryset, search_term):
+        """Match each search field exactly (and case-sensitively), so the lookups can use indexes.
+
+        Fields listed with a lookup ('message__icontains') use it instead.
+        Terms that are not valid for a field (text in an id field) skip it
+        rather than failing; a term no field accepts matches nothing.
+        """
+        lookups = self._search_lookups(request)
+        if not lookups or not search_term:
+            return queryset, False
+        for term in search_term.split():
+            matches = Q()
+            for path, field, lookup in lookups:
+                try:
+                    value = field.to_python(term)
+                except ValidationError:
+                    continue
+                matches |= Q(**{f'{path}__{lookup}': value})
+            if not matches:
+                return queryset.none(), False
+            queryset = queryset.filter(matches)
+        return queryset, False
@@ -0,0 +1,455 @@
+"""
+Synthetic data, microbenchmarks and end-to-end funnel scenarios for the click path.
+
+Everything generated here is tagged with BENCH_PREFIX so it can be removed
+again with flush_dataset(). Results are plain dicts (timings in
+microseconds/milliseconds, throughput per second) that the run_benchmarks
+command dumps as JSON so two runs can be compared.
+"""
+import json
+import multiprocessing
+import os
+import platform
+import random
+import secrets
+import statistics
+import time
+from decimal import Decimal
+
+import django
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection, connections
+from django.test import Client, RequestFactory
+from django.urls import reverse
+
+from .models import Advertiser, ContactInfo, Offer, Referral, ReferralClick, UserProfile
+from .ipintel import lookup as ip_lookup
+from . import phone_validation
+from .postback_auth import sign, verify_postback
+from .search import offer_index
+
+BENCH_PREFIX = 'bench-'
+CATEGORIES = [value for value, label in Offer._meta.get_field('category').choices]
+CONVERSION_TYPES = [value for value, label in Offer._meta.get_field('conversion_type').choices]
+# Host header for test-client requests; 'testserver' is only allowed under the test runner
+BENCH_HOST = 'localhost'
+# Offers the funnel scenarios drive end to end (no contact form, so grab_offer redirects)
+FUNNEL_OFFER_FILTER = {'external_id__startswith': BENCH_PREFIX, 'requires_contact_info': False, 'is_active': 'active'}
+
+
+def percentiles(samples, scale=1.0):
+    """Mean/p50/p95/p99/max of a list of durations in seconds, multiplied by scale."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    last = len(ordered) - 1
+
+    def pick(q):
+        return round(ordered[min(last, int(q * len(ordered)))] * scale, 3)
+
+    return {
+        'count': len(ordered),
+        'mean': round(statistics.fmean(ordered) * scale, 3),
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': round(ordered[-1] * scale, 3),
+    }
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'cpus': os.cpu_count(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'dataset': dataset_counts(),
+    }
+
+
+# --- Synthetic data -------------------------------------------------------
+
+def _bulk(model, make_row, count, batch_size):
+    """bulk_create `count` rows in chunks so millions of rows never sit in memory at once."""
+    created = 0
+    while created < count:
+        size = min(batch_size, count - created)
+        model.objects.bulk_create([make_row(created + i) for i in range(size)], batch_size=batch_size)
+        created += size
+
+
+def generate_dataset(advertisers=20, offers=500, users=2000, referrals=100000, clicks=200000,
+                     contact_infos=5000, seed=42, batch_size=5000, progress=None):
+    """Fill the database with a reproducible synthetic catalog and click history.
+
+    Rows are created with bulk_create, so model signals do not fire; the offer
+    search index is invalidated at the end instead.
+    """
+    rng = random.Random(seed)
+    report = progress or (lambda message: None)
+
+    Advertiser.objects.bulk_create([
+        Advertiser(
+            name=f'{BENCH_PREFIX}advertiser-{i}',
+            base_url=f'https://adv{i}.example.com/',
+            query_param_prefix=rng.choice(('aff_sub', 'sub', 'click_id')),
+        )
+        for i in range(advertisers)
+    ], batch_size=batch_size)
+    advertiser_ids = list(Advertiser.objects.filter(name__startswith=BENCH_PREFIX).values_list('id', flat=True))
+    report(f'{len(advertiser_ids)} advertisers')
+
+    def make_offer(i):
+        return Offer(
+            advertiser_id=rng.choice(advertiser_ids) if advertiser_ids and rng.random() < 0.9 else None,
+            external_id=f'{BENCH_PREFIX}{i}',
+            name=f'Benchmark offer {i} {rng.choice(("cashback", "signup", "trial", "deal"))}',
+            description='Synthetic offer generated for benchmarking.',
+            price=Decimal(rng.randint(0, 50000)) / 100,
+            link=f'https://adv.example.com/landing/{i}?utm_source=cashback',
+            reward=f'{rng.randint(1, 500)} cashback',
+            requires_contact_info=rng.random() < 0.2,
+            category=rng.choice(CATEGORIES),
+            conversion_type=rng.choice(CONVERSION_TYPES),
+        )
+    _bulk(Offer, make_offer, offers, batch_size)
+    offer_ids = list(Offer.objects.filter(external_id__startswith=BENCH_PREFIX).values_list('id', flat=True))
+    offer_index.invalidate()
+    report(f'{len(offer_ids)} offers')
+
+    _bulk(User, lambda i: User(username=f'{BENCH_PREFIX}user-{i}', email=f'{BENCH_PREFIX}user-{i}@example.com',
+                               password='!'), users, batch_size)
+    user_ids = list(User.objects.filter(username__startswith=BENCH_PREFIX).values_list('id', flat=True))
+    # bulk_create skips the post_save signal that normally creates the profile
+    _bulk(UserProfile, lambda i: UserProfile(user_id=user_ids[i], email_verified=rng.random() < 0.7),
+          len(user_ids), batch_size)
+    report(f'{len(user_ids)} users')
+
+    first_referral_id = (Referral.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+
+    def make_referral(i):
+        if user_ids and rng.random() < 0.6:
+            return Referral(user_id=rng.choice(user_ids), offer_id=rng.choice(offer_ids),
+                            click_count=rng.randint(0, 20), working_state=rng.choice(('pending', 'clicked')))
+        return Referral(visitor_identifier=f'{BENCH_PREFIX}{i:032x}'[:40], offer_id=rng.choice(offer_ids),
+                        click_count=rng.randint(0, 5))
+    _bulk(Referral, make_referral, referrals, batch_size)
+    referral_ids = list(Referral.objects.filter(offer_id__in=offer_ids, id__gte=first_referral_id)
+                        .values_list('id', flat=True))
+    report(f'{len(referral_ids)} referrals')
+
+    _bulk(ReferralClick, lambda i: ReferralClick(
+        referral_id=rng.choice(referral_ids),
+        ip_address=f'10.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}',
+        session_key=f'{rng.getrandbits(128):032x}',
+    ), clicks if referral_ids else 0, batch_size)
+    report(f'{clicks if referral_ids else 0} clicks')
+
+    _bulk(ContactInfo, lambda i: ContactInfo(
+        user_id=rng.choice(user_ids) if user_ids else None,
+        offer_id=rng.choice(offer_ids),
+        name=f'Benchmark contact {i}',
+        email=f'{BENCH_PREFIX}contact-{i}@example.com',
+        mobile=f'+9170{i:08d}',
+    ), contact_infos, batch_size)
+    report(f'{contact_infos} contact infos')
+    return dataset_counts()
+
+
+def flush_dataset():
+    """Delete everything generate_dataset created; referrals, clicks and contact infos cascade."""
+    Offer.objects.filter(external_id__startswith=BENCH_PREFIX).delete()
+    Advertiser.objects.filter(name__startswith=BENCH_PREFIX).delete()
+    User.objects.filter(username__startswith=BENCH_PREFIX).delete()
+    offer_index.invalidate()
+
+
+def dataset_counts():
+    offers = Offer.objects.filter(external_id__startswith=BENCH_PREFIX)
+    return {
+        'advertisers': Advertiser.objects.filter(name__startswith=BENCH_PREFIX).count(),
+        'offers': offers.count(),
+        'users': User.objects.filter(username__startswith=BENCH_PREFIX).count(),
+        'referrals': Referral.objects.filter(offer__in=offers).count(),
+        'clicks': ReferralClick.objects.filter(referral__offer__in=offers).count(),
+        'contact_infos': ContactInfo.objects.filter(offer__in=offers).count(),
+    }
+
+
+# --- Microbenchmarks ------------------------------------------------------
+
+def _time_calls(func, iterations, warmup=10):
+    for _ in range(min(warmup, iterations)):
+        func()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    result = percentiles(samples, scale=1e6)
+    result['ops_per_sec'] = round(len(samples) / sum(samples), 1) if sum(samples) else None
+    return result
+
+
+def _view_request(path, user, **meta):
+    request = RequestFactory(HTTP_HOST=BENCH_HOST).get(path, **meta)
+    request.user = user
+    request.session = SessionStore()
+    request._messages = FallbackStorage(request)
+    return request
+
+
+def run_microbenchmarks(iterations=1000):
+    """Time the hot helpers of the click path in isolation (microseconds per call)."""
+    from .views import build_referral_redirect_url, get_client_ip, is_duplicate_click, offer_detail
+
+    offer = Offer.objects.filter(**FUNNEL_OFFER_FILTER).select_related('advertiser').first()
+    referral = Referral.objects.filter(offer=offer).first() if offer else None
+    if offer is None or referral is None:
+        raise ValueError('No benchmark offers with referrals; run generate_benchmark_data first')
+    user = User.objects.filter(username__startswith=BENCH_PREFIX, userprofile__email_verified=True).first()
+    factory = RequestFactory()
+    forwarded = factory.get('/', HTTP_X_FORWARDED_FOR='203.0.113.7, 10.0.0.1, 10.0.0.2')
+    direct = factory.get('/', REMOTE_ADDR='198.51.100.4')
+    known_ip = ReferralClick.objects.filter(referral=referral).values_list('ip_address', flat=True).first()
+    detail_path = reverse('offer_detail_with_referral', kwargs={'offer_id': offer.id, 'referral_id': referral.id})
+    # Each signature is accepted once, so every verification gets its own payload
+    advertiser = offer.advertiser or Advertiser.objects.filter(name__startswith=BENCH_PREFIX).first()
+    postbacks = iter([signed_postback(advertiser.id, advertiser.postback_secret, str(i)) for i in range(iterations + 100)])
+
+    # offer_detail is called directly (no middleware); querysets are re-read on every call
+    benchmarks = {
+        'get_client_ip.forwarded': lambda: get_client_ip(forwarded),
+        'get_client_ip.direct': lambda: get_client_ip(direct),
+        'ip_lookup': lambda: ip_lookup('203.0.113.7'),
+        'build_referral_redirect_url': lambda: build_referral_redirect_url(offer, referral.id),
+        'is_duplicate_click.miss': lambda: is_duplicate_click(referral, '192.0.2.1'),
+        'is_duplicate_click.hit': lambda: is_duplicate_click(referral, known_ip or '192.0.2.1'),
+        'verify_postback': lambda: verify_postback(next(postbacks)),
+        'phone_validation.parse': lambda: phone_validation.is_possible('+91 98765 43210'),
+        'offer_detail.anonymous': lambda: offer_detail(_view_request(reverse('offer_detail', args=[offer.id]), AnonymousUser()), offer.id),
+        'offer_detail.referral_click': lambda: offer_detail(_view_request(detail_path, AnonymousUser(), REMOTE_ADDR='192.0.2.200'), offer.id, referral.id),
+    }
+    if user is not None:
+        benchmarks['offer_detail.authenticated'] = lambda: offer_detail(_view_request(reverse('offer_detail', args=[offer.id]), user), offer.id)
+
+    results = {}
+    for name, func in benchmarks.items():
+        # Views hit the DB and render templates; a tenth of the iterations is plenty
+        results[name] = _time_calls(func, iterations if not name.startswith('offer_detail') else max(iterations // 10, 10))
+    return results
+
+
+# --- End-to-end funnel ----------------------------------------------------
+
+FUNNEL_STEPS = ('index', 'offer_detail', 'grab_offer', 'postback')
+
+
+def signed_postback(advertiser_id, secret, referral_id, state='clicked'):
+    """POST data for views.postback, signed like an advertiser would."""
+    timestamp = int(time.time())
+    nonce = secrets.token_hex(8)
+    return {
+        'advertiser': advertiser_id,
+        'referral_id': referral_id,
+        'state': state,
+        'timestamp': timestamp,
+        'nonce': nonce,
+        'signature': sign(secret, advertiser_id, referral_id, state, timestamp, nonce),
+    }
+
+
+def run_funnel(client, target, ip, timings):
+    """index -> offer_detail (referral click) -> grab_offer (POST) -> postback, timing each step."""
+    offer_id, referral_id, advertiser_id, secret = target
+    steps = (
+        ('index', lambda: client.get(reverse('home'), REMOTE_ADDR=ip)),
+        ('offer_detail', lambda: client.get(
+            reverse('offer_detail_with_referral', kwargs={'offer_id': offer_id, 'referral_id': referral_id}), REMOTE_ADDR=ip)),
+        ('grab_offer', lambda: client.post(reverse('grab_offer', args=[offer_id, referral_id]), REMOTE_ADDR=ip)),
+        ('postback', lambda: client.post(reverse('postback'), signed_postback(advertiser_id, secret, referral_id),
+                                         REMOTE_ADDR=ip)),
+    )
+    errors = 0
+    for name, call in steps:
+        start = time.perf_counter()
+        response = call()
+        timings[name].append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            errors += 1
+    return errors
+
+
+def _funnel_targets(limit=200):
+    # Postbacks are signed per advertiser, so only offers with one are driven end to end
+    return list(Referral.objects.filter(**{f'offer__{key}': value for key, value in FUNNEL_OFFER_FILTER.items()})
+                .filter(offer__advertiser__isnull=False)
+                .order_by('id').values_list('offer_id', 'id', 'offer__advertiser_id', 'offer__advertiser__postback_secret')[:limit])
+
+
+def _summarize(timings, funnels, errors, elapsed):
+    all_steps = [sample for samples in timings.values() for sample in samples]
+    return {
+        'funnels': funnels,
+        'requests': len(all_steps),
+        'errors': errors,
+        'elapsed_s': round(elapsed, 3),
+        'funnels_per_sec': round(funnels / elapsed, 2) if elapsed else None,
+        'requests_per_sec': round(len(all_steps) / elapsed, 2) if elapsed else None,
+        'latency_ms': percentiles(all_steps, scale=1e3),
+        'steps_ms': {name: percentiles(samples, scale=1e3) for name, samples in timings.items()},
+    }
+
+
+def run_scenarios(funnels=100, seed=42):
+    """Drive the funnel sequentially through the test client, one fresh visitor per funnel."""
+    targets = _funnel_targets()
+    if not targets:
+        raise ValueError('No benchmark offers with referrals; run generate_benchmark_data first')
+    rng = random.Random(seed)
+    timings = {name: [] for name in FUNNEL_STEPS}
+    errors = 0
+    start = time.perf_counter()
+    for i in range(funnels):
+        # A new IP per funnel keeps clicks unique and stays under grab_offer's rate limit
+        errors += run_funnel(Client(HTTP_HOST=BENCH_HOST), rng.choice(targets), f'172.16.{i // 250 % 250}.{i % 250 + 1}', timings)
+    return _summarize(timings, funnels, errors, time.perf_counter() - start)
+
+
+def _load_worker(worker, funnels, seed, targets, queue):
+    # Each forked worker needs its own database connection
+    connections.close_all()
+    rng = random.Random(seed + worker)
+    timings = {name: [] for name in FUNNEL_STEPS}
+    errors = 0
+    for i in range(funnels):
+        errors += run_funnel(Client(HTTP_HOST=BENCH_HOST), rng.choice(targets), f'100.{64 + worker % 64}.{i // 250 % 250}.{i % 250 + 1}', timings)
+    connections.close_all()
+    queue.put((timings, errors))
+
+
+def run_load(workers=4, funnels_per_worker=50, seed=42):
+    """Run the funnel from several forked processes at once and merge their timings."""
+    targets = _funnel_targets()
+    if not targets:
+        raise ValueError('No benchmark offers with referrals; run generate_benchmark_data first')
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    processes = [context.Process(target=_load_worker, args=(w, funnels_per_worker, seed, targets, queue))
+                 for w in range(workers)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    results = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+
+    timings = {name: [] for name in FUNNEL_STEPS}
+    errors = 0
+    for worker_timings, worker_errors in results:
+        errors += worker_errors
+        for name, samples in worker_timings.items():
+            timings[name].extend(samples)
+    result = _summarize(timings, workers * funnels_per_worker, errors, elapsed)
+    result['workers'] = workers
+    return result
+
+
+# --- Mobile number pre-validation ----------------------------------------
+
+# What people type into the signup mobile field; every kind passes the old '^\+\d{10,15}$' check
+SIGNUP_NUMBER_MIX = {
+    'valid': 0.80,
+    'placeholder': 0.05,           # the form's prefilled +911234567890
+    'wrong_length': 0.05,          # a digit dropped or doubled
+    'not_mobile': 0.04,            # landline or unassigned leading digits
+    'missing_country_code': 0.04,  # '+' and the national number only
+    'unknown_code': 0.02,
+}
+# Countries of the valid numbers; the rest of the 'valid' share is spread over every described code
+SIGNUP_COUNTRY_MIX = {'91': 0.7, '1': 0.05, '44': 0.05, '971': 0.05}
+
+
+def _random_digits(rng, count):
+    return ''.join(rng.choice('0123456789') for _ in range(count))
+
+
+def synthetic_signup_numbers(count, seed=42):
+    """(kind, number) pairs drawn from SIGNUP_NUMBER_MIX."""
+    rng = random.Random(seed)
+    with open(phone_validation.METADATA_PATH, encoding='utf-8') as fh:
+        described = {code: entry for code, entry in json.load(fh)['codes'].items() if entry.get('mobile')}
+    codes = list(SIGNUP_COUNTRY_MIX) + list(described)
+    code_weights = list(SIGNUP_COUNTRY_MIX.values()) + [(1 - sum(SIGNUP_COUNTRY_MIX.values())) / len(described)] * len(described)
+
+    def valid(code):
+        entry = described[code]
+        prefix = ''.join(rng.choice(digits) for digits in phone_validation._expand(rng.choice(entry['mobile'])))
+        return code, prefix + _random_digits(rng, rng.choice(entry['lengths']) - len(prefix))
+
+    numbers = []
+    for kind in rng.choices(list(SIGNUP_NUMBER_MIX), weights=list(SIGNUP_NUMBER_MIX.values()), k=count):
+        code, national = valid(rng.choices(codes, weights=code_weights)[0])
+        if kind == 'placeholder':
+            number = '+911234567890'
+        elif kind == 'wrong_length':
+            number = f'+{code}{national[:-1] if rng.random() < 0.5 else national + national[-1]}'
+        elif kind == 'not_mobile':
+            number = f'+91{rng.choice("12345")}{_random_digits(rng, 9)}'
+        elif kind == 'missing_country_code':
+            number = f'+{valid("91")[1]}'
+        elif kind == 'unknown_code':
+            number = f'+{rng.choice(["28", "83", "89", "999"])}{_random_digits(rng, 10)}'
+        else:
+            number = f'+{code}{national}'
+        if 10 <= len(number) - 1 <= 15:
+            numbers.append((kind, number))
+    return numbers
+
+
+def run_phone_prevalidation(signups=10000, seed=42):
+    """Numbers sent to the paid validation APIs with the old regex check versus offline pre-validation.
+
+    Counts lookups before the MobileValidationCache, i.e. for first-time
+    numbers, per 10,000 signups of the SIGNUP_NUMBER_MIX.
+    """
+    numbers = synthetic_signup_numbers(signups, seed)
+    by_kind = {}
+    timings = []
+    for kind, number in numbers:
+        start = time.perf_counter()
+        possible = phone_validation.is_possible(number)
+        timings.append(time.perf_counter() - start)
+        counts = by_kind.setdefault(kind, {'numbers': 0, 'api_calls_after': 0})
+        counts['numbers'] += 1
+        counts['api_calls_after'] += possible
+    before = len(numbers)
+    after = sum(counts['api_calls_after'] for counts in by_kind.values())
+    return {
+        'signups': before,
+        'api_calls_before': before,
+        'api_calls_after': after,
+        'api_calls_saved_per_10k': round((before - after) * 10000 / before) if before else 0,
+        'by_kind': by_kind,
+        'check_us': percentiles(timings, scale=1e6),
+    }
+
+
+def compare(baseline, current, metric='p95'):
+    """Relative change of `metric` per benchmark/step between two result dicts (positive is slower)."""
+    changes = {}
+    for name, result in current.get('micro', {}).items():
+        before = baseline.get('micro', {}).get(name, {}).get(metric)
+        if before:
+            changes[f'micro.{name}'] = round(result[metric] / before - 1, 3)
+    for section in ('scenarios', 'load'):
+        for name, result in current.get(section, {}).get('steps_ms', {}).items():
+            before = baseline.get(section, {}).get('steps_ms', {}).get(name, {}).get(metric)
+            if before and result:
+                changes[f'{section}.{name}'] = round(result[metric] / before - 1, 3)
+    return changes
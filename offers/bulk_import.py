@@ -0,0 +1,332 @@
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from .models import AdBanner, Advertiser, Offer, TutorialVideo
+from .search import catalog
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_MEDIA_WORKERS = 8
+
+# Offer columns that a feed row may set directly (everything except relations and media)
+OFFER_FIELDS = [
+    'name', 'description', 'price', 'link', 'terms', 'reward', 'theme', 'is_active',
+    'requires_google_form', 'google_form_url', 'requires_contact_info', 'requires_lead_form',
+    'category', 'conversion_type', 'requires_conversion_proof',
+]
+BOOLEAN_FIELDS = {
+    'requires_google_form', 'requires_contact_info', 'requires_lead_form', 'requires_conversion_proof',
+}
+MEDIA_FIELDS = {'image': 'offers/', 'logo': 'logos/'}
+
+
+class FeedError(ValueError):
+    pass
+
+
+def load_feed(fileobj, fmt=None, name=''):
+    """Parse a CSV or JSON offer feed into a list of normalized row dicts."""
+    data = fileobj.read()
+    if isinstance(data, bytes):
+        data = data.decode('utf-8-sig')
+    if fmt is None:
+        fmt = 'json' if name.lower().endswith('.json') or data.lstrip()[:1] in ('[', '{') else 'csv'
+
+    if fmt == 'json':
+        rows = json.loads(data)
+        if isinstance(rows, dict):
+            rows = rows.get('offers', [])
+    elif fmt == 'csv':
+        rows = list(csv.DictReader(io.StringIO(data)))
+    else:
+        raise FeedError(f"Unsupported feed format: {fmt}")
+
+    return [normalize_row(row, line) for line, row in enumerate(rows, start=1)]
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y', 'on')
+
+
+def _split_list(value):
+    # CSV cells hold several banners/videos separated by '|'
+    if not value:
+        return []
+    if isinstance(value, list):
+        return value
+    return [item.strip() for item in str(value).split('|') if item.strip()]
+
+
+def normalize_row(row, line=0):
+    external_id = str(row.get('external_id') or '').strip()
+    name = str(row.get('name') or '').strip()
+    if not external_id or not name or row.get('price') in (None, ''):
+        raise FeedError(f"Row {line}: 'external_id', 'name' and 'price' are required")
+
+    offer = {}
+    for field in OFFER_FIELDS:
+        if field not in row or row[field] in (None, ''):
+            continue
+        value = row[field]
+        if field in BOOLEAN_FIELDS:
+            value = _parse_bool(value)
+        elif field == 'price':
+            try:
+                value = Decimal(str(value))
+            except InvalidOperation:
+                raise FeedError(f"Row {line}: invalid price {value!r}")
+        offer[field] = value
+    offer['name'] = name
+
+    banners = []
+    for banner in _split_list(row.get('banners')):
+        if isinstance(banner, str):
+            banner = {'image': banner}
+        banners.append({
+            'image': banner.get('image', ''),
+            'title': banner.get('title') or None,
+            'description': banner.get('description') or None,
+        })
+
+    videos = []
+    for video in _split_list(row.get('videos')):
+        if isinstance(video, str):
+            video = {'url': video}
+        videos.append({
+            'url': video.get('url', ''),
+            'title': video.get('title') or None,
+            'description': video.get('description') or None,
+        })
+
+    advertiser = None
+    if row.get('advertiser'):
+        advertiser = {
+            'name': str(row['advertiser']).strip(),
+            'base_url': row.get('advertiser_base_url') or '',
+            'query_param_prefix': row.get('advertiser_query_param_prefix') or 'aff_sub',
+        }
+
+    return {
+        'external_id': external_id,
+        'offer': offer,
+        'advertiser': advertiser,
+        'media': {field: row[field] for field in MEDIA_FIELDS if row.get(field)},
+        'banners': banners,
+        'videos': videos,
+    }
+
+
+def resolve_media_path(source, media_root):
+    """The real path of a feed media path under media_root, or None if it points anywhere else."""
+    if not media_root:
+        return None
+    root = os.path.realpath(media_root)
+    path = os.path.realpath(os.path.join(root, source))
+    if os.path.commonpath([root, path]) != root:
+        return None
+    return path
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _copy_media(upload_to, source, media_root):
+    path = resolve_media_path(source, media_root)
+    if path is None:
+        logger.warning(f"Feed media outside OFFER_FEED_MEDIA_ROOT, skipping: {source}")
+        return (upload_to, source), None
+    if not os.path.isfile(path):
+        logger.warning(f"Feed media not found, skipping: {source}")
+        return (upload_to, source), None
+    # Stored under its content hash, so a re-import reuses the copy only when the bytes match
+    target = f'{upload_to}{_file_digest(path)[:16]}-{os.path.basename(path)}'
+    if default_storage.exists(target):
+        return (upload_to, source), target
+    with open(path, 'rb') as fh:
+        saved = default_storage.save(target, File(fh))
+    return (upload_to, source), saved
+
+
+def copy_media(rows, workers=DEFAULT_MEDIA_WORKERS, media_root=None):
+    """Copy every media path referenced by the feed into storage, in parallel.
+
+    Paths are relative to media_root (OFFER_FEED_MEDIA_ROOT by default); paths
+    that resolve outside it, absolute or through '..' or symlinks, are skipped,
+    as is everything when no root is configured. Returns a map of
+    (upload_to, source path) -> stored name. Each path is copied once per
+    upload directory even if several offers share it.
+    """
+    if media_root is None:
+        media_root = getattr(settings, 'OFFER_FEED_MEDIA_ROOT', None)
+    jobs = set()
+    for row in rows:
+        for field, source in row['media'].items():
+            jobs.add((MEDIA_FIELDS[field], source))
+        for banner in row['banners']:
+            if banner['image']:
+                jobs.add(('ad_banners/', banner['image']))
+    if not jobs:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lambda job: _copy_media(*job, media_root), jobs)
+        return {key: saved for key, saved in results if saved}
+
+
+def _upsert_advertisers(rows, batch_size):
+    advertisers = {}
+    for row in rows:
+        if row['advertiser']:
+            advertisers[row['advertiser']['name']] = row['advertiser']
+
+    existing = {a.name: a for a in Advertiser.objects.filter(name__in=list(advertisers))}
+    objs = []
+    for name, data in advertisers.items():
+        current = existing.get(name)
+        objs.append(Advertiser(
+            name=name,
+            base_url=data['base_url'] or (current.base_url if current else ''),
+            query_param_prefix=data['query_param_prefix'],
+        ))
+    Advertiser.objects.bulk_create(
+        objs,
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['name'],
+        update_fields=['base_url', 'query_param_prefix', 'updated_at'],
+    )
+    return dict(Advertiser.objects.filter(name__in=list(advertisers)).values_list('name', 'id'))
+
+
+def _upsert_offer_batch(batch, advertiser_ids, media_map):
+    # Rows only overwrite the columns they carry, so rows are grouped by the set
+    # of columns they set and each group is upserted with its own update_fields.
+    groups = {}
+    for row in batch:
+        offer = Offer(external_id=row['external_id'], **row['offer'])
+        fields = set(row['offer']) | {'updated_at'}
+        if row['advertiser']:
+            offer.advertiser_id = advertiser_ids[row['advertiser']['name']]
+            fields.add('advertiser')
+        for field, source in row['media'].items():
+            saved = media_map.get((MEDIA_FIELDS[field], source))
+            if saved:
+                setattr(offer, field, saved)
+                fields.add(field)
+        groups.setdefault(frozenset(fields), []).append(offer)
+
+    for fields, objs in groups.items():
+        Offer.objects.bulk_create(
+            objs,
+            update_conflicts=True,
+            unique_fields=['external_id'],
+            update_fields=sorted(fields),
+        )
+    offer_ids = dict(
+        Offer.objects.filter(external_id__in=[row['external_id'] for row in batch]).values_list('external_id', 'id')
+    )
+
+    # Banners and videos have no natural key, so the feed replaces them wholesale
+    # for every offer that lists any.
+    banner_offers = [offer_ids[row['external_id']] for row in batch if row['banners']]
+    video_offers = [offer_ids[row['external_id']] for row in batch if row['videos']]
+    AdBanner.objects.filter(offer_id__in=banner_offers).delete()
+    TutorialVideo.objects.filter(offer_id__in=video_offers).delete()
+
+    banners = []
+    videos = []
+    for row in batch:
+        offer_id = offer_ids[row['external_id']]
+        for banner in row['banners']:
+            image = media_map.get(('ad_banners/', banner['image']))
+            if image:
+                banners.append(AdBanner(offer_id=offer_id, image=image, title=banner['title'], description=banner['description']))
+        for video in row['videos']:
+            if video['url']:
+                videos.append(TutorialVideo(offer_id=offer_id, **video))
+    AdBanner.objects.bulk_create(banners)
+    TutorialVideo.objects.bulk_create(videos)
+    return len(banners), len(videos)
+
+
+def diff_feed(rows):
+    """Compare feed rows with the stored offers without writing anything."""
+    existing = {
+        offer['external_id']: offer
+        for offer in Offer.objects.filter(
+            external_id__in=[row['external_id'] for row in rows]
+        ).values('external_id', 'advertiser__name', *OFFER_FIELDS)
+    }
+    created = []
+    updated = []
+    unchanged = 0
+    for row in rows:
+        current = existing.get(row['external_id'])
+        if current is None:
+            created.append(row['external_id'])
+            continue
+        changes = {}
+        for field, value in row['offer'].items():
+            if current[field] != value:
+                changes[field] = (current[field], value)
+        advertiser = row['advertiser']['name'] if row['advertiser'] else None
+        if advertiser and current['advertiser__name'] != advertiser:
+            changes['advertiser'] = (current['advertiser__name'], advertiser)
+        if changes:
+            updated.append({'external_id': row['external_id'], 'changes': changes})
+        else:
+            unchanged += 1
+    return {'created': created, 'updated': updated, 'unchanged': unchanged}
+
+
+def import_offers(rows, batch_size=DEFAULT_BATCH_SIZE, dry_run=False, workers=DEFAULT_MEDIA_WORKERS, media_root=None):
+    """Upsert advertisers, offers, banners and videos from normalized feed rows.
+
+    media_root overrides OFFER_FEED_MEDIA_ROOT for the command line; the admin
+    upload always uses the setting.
+    """
+    if dry_run:
+        return {'dry_run': True, **diff_feed(rows)}
+
+    # Later rows win when a feed repeats an external_id
+    rows = list({row['external_id']: row for row in rows}.values())
+    media_map = copy_media(rows, workers=workers, media_root=media_root)
+
+    banners = videos = 0
+    with transaction.atomic():
+        advertiser_ids = _upsert_advertisers(rows, batch_size)
+        for start in range(0, len(rows), batch_size):
+            b, v = _upsert_offer_batch(rows[start:start + batch_size], advertiser_ids, media_map)
+            banners += b
+            videos += v
+    # bulk_create bypasses post_save, so every worker rebuilds its catalog lazily instead
+    catalog.invalidate()
+
+    logger.info(f"Offer feed imported: offers={len(rows)}, advertisers={len(advertiser_ids)}, banners={banners}, videos={videos}, media={len(media_map)}")
+    return {
+        'dry_run': False,
+        'offers': len(rows),
+        'advertisers': len(advertiser_ids),
+        'banners': banners,
+        'videos': videos,
+        'media': len(media_map),
+    }
@@ -0,0 +1,381 @@
+"""
+Versioned cache namespaces shared by every worker.
+
+A namespace ('offers', 'advertisers', ...) has a version number published on
+the invalidation bus (CACHE_BUS_URL):
+
+* file:///path/cache_bus.json (default): the versions of every namespace in one
+  JSON file on the host. A bump rewrites it under an flock and swaps it in with
+  os.replace; readers stat() it at most every CACHE_BUS_POLL_INTERVAL seconds
+  and reload when it changed, so a bump reaches every worker on the host
+  within a few milliseconds.
+* redis://host:port/db: versions in a Redis hash, bumped with HINCRBY and
+  announced with PUBLISH; each process applies announcements from a listener
+  thread (and rereads the hash every CACHE_BUS_POLL_INTERVAL while it is not
+  connected), which also spans hosts. Needs the redis package.
+
+Values cached in a namespace are stored under '<namespace>:<version>:<key>',
+so invalidate() is one bump: entries of older versions are never read again
+and age out. Each namespace lives in a tier: 'local' is a per-process LRU of
+CACHE_LOCAL_MAX_ENTRIES entries, 'shared' is the CACHE_SHARED_ALIAS Django
+cache, which must be one every worker reaches (a local-memory backend is
+refused). get_or_set() computes a missing value once: other threads of the
+process wait for it, and on the shared tier other workers wait on a fill lock
+in that cache for up to CACHE_FILL_LOCK_TIMEOUT seconds.
+
+In-memory structures built from the database (the search index, the ranking
+snapshot, postback secrets) compare the namespace version instead and rebuild
+when it moved. Lookups are counted per namespace and tier in
+cashback_namespace_cache_requests_total; stats() gives the hit ratios.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+TIERS = ('local', 'shared')
+FILL_LOCK_PREFIX = 'cache-fill:'
+_MISSING = object()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class FileBus:
+    """Namespace versions in a JSON file that every process on the host reads."""
+
+    def __init__(self, path, poll_interval):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._signature = None
+        self._checked_at = 0.0
+
+    def _read(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None, {}
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return signature, self._versions
+        try:
+            with open(self.path, encoding='utf-8') as fh:
+                return signature, json.load(fh)
+        except (FileNotFoundError, ValueError):
+            # Replaced between stat() and open(): read it again on the next poll
+            return self._signature, self._versions
+
+    def versions(self):
+        now = time.monotonic()
+        if now - self._checked_at >= self.poll_interval:
+            with self._lock:
+                self._signature, self._versions = self._read()
+                self._checked_at = now
+        return self._versions
+
+    def bump(self, namespace):
+        import fcntl
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f'{self.path}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                versions = dict(self._read()[1])
+                versions[namespace] = versions.get(namespace, 0) + 1
+                temporary = f'{self.path}.{os.getpid()}.tmp'
+                with open(temporary, 'w', encoding='utf-8') as fh:
+                    json.dump(versions, fh)
+                os.replace(temporary, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        with self._lock:
+            self._signature, self._versions = self._read()
+            self._checked_at = time.monotonic()
+        return versions[namespace]
+
+
+class RedisBus:
+    """Namespace versions in a Redis hash, with bumps announced over pub/sub."""
+
+    def __init__(self, url, poll_interval, key='cache-bus:versions'):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured(f"CACHE_BUS_URL {url} needs the redis package (pip install redis).")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.poll_interval = poll_interval
+        self.key = key
+        self.channel = f'{key}:bumps'
+        self._versions = {}
+        self._checked_at = 0.0
+        self._listening = False
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def _reload(self):
+        self._versions = {name: int(version) for name, version in self.client.hgetall(self.key).items()}
+        self._checked_at = time.monotonic()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Bumps made before the subscription are in the hash
+                self._reload()
+                self._listening = True
+                for message in pubsub.listen():
+                    namespace, version = message['data'].rsplit(':', 1)
+                    if int(version) > self._versions.get(namespace, 0):
+                        self._versions = {**self._versions, namespace: int(version)}
+            except Exception as e:
+                logger.warning(f"Cache bus listener disconnected: {e}")
+            self._listening = False
+            time.sleep(1)
+
+    def versions(self):
+        if self._listener is None:
+            with self._lock:
+                if self._listener is None:
+                    self._listener = threading.Thread(target=self._listen, name='cache-bus', daemon=True)
+                    self._listener.start()
+        if not self._listening and time.monotonic() - self._checked_at >= self.poll_interval:
+            try:
+                self._reload()
+            except Exception as e:
+                logger.warning(f"Cache bus unavailable: {e}")
+                self._checked_at = time.monotonic()
+        return self._versions
+
+    def bump(self, namespace):
+        version = self.client.hincrby(self.key, namespace, 1)
+        self.client.publish(self.channel, f'{namespace}:{version}')
+        self._versions = {**self._versions, namespace: max(version, self._versions.get(namespace, 0))}
+        return version
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def bus():
+    global _bus
+    if _bus is None:
+        with _bus_lock:
+            if _bus is None:
+                url = _setting('CACHE_BUS_URL', None) or f"file://{os.path.join(settings.BASE_DIR, 'cache_bus.json')}"
+                poll_interval = _setting('CACHE_BUS_POLL_INTERVAL', 0.005)
+                parsed = urlparse(url)
+                if parsed.scheme == 'file':
+                    _bus = FileBus(parsed.path, poll_interval)
+                elif parsed.scheme in ('redis', 'rediss', 'unix'):
+                    _bus = RedisBus(url, poll_interval)
+                else:
+                    raise ImproperlyConfigured(f"Unsupported CACHE_BUS_URL scheme: {parsed.scheme}")
+    return _bus
+
+
+class LocalTier:
+    """Per-process LRU with per-entry expiry."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def _store(self, key, value, timeout):
+        self._entries[key] = (value, None if timeout is None else time.monotonic() + timeout)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._store(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                return False
+            self._store(key, value, timeout)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_local_tier = None
+
+
+def local_tier():
+    global _local_tier
+    if _local_tier is None:
+        _local_tier = LocalTier(_setting('CACHE_LOCAL_MAX_ENTRIES', 10000))
+    return _local_tier
+
+
+def shared_tier():
+    alias = _setting('CACHE_SHARED_ALIAS', 'default')
+    cache = caches[alias]
+    if isinstance(cache, LocMemCache):
+        # Every process would fill, lock and invalidate its own copy
+        raise ImproperlyConfigured(f"CACHE_SHARED_ALIAS {alias!r} is a local-memory cache; use one all workers share.")
+    return cache
+
+
+# One computation per key and process at a time: key -> lock, dropped when the fill ends
+_fills = {}
+_fills_lock = threading.Lock()
+
+
+def get_or_set(cache, key, compute, timeout=None, shared=True):
+    """cache[key], computing and storing it on a miss; concurrent misses compute once.
+
+    Threads of this process wait for the one computing the key. With
+    shared=True other processes do too: the first to take a fill lock in the
+    cache computes, the rest poll for its value until CACHE_FILL_LOCK_TIMEOUT
+    and then compute it themselves. The value is stored with add(), so a
+    counter incremented in the meantime is not overwritten. Returns (value, hit).
+    """
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        return value, True
+    with _fills_lock:
+        fill = _fills.setdefault(key, threading.Lock())
+    with fill:
+        try:
+            value = cache.get(key, _MISSING)
+            if value is not _MISSING:
+                return value, True
+            lock_timeout = _setting('CACHE_FILL_LOCK_TIMEOUT', 10)
+            if shared and not cache.add(f'{FILL_LOCK_PREFIX}{key}', 1, timeout=lock_timeout):
+                deadline = time.monotonic() + lock_timeout
+                while time.monotonic() < deadline:
+                    time.sleep(0.01)
+                    value = cache.get(key, _MISSING)
+                    if value is not _MISSING:
+                        return value, True
+                logger.warning(f"Cache fill lock timed out: key={key}")
+            try:
+                value = compute()
+                if not cache.add(key, value, timeout=timeout):
+                    stored = cache.get(key, _MISSING)
+                    value = value if stored is _MISSING else stored
+            finally:
+                if shared:
+                    cache.delete(f'{FILL_LOCK_PREFIX}{key}')
+            return value, False
+        finally:
+            with _fills_lock:
+                _fills.pop(key, None)
+
+
+class Namespace:
+    def __init__(self, name, tier='local', timeout=None):
+        if tier not in TIERS:
+            raise ValueError(f"Unknown cache tier {tier}; expected one of {', '.join(TIERS)}")
+        self.name = name
+        self.tier = tier
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def version(self):
+        return bus().versions().get(self.name, 0)
+
+    def invalidate(self):
+        """Bump the version in every worker; returns the new version."""
+        version = bus().bump(self.name)
+        logger.info(f"Cache namespace invalidated: namespace={self.name}, version={version}")
+        return version
+
+    def key(self, key):
+        return f'{self.name}:{self.version}:{key}'
+
+    def _cache(self):
+        return local_tier() if self.tier == 'local' else shared_tier()
+
+    def _record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        registry.inc('cashback_namespace_cache_requests_total',
+                     {'namespace': self.name, 'tier': self.tier, 'result': 'hit' if hit else 'miss'},
+                     help_text='Versioned cache namespace lookups by namespace, tier and result')
+
+    def get(self, key, default=None):
+        value = self._cache().get(self.key(key), _MISSING)
+        self._record(value is not _MISSING)
+        return default if value is _MISSING else value
+
+    def set(self, key, value, timeout=None):
+        self._cache().set(self.key(key), value, timeout=self.timeout if timeout is None else timeout)
+
+    def delete(self, key):
+        self._cache().delete(self.key(key))
+
+    def get_or_set(self, key, compute, timeout=None):
+        value, hit = get_or_set(self._cache(), self.key(key), compute,
+                                timeout=self.timeout if timeout is None else timeout,
+                                shared=self.tier == 'shared')
+        self._record(hit)
+        return value
+
+
+_namespaces = {}
+
+
+def namespace(name, tier='local', timeout=None):
+    """The process-wide Namespace called name (created with tier and timeout on first use)."""
+    if name not in _namespaces:
+        _namespaces.setdefault(name, Namespace(name, tier, timeout))
+    return _namespaces[name]
+
+
+def stats():
+    """{namespace: {tier, version, hits, misses, hit_ratio}} for this process."""
+    return {
+        name: {
+            'tier': ns.tier,
+            'version': ns.version,
+            'hits': ns.hits,
+            'misses': ns.misses,
+            'hit_ratio': round(ns.hits / (ns.hits + ns.misses), 4) if ns.hits + ns.misses else None,
+        }
+        for name, ns in sorted(_namespaces.items())
+    }
@@ -0,0 +1,171 @@
+"""
+Stateless image CAPTCHA for the contact-info form.
+
+A challenge shows CAPTCHA_CHOICES tiles from a pool of shapes ("Select the
+blue triangle"). Nothing is stored when it is issued: the form carries a token
+
+    <issued_at>.<nonce>.<signature>
+
+where the signature binds the nonce to the scope (the offer) and issue time.
+Which tiles are shown, in which slots, and the right slot are all derived from
+an HMAC of the nonce, so only the server can work them out and verify()
+recomputes them instead of reading anything back. The only state is a
+UsedToken row per submitted nonce (offers.replay), claimed before the answer
+is compared, so a token gets exactly one answer, right or wrong, and cannot be
+submitted again (or guessed slot by slot).
+
+Each challenge has an image of its own, drawn on request from the nonce and
+served at a signed, expiring URL; the page addresses tiles only by their slot
+in that image. Nothing in the page or the URL says which shape sits in a
+slot, and the same shape is drawn differently in every challenge, so each
+one has to be read from its pixels.
+"""
+import io
+import logging
+import math
+import random
+import secrets
+import time
+
+from django.conf import settings
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from . import replay
+
+logger = logging.getLogger(__name__)
+
+SHAPES = ('circle', 'square', 'triangle', 'diamond', 'star', 'hexagon', 'cross', 'ring')
+COLORS = {
+    'red': (220, 38, 38),
+    'blue': (37, 99, 235),
+    'green': (22, 163, 74),
+    'orange': (234, 88, 12),
+    'purple': (147, 51, 234),
+    'black': (31, 41, 55),
+}
+POOL = tuple((shape, color) for shape in SHAPES for color in COLORS)
+TILE_SIZE = 80
+IMAGE_COLUMNS = 3
+REPLAY_KIND = 'captcha'
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _mac(*parts):
+    return salted_hmac('offers.captcha', '|'.join(str(part) for part in parts)).hexdigest()
+
+
+def _challenge(nonce):
+    """(pool index per slot, right slot) for a nonce, derived from the secret key."""
+    rng = random.Random(_mac('challenge', nonce))
+    choices = min(_setting('CAPTCHA_CHOICES', 6), len(POOL))
+    target = rng.randrange(len(POOL))
+    # Distractors never share both shape and colour with the target, so exactly one tile is right
+    tiles = [target] + rng.sample([i for i in range(len(POOL)) if i != target], choices - 1)
+    rng.shuffle(tiles)
+    return tuple(tiles), tiles.index(target)
+
+
+def _slot_position(slot):
+    return (slot % IMAGE_COLUMNS) * TILE_SIZE, (slot // IMAGE_COLUMNS) * TILE_SIZE
+
+
+def _polygon(sides, radius, center, rotation=0.0):
+    cx, cy = center
+    return [(cx + radius * math.cos(rotation + 2 * math.pi * i / sides),
+             cy + radius * math.sin(rotation + 2 * math.pi * i / sides)) for i in range(sides)]
+
+
+def _draw_tile(draw, shape, color, left, top, rng):
+    cx, cy = left + TILE_SIZE / 2 + rng.uniform(-6, 6), top + TILE_SIZE / 2 + rng.uniform(-6, 6)
+    r = rng.uniform(20, 28)
+    # A little clutter under the shape, so tiles are not flat-colour matches
+    for _ in range(4):
+        draw.line([(left + rng.uniform(0, TILE_SIZE), top + rng.uniform(0, TILE_SIZE)),
+                   (left + rng.uniform(0, TILE_SIZE), top + rng.uniform(0, TILE_SIZE))],
+                  fill=tuple(rng.randint(170, 230) for _ in range(3)), width=2)
+    if shape == 'circle':
+        draw.ellipse([cx - r, cy - r, cx + r, cy + r], fill=color)
+    elif shape == 'ring':
+        draw.ellipse([cx - r, cy - r, cx + r, cy + r], outline=color, width=7)
+    elif shape == 'square':
+        draw.polygon(_polygon(4, r * 1.2, (cx, cy), math.pi / 4 + rng.uniform(-0.15, 0.15)), fill=color)
+    elif shape == 'diamond':
+        draw.polygon(_polygon(4, r * 1.2, (cx, cy), rng.uniform(-0.15, 0.15)), fill=color)
+    elif shape == 'triangle':
+        draw.polygon(_polygon(3, r * 1.2, (cx, cy), -math.pi / 2 + rng.uniform(-0.3, 0.3)), fill=color)
+    elif shape == 'hexagon':
+        draw.polygon(_polygon(6, r * 1.1, (cx, cy), rng.uniform(0, math.pi / 3)), fill=color)
+    elif shape == 'star':
+        rotation = -math.pi / 2 + rng.uniform(-0.3, 0.3)
+        outer, inner = _polygon(5, r * 1.25, (cx, cy), rotation), _polygon(5, r * 0.5, (cx, cy), rotation + math.pi / 5)
+        draw.polygon([point for pair in zip(outer, inner) for point in pair], fill=color)
+    elif shape == 'cross':
+        w = r * 0.4
+        draw.rectangle([cx - r, cy - w, cx + r, cy + w], fill=color)
+        draw.rectangle([cx - w, cy - r, cx + w, cy + r], fill=color)
+
+
+def image_png(key):
+    """The tiles of one challenge as a PNG, for a key from issue(); None if forged or expired."""
+    try:
+        issued_at, nonce, mac = key.split('.')
+        issued_at = int(issued_at)
+    except ValueError:
+        return None
+    if not 0 <= time.time() - issued_at <= _setting('CAPTCHA_TTL', 600):
+        return None
+    if not constant_time_compare(mac, _mac('image', issued_at, nonce)[:20]):
+        return None
+
+    from PIL import Image, ImageDraw
+
+    tiles, _ = _challenge(nonce)
+    rows = math.ceil(len(tiles) / IMAGE_COLUMNS)
+    image = Image.new('RGB', (IMAGE_COLUMNS * TILE_SIZE, rows * TILE_SIZE), (249, 250, 251))
+    draw = ImageDraw.Draw(image)
+    rng = random.Random(_mac('render', nonce))
+    for slot, index in enumerate(tiles):
+        shape, color = POOL[index]
+        _draw_tile(draw, shape, COLORS[color], *_slot_position(slot), rng)
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def issue(scope):
+    """A new challenge for a form; scope (e.g. the offer id) must match on verify."""
+    issued_at = int(time.time())
+    nonce = secrets.token_urlsafe(12)
+    tiles, answer = _challenge(nonce)
+    shape, color = POOL[tiles[answer]]
+    return {
+        'description': f'Select the {color} {shape}',
+        'token': f"{issued_at}.{nonce}.{_mac('token', scope, issued_at, nonce)}",
+        'image_url': reverse('captcha_image', args=[f"{issued_at}.{nonce}.{_mac('image', issued_at, nonce)[:20]}"]),
+        'tile_size': TILE_SIZE,
+        'tiles': [dict(zip(('slot', 'x', 'y'), (slot, *_slot_position(slot)))) for slot in range(len(tiles))],
+    }
+
+
+def verify(data, scope):
+    """True if data (request.POST) answers an unexpired, unused challenge issued for scope."""
+    try:
+        issued_at, nonce, signature = data.get('captcha_token', '').split('.')
+        issued_at = int(issued_at)
+    except ValueError:
+        return False
+    ttl = _setting('CAPTCHA_TTL', 600)
+    if not 0 <= time.time() - issued_at <= ttl:
+        return False
+    if not constant_time_compare(signature, _mac('token', scope, issued_at, nonce)):
+        return False
+    # A token is answered once: a wrong answer uses it up as well
+    if not replay.claim(REPLAY_KIND, nonce, ttl):
+        logger.warning(f"CAPTCHA token replayed: scope={scope}")
+        return False
+    _, answer = _challenge(nonce)
+    return constant_time_compare(data.get('captcha_image', ''), str(answer))
@@ -2,16 +2,16 @@ from allauth.account.forms import SignupForm
 from django import forms
 from offers.models import UserProfile, PendingVerification, ContactInfo
 from offers.utils import send_email_verification_code, validate_mobile_number, send_verification_email
+from offers import phone_validation, verification_codes
+from offers.ipintel import client_ip
 from django.core.mail import send_mail
 from django.core.exceptions import ValidationError
-import re
 import logging
-import random
 
 logger = logging.getLogger(__name__)
 
 class CustomSignupForm(SignupForm):
-    mobile_number = forms.CharField(max_length=15, required=True, label="Mobile Number")
+    mobile_number = forms.CharField(max_length=20, required=True, label="Mobile Number")
     email_verification_code = forms.CharField(max_length=6, required=False, label="Email Verification Code")
 
     def __init__(self, *args, **kwargs):
@@ -20,9 +20,10 @@ class CustomSignupForm(SignupForm):
 
     def clean_mobile_number(self):
         mobile = self.cleaned_data['mobile_number']
-        if not re.match(r'^\+\d{10,15}$', mobile):
-            raise ValidationError("Mobile number must start with a '+' followed by 10-15 digits (e.g., +919876543210).")
-        return mobile
+        try:
+            return phone_validation.normalize(mobile)
+        except phone_validation.InvalidNumber as e:
+            raise ValidationError(str(e))
 
     def clean(self):
         cleaned_data = super().clean()
@@ -31,13 +32,15 @@ class CustomSignupForm(SignupForm):
         email_code = cleaned_data.get('email_verification_code')
 
         if email and email_code:
-            expected_code = self.request.session.get('email_verification_code')
-            if email_code != expected_code:
-                raise ValidationError("Invalid email verification code.")
-            self.request.session['email_verified'] = True
-        elif email and not self.request.session.get('email_verified'):
-            code = str(random.randint(100000, 999999))
-            self.request.session['email_verification_code'] = code
+            try:
+                verification_codes.check(email, email_code, ip=client_ip(self.request.META))
+            except verification_codes.VerificationError as e:
+                raise ValidationError(str(e))
+        elif email and not verification_codes.is_verified(email):
+            try:
+                code = verification_codes.issue(email, ip=client_ip(self.request.META))
+            except verification_codes.Throttled as e:
+                raise ValidationError(str(e))
             send_email_verification_code(self.request.user, email, code)
             raise ValidationError("Please enter the email verification code sent to your email.")
 
@@ -74,14 +77,13 @@ class CustomSignupForm(SignupForm):
         user_profile, created = UserProfile.objects.get_or_create(user=user)
 
         user_profile.mobile_verified = request.session.get('mobile_verified', False)
-        user_profile.email_verified = request.session.get('email_verified', False)
+        user_profile.email_verified = verification_codes.is_verified(user.email)
         user_profile.save()
+        verification_codes.consume(user.email)
 
         if not user_profile.mobile_verified:
             PendingVerification.objects.filter(mobile_number=mobile_number, user__isnull=True).update(user=user)
 
-        request.session.pop('email_verification_code', None)
-        request.session.pop('email_verified', None)
         request.session.pop('mobile_verified', None)
 
         try:
@@ -90,7 +92,7 @@ class CustomSignupForm(SignupForm):
             logger.error(f"Failed to send email verification to {user.email}: {str(e)}")
 
 class UpdateMobileForm(forms.Form):
-    mobile_number = forms.CharField(max_length=15, required=True, label="New Mobile Number")
+    mobile_number = forms.CharField(max_length=20, required=True, label="New Mobile Number")
 
     def __init__(self, *args, user=None, request=None, **kwargs):
         self.user = user
@@ -99,9 +101,10 @@ class UpdateMobileForm(forms.Form):
 
     def clean_mobile_number(self):
         mobile = self.cleaned_data['mobile_number']
-        if not re.match(r'^\+\d{10,15}$', mobile):
-            raise ValidationError("Mobile number must start with a '+' followed by 10-15 digits (e.g., +919876543210).")
-        return mobile
+        try:
+            return phone_validation.normalize(mobile)
+        except phone_validation.InvalidNumber as e:
+            raise ValidationError(str(e))
 
     def clean(self):
         cleaned_data = super().clean()
@@ -133,10 +136,7 @@ class UpdateMobileForm(forms.Form):
 
     def save(self, request):
         mobile_number = self.cleaned_data.get('mobile_number')
-        user_profile = self.user.userprofile
-
-        user_profile.mobile_verified = request.session.get('mobile_verified', False)
-        user_profile.save()
+        UserProfile.objects.update_for(self.user, mobile_verified=request.session.get('mobile_verified', False))
 
         request.session.pop('mobile_verified', None)
 
@@ -152,6 +152,11 @@ class ContactInfoForm(forms.ModelForm):
 
     def clean_mobile(self):
         mobile = self.cleaned_data['mobile']
-        if not re.match(r'^\+\d{10,15}$', mobile):
-            raise ValidationError("Mobile number must start with a '+' followed by 10-15 digits (e.g., +919876543210).")
-        return mobile
\ No newline at end of file
+        try:
+            return phone_validation.normalize(mobile)
+        except phone_validation.InvalidNumber as e:
+            raise ValidationError(str(e))
+
+class OfferFeedImportForm(forms.Form):
+    feed = forms.FileField(label="Feed file (CSV or JSON)")
+    dry_run = forms.BooleanField(required=False, initial=True, label="Dry run (show changes without saving)")
@@ -0,0 +1,325 @@
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Default rules: (window seconds, limit, weight). A signal scores 0 up to its
+# limit and rises linearly to 1 at twice the limit; FRAUD_RULES overrides these.
+DEFAULT_RULES = {
+    'ip_velocity': {'window': 60, 'limit': 10, 'weight': 0.9},
+    'subnet_velocity': {'window': 60, 'limit': 60, 'weight': 0.6},
+    'session_velocity': {'window': 60, 'limit': 10, 'weight': 0.9},
+    'referral_velocity': {'window': 60, 'limit': 120, 'weight': 0.5},
+    'ip_distinct_referrals': {'window': 3600, 'limit': 20, 'weight': 0.8},
+    # Lifetime clicks per conversion on a referral, checked once it has min_clicks;
+    # totals of referrals idle for `idle` seconds are dropped
+    'referral_click_conversion_ratio': {'limit': 500, 'min_clicks': 200, 'weight': 0.5, 'idle': 7 * 86400},
+}
+VELOCITY_DIMENSIONS = {
+    'ip_velocity': 'ip',
+    'subnet_velocity': 'subnet',
+    'session_velocity': 'session',
+    'referral_velocity': 'referral',
+}
+SWEEP_EVERY = 10000
+
+
+def subnet_of(ip_address):
+    """The /24 of an IPv4 address, or the /48 of an IPv6 one, as a string key."""
+    if ':' in ip_address:
+        return ':'.join(ip_address.split(':')[:3]) + '::/48'
+    return ip_address.rsplit('.', 1)[0] + '.0/24'
+
+
+class ClickVerdict:
+    __slots__ = ('score', 'reasons', 'action')
+
+    def __init__(self, score, reasons, action):
+        self.score = score
+        self.reasons = reasons
+        self.action = action  # 'allow', 'flag' or 'discard'
+
+    def __repr__(self):
+        return f"<ClickVerdict {self.action} score={self.score:.2f} reasons={self.reasons}>"
+
+
+class ClickFraudEngine:
+    """Scores referral clicks from sliding-window features kept in memory.
+
+    Every click attempt (duplicates included) is observed per IP, per /24,
+    per session key and per referral. Each worker process keeps its own
+    features and snapshots them every FRAUD_SNAPSHOT_INTERVAL seconds to a
+    file of its own, FRAUD_STATE_FILE.<pid>. On first use a worker merges
+    every snapshot it finds: windows are unions of timestamps (so history two
+    files share is not counted twice), referral totals take the largest
+    count seen. Snapshots of workers that stopped are removed once a running
+    worker that merged them has written its own.
+    """
+
+    def __init__(self, rules=None, state_file=None, snapshot_interval=None):
+        self._lock = threading.Lock()
+        self._rules = rules
+        self._state_file = state_file
+        self._snapshot_interval = snapshot_interval
+        self._loaded = False
+        self._reset()
+
+    def _reset(self):
+        self._velocity = {dimension: {} for dimension in VELOCITY_DIMENSIONS.values()}
+        # ip -> {referral_id: last seen}, oldest first
+        self._ip_referrals = {}
+        # referral_id -> [clicks, conversions, last seen]
+        self._referral_totals = {}
+        self._observed = 0
+        self._loaded_at = time.time()
+        self._last_snapshot = time.time()
+        self._snapshot_running = False
+
+    @property
+    def rules(self):
+        if self._rules is None:
+            rules = {name: dict(rule) for name, rule in DEFAULT_RULES.items()}
+            for name, overrides in getattr(settings, 'FRAUD_RULES', {}).items():
+                rules.setdefault(name, {}).update(overrides)
+            self._rules = rules
+        return self._rules
+
+    @property
+    def state_file(self):
+        return self._state_file if self._state_file is not None else getattr(settings, 'FRAUD_STATE_FILE', None)
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._loaded = True
+                    if self.state_file:
+                        self._load(self.state_file)
+
+    # --- Scoring ----------------------------------------------------------
+
+    def score_click(self, ip_address, session_key, referral_id, now=None):
+        """Record a click attempt and score it; returns a ClickVerdict."""
+        self._ensure_loaded()
+        now = time.time() if now is None else now
+        rules = self.rules
+        keys = {'ip': ip_address, 'subnet': subnet_of(ip_address), 'session': session_key, 'referral': referral_id}
+        signals = {}
+        with self._lock:
+            for rule_name, dimension in VELOCITY_DIMENSIONS.items():
+                key = keys[dimension]
+                if key is None:
+                    continue
+                window = self._velocity[dimension].get(key)
+                if window is None:
+                    window = self._velocity[dimension][key] = deque()
+                window.append(now)
+                cutoff = now - rules[rule_name]['window']
+                while window[0] < cutoff:
+                    window.popleft()
+                signals[rule_name] = len(window)
+
+            seen = self._ip_referrals.get(ip_address)
+            if seen is None:
+                seen = self._ip_referrals[ip_address] = OrderedDict()
+            seen[referral_id] = now
+            seen.move_to_end(referral_id)
+            cutoff = now - rules['ip_distinct_referrals']['window']
+            while next(iter(seen.values())) < cutoff:
+                seen.popitem(last=False)
+            signals['ip_distinct_referrals'] = len(seen)
+
+            totals = self._referral_totals.get(referral_id)
+            if totals is None:
+                totals = self._referral_totals[referral_id] = [0, 0, now]
+            totals[0] += 1
+            totals[2] = now
+            ratio_rule = rules['referral_click_conversion_ratio']
+            if totals[0] >= ratio_rule.get('min_clicks', 0):
+                signals['referral_click_conversion_ratio'] = totals[0] / max(totals[1], 1)
+
+            self._observed += 1
+            if self._observed % SWEEP_EVERY == 0:
+                self._sweep(now)
+
+        verdict = self._verdict(signals)
+        self._maybe_snapshot(now)
+        return verdict
+
+    def _verdict(self, signals):
+        rules = self.rules
+        keep = 1.0
+        reasons = []
+        for name, value in signals.items():
+            rule = rules[name]
+            limit = rule['limit']
+            if value <= limit:
+                continue
+            strength = min(1.0, (value - limit) / limit)
+            keep *= 1 - rule['weight'] * strength
+            reasons.append(name)
+        score = 1 - keep
+        if score >= getattr(settings, 'FRAUD_DISCARD_SCORE', 0.8):
+            action = 'discard'
+        elif score >= getattr(settings, 'FRAUD_FLAG_SCORE', 0.5):
+            action = 'flag'
+        else:
+            action = 'allow'
+        return ClickVerdict(score, reasons, action)
+
+    def record_conversion(self, referral_id, now=None):
+        self._ensure_loaded()
+        now = time.time() if now is None else now
+        with self._lock:
+            totals = self._referral_totals.get(referral_id)
+            if totals is None:
+                totals = self._referral_totals[referral_id] = [0, 0, now]
+            totals[1] += 1
+            totals[2] = now
+
+    def _sweep(self, now):
+        # Drop keys with nothing left in their window so memory tracks live traffic
+        for rule_name, dimension in VELOCITY_DIMENSIONS.items():
+            cutoff = now - self.rules[rule_name]['window']
+            windows = self._velocity[dimension]
+            for key in [key for key, window in windows.items() if window[-1] < cutoff]:
+                del windows[key]
+        cutoff = now - self.rules['ip_distinct_referrals']['window']
+        for ip in [ip for ip, seen in self._ip_referrals.items() if next(reversed(seen.values())) < cutoff]:
+            del self._ip_referrals[ip]
+        idle = self.rules['referral_click_conversion_ratio'].get('idle')
+        if idle:
+            cutoff = now - idle
+            for referral_id in [key for key, totals in self._referral_totals.items() if totals[2] < cutoff]:
+                del self._referral_totals[referral_id]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'observed': self._observed,
+                'keys': {dimension: len(windows) for dimension, windows in self._velocity.items()},
+                'ips_tracked': len(self._ip_referrals),
+                'referrals_tracked': len(self._referral_totals),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._reset()
+            self._loaded = True
+
+    # --- Snapshots --------------------------------------------------------
+
+    def _maybe_snapshot(self, now):
+        interval = self._snapshot_interval if self._snapshot_interval is not None else getattr(settings, 'FRAUD_SNAPSHOT_INTERVAL', 60)
+        if not self.state_file or not interval or now - self._last_snapshot < interval or self._snapshot_running:
+            return
+        self._last_snapshot = now
+        self._snapshot_running = True
+        threading.Thread(target=self.snapshot, name='fraud-snapshot', daemon=True).start()
+
+    def worker_file(self):
+        return f'{self.state_file}.{os.getpid()}'
+
+    def snapshot(self, path=None):
+        """Write the feature state to disk atomically (JSON); by default to this worker's file."""
+        own = path is None
+        path = path or self.worker_file()
+        try:
+            # Only copy the windows while holding the lock; building and
+            # encoding the JSON document happens after it is released
+            with self._lock:
+                velocity = {dimension: [(key, tuple(window)) for key, window in windows.items()]
+                            for dimension, windows in self._velocity.items()}
+                ip_referrals = [(ip, tuple(seen.items())) for ip, seen in self._ip_referrals.items()]
+                referral_totals = [(key, tuple(totals)) for key, totals in self._referral_totals.items()]
+            state = {
+                'saved_at': time.time(),
+                'velocity': {dimension: {str(key): window for key, window in windows}
+                             for dimension, windows in velocity.items()},
+                'ip_referrals': dict(ip_referrals),
+                'referral_totals': {str(key): totals for key, totals in referral_totals},
+            }
+            # A unique temporary file per snapshot, so concurrent snapshots
+            # (threads or workers) never write into each other's file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=f'{os.path.basename(path)}.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as fh:
+                    json.dump(state, fh, separators=(',', ':'))
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            if own:
+                self._prune(path)
+        except OSError as e:
+            logger.error(f"Fraud state snapshot failed: {str(e)}")
+        finally:
+            self._snapshot_running = False
+
+    @staticmethod
+    def _state_files(path):
+        """The shared (older) state file and every worker's, if present."""
+        files = [path] if os.path.isfile(path) else []
+        return files + sorted(name for name in glob.glob(f'{glob.escape(str(path))}.*')
+                              if name.rsplit('.', 1)[1].isdigit())
+
+    def _prune(self, own):
+        # Files not written since before this worker merged them belong to stopped workers
+        interval = self._snapshot_interval if self._snapshot_interval is not None else getattr(settings, 'FRAUD_SNAPSHOT_INTERVAL', 60)
+        cutoff = min(self._loaded_at, time.time() - 10 * max(interval, 1))
+        for name in self._state_files(self.state_file):
+            try:
+                if name != own and os.path.getmtime(name) < cutoff:
+                    os.unlink(name)
+            except FileNotFoundError:
+                pass
+
+    def _load(self, path):
+        velocity = {dimension: {} for dimension in self._velocity}
+        ip_referrals = {}
+        referral_totals = {}
+        for name in self._state_files(path):
+            try:
+                with open(name) as fh:
+                    state = json.load(fh)
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError) as e:
+                logger.error(f"Fraud state snapshot {name} unreadable, skipped: {str(e)}")
+                continue
+            for dimension, windows in state.get('velocity', {}).items():
+                if dimension not in velocity:
+                    continue
+                # Referral ids come back from JSON as strings
+                convert = int if dimension == 'referral' else str
+                for key, window in windows.items():
+                    velocity[dimension].setdefault(convert(key), set()).update(window)
+            for ip, seen in state.get('ip_referrals', {}).items():
+                merged = ip_referrals.setdefault(ip, {})
+                for rid, ts in seen:
+                    merged[int(rid)] = max(ts, merged.get(int(rid), ts))
+            # Snapshots from before last-seen was kept count as seen at saved_at
+            saved_at = state.get('saved_at', time.time())
+            for key, totals in state.get('referral_totals', {}).items():
+                totals = (totals + [saved_at])[:3]
+                merged = referral_totals.get(int(key))
+                referral_totals[int(key)] = totals if merged is None else [max(a, b) for a, b in zip(merged, totals)]
+        self._velocity = {dimension: {key: deque(sorted(window)) for key, window in windows.items()}
+                          for dimension, windows in velocity.items()}
+        self._ip_referrals = {ip: OrderedDict(sorted(seen.items(), key=lambda item: item[1]))
+                              for ip, seen in ip_referrals.items()}
+        self._referral_totals = referral_totals
+        self._loaded_at = time.time()
+        self._sweep(time.time())
+        logger.info(f"Fraud state loaded: ips={len(self._ip_referrals)}, referrals={len(self._referral_totals)}")
+
+
+click_fraud_engine = ClickFraudEngine()
@@ -0,0 +1,161 @@
+"""
+Per-visitor offer funnel state.
+
+Whether a user (or an anonymous visitor, by session key) has submitted
+contact info, completed the Google Form or sent a conversion proof for an
+offer, and the status of their latest proof, are kept in one FunnelState row
+per (user or visitor, offer): a bitset of completed steps plus the proof
+status, under a primary key built from the pair. offer_detail reads it with
+state(), one primary-key lookup instead of querying the three source tables;
+a pair without a row is EMPTY, so browsing visitors cost that one query and
+add no rows.
+
+The signals in signals.py (and the admin actions that update proofs in bulk)
+call refresh() after every write to a source table. It recomputes the row
+from the source tables, so status changes are reflected too; deleting a
+source row recomputes it once the deletion commits (forget()). Rows for data
+from before the table are written by backfill() (python manage.py
+backfill_funnel_states), not on read.
+
+States can also be cached in FUNNEL_STATE_CACHE, an alias every worker
+shares (Redis, Memcached): refresh() overwrites just that pair's entry, so
+nothing else is dropped. Without it (the default) there is no cache in front
+of the lookup, since a database cache would cost a query as well.
+"""
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import ContactInfo, ConversionProof, FunnelState, GoogleFormSubmission
+
+CONTACT_INFO = FunnelState.CONTACT_INFO
+GOOGLE_FORM = FunnelState.GOOGLE_FORM
+CONVERSION_PROOF = FunnelState.CONVERSION_PROOF
+
+CACHE_PREFIX = 'funnel-state:'
+
+
+class State(namedtuple('State', 'steps proof_status')):
+    @property
+    def contact_info_submitted(self):
+        return bool(self.steps & CONTACT_INFO)
+
+    @property
+    def google_form_completed(self):
+        return bool(self.steps & GOOGLE_FORM)
+
+    @property
+    def proof_submitted(self):
+        return bool(self.steps & CONVERSION_PROOF)
+
+
+EMPTY = State(0, '')
+
+
+def state_key(offer_id, user_id=None, visitor_identifier=None):
+    return f'u{user_id}:{offer_id}' if user_id else f'v{visitor_identifier}:{offer_id}'
+
+
+def _compute(offer_id, user_id, visitor_identifier):
+    owner = {'user_id': user_id} if user_id else {'visitor_identifier': visitor_identifier}
+    steps = 0
+    if ContactInfo.objects.filter(offer_id=offer_id, **owner).exists():
+        steps |= CONTACT_INFO
+    if GoogleFormSubmission.objects.filter(offer_id=offer_id, **owner).exists():
+        steps |= GOOGLE_FORM
+    # Proofs are only taken from signed-in users
+    proof_status = ''
+    if user_id:
+        proof_status = ConversionProof.objects.filter(offer_id=offer_id, user_id=user_id).order_by(
+            '-submitted_at', '-id').values_list('status', flat=True).first() or ''
+        if proof_status:
+            steps |= CONVERSION_PROOF
+    return State(steps, proof_status)
+
+
+def _cache():
+    alias = getattr(settings, 'FUNNEL_STATE_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def state(offer_id, user_id=None, visitor_identifier=None):
+    """The funnel State of a user (or, without one, a visitor) for an offer; EMPTY without a row."""
+    if not user_id and not visitor_identifier:
+        return EMPTY
+    key = state_key(offer_id, user_id, visitor_identifier)
+    cache = _cache()
+    if cache is not None:
+        cached = cache.get(f'{CACHE_PREFIX}{key}')
+        if cached is not None:
+            return State(*cached)
+    row = FunnelState.objects.filter(key=key).values_list('steps', 'proof_status').first()
+    current = State(*row) if row is not None else EMPTY
+    if cache is not None:
+        # add(), so a refresh() that stored a newer state meanwhile keeps it
+        cache.add(f'{CACHE_PREFIX}{key}', tuple(current), timeout=getattr(settings, 'FUNNEL_STATE_CACHE_TIMEOUT', 3600))
+    return current
+
+
+def refresh(offer_id, user_id=None, visitor_identifier=None):
+    """Recompute and store the funnel state after a source row for the pair was written or deleted."""
+    if not user_id and not visitor_identifier:
+        return EMPTY
+    key = state_key(offer_id, user_id, visitor_identifier)
+    computed = _compute(offer_id, user_id, visitor_identifier)
+    if computed == EMPTY:
+        FunnelState.objects.filter(key=key).delete()
+    else:
+        FunnelState.objects.update_or_create(key=key, defaults={
+            'offer_id': offer_id,
+            'user_id': user_id or None,
+            'visitor_identifier': '' if user_id else visitor_identifier,
+            'steps': computed.steps,
+            'proof_status': computed.proof_status,
+        })
+    # Only this pair's cached state is replaced, and only once the row is committed
+    cache = _cache()
+    if cache is not None:
+        transaction.on_commit(lambda: cache.set(f'{CACHE_PREFIX}{key}', tuple(computed),
+                                                timeout=getattr(settings, 'FUNNEL_STATE_CACHE_TIMEOUT', 3600)))
+    return computed
+
+
+def forget(offer_id, user_id=None, visitor_identifier=None):
+    """refresh() once the deletion of a source row commits.
+
+    The offer or user may be going too (cascades), in which case nothing is
+    left to record and the row is deleted rather than written.
+    """
+    if not user_id and not visitor_identifier:
+        return
+    transaction.on_commit(lambda: refresh(offer_id, user_id, visitor_identifier))
+
+
+def refresh_for(instance):
+    """refresh() for the pair a ContactInfo, GoogleFormSubmission or ConversionProof belongs to."""
+    return refresh(instance.offer_id, instance.user_id, getattr(instance, 'visitor_identifier', None))
+
+
+def backfill(batch_size=1000):
+    """Store the state of every pair with source rows but no FunnelState row (data from before the table); returns the count."""
+    pairs = set()
+    for model in (ContactInfo, GoogleFormSubmission):
+        pairs.update(model.objects.values_list('offer_id', 'user_id', 'visitor_identifier').distinct().iterator())
+    pairs.update((offer_id, user_id, None) for offer_id, user_id
+                 in ConversionProof.objects.values_list('offer_id', 'user_id').distinct().iterator())
+    by_key = {}
+    for offer_id, user_id, visitor_identifier in pairs:
+        if user_id or visitor_identifier:
+            by_key.setdefault(state_key(offer_id, user_id, visitor_identifier), (offer_id, user_id, visitor_identifier))
+    keys = sorted(by_key)
+    created = 0
+    for start in range(0, len(keys), batch_size):
+        chunk = keys[start:start + batch_size]
+        existing = set(FunnelState.objects.filter(key__in=chunk).values_list('key', flat=True))
+        for key in chunk:
+            if key not in existing:
+                refresh(*by_key[key])
+                created += 1
+    return created
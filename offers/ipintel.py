@@ -0,0 +1,247 @@
+"""
+IP intelligence: client IP resolution behind trusted proxies, and country/ASN
+lookup from a local IP-range database.
+
+The range database is compiled once (build_ip_database) from a CSV/TSV file
+into sorted NumPy arrays saved as .npy files in GEOIP_DATABASE, which are
+memory-mapped on load and searched with np.searchsorted. IPv6 ranges are
+keyed by their upper 64 bits, which is finer than any real country or ASN
+allocation. A lookup takes a few microseconds and no queries. NumPy is only
+imported once the database is built or loaded, so client_ip() alone (forms,
+views) does not pay for it.
+
+Accepted sources, one range per row:
+
+* iptoasn.com ip2asn files (tab separated, no header):
+  range_start, range_end, AS number, country code, AS description
+* CSV with a header naming either start/end or network (CIDR) columns, plus
+  country and/or asn columns
+
+Ranges may overlap (a more specific allocation inside a larger block); the
+build splits them into disjoint segments where the range starting last wins,
+since the lookup only looks at the nearest start at or below the key.
+"""
+import csv
+import ipaddress
+import json
+import logging
+import os
+import socket
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Key dtype per IP version
+FAMILIES = {4: 'uint32', 6: 'uint64'}
+COLUMNS = ('start', 'end', 'asn', 'country')
+NO_MATCH = ('', None)
+
+
+def _key(address):
+    """Integer key of an ip_address object in its family's table."""
+    return int(address) if address.version == 4 else int(address) >> 64
+
+
+def _parse(ip):
+    """(version, table key) for an IP string, or None; inet_pton is several times faster than ipaddress."""
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except (OSError, TypeError):
+        pass
+    try:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip)[:8], 'big')
+    except (OSError, TypeError):
+        return None
+
+
+# --- Client IP ------------------------------------------------------------
+
+@lru_cache(maxsize=8)
+def _trusted_networks(proxies):
+    return tuple(ipaddress.ip_network(proxy, strict=False) for proxy in proxies)
+
+
+def _is_trusted(address, networks):
+    return any(address.version == network.version and address in network for network in networks)
+
+
+def client_ip(meta):
+    """The client address for a request's META.
+
+    X-Forwarded-For is only believed when the connection comes from one of
+    TRUSTED_PROXIES, and then only up to the first hop (from the right) that
+    is not itself a trusted proxy; entries further left are client-supplied.
+    """
+    remote = meta.get('REMOTE_ADDR')
+    networks = _trusted_networks(tuple(getattr(settings, 'TRUSTED_PROXIES', ())))
+    try:
+        address = ipaddress.ip_address(remote)
+    except ValueError:
+        return remote
+    if not networks or not _is_trusted(address, networks):
+        return remote
+    for hop in reversed(meta.get('HTTP_X_FORWARDED_FOR', '').split(',')):
+        hop = hop.strip()
+        if not hop:
+            continue
+        try:
+            address = ipaddress.ip_address(hop)
+        except ValueError:
+            # Garbage in the chain: stop at the last address we could trust
+            break
+        if not _is_trusted(address, networks):
+            return hop
+        remote = hop
+    return remote
+
+
+# --- Range database -------------------------------------------------------
+
+def _parse_rows(path):
+    """Yield (first address, last address, asn, country) from a source file."""
+    with open(path, newline='', encoding='utf-8') as fh:
+        sample = fh.readline()
+        fh.seek(0)
+        if '\t' in sample:
+            for row in csv.reader(fh, delimiter='\t'):
+                if len(row) >= 4:
+                    yield row[0], row[1], row[2], row[3]
+            return
+        for row in csv.DictReader(fh):
+            if row.get('network'):
+                network = ipaddress.ip_network(row['network'].strip(), strict=False)
+                start, end = str(network.network_address), str(network.broadcast_address)
+            else:
+                start, end = row['start'], row['end']
+            yield start, end, row.get('asn', ''), row.get('country', '')
+
+
+def _disjoint(table):
+    """Split sorted (start, end, asn, country) rows into non-overlapping ones; inner ranges win."""
+    segments = []
+    open_ranges = []
+    cursor = 0
+
+    def close(until):
+        nonlocal cursor
+        while open_ranges and open_ranges[-1][1] < until:
+            start, end, asn, country = open_ranges.pop()
+            if cursor <= end:
+                segments.append((cursor, end, asn, country))
+                cursor = end + 1
+
+    # Wider ranges first among equal starts, so the narrower one is on top
+    for row in sorted(table, key=lambda row: (row[0], -row[1])):
+        close(row[0])
+        if open_ranges and cursor < row[0]:
+            segments.append((cursor, row[0] - 1, *open_ranges[-1][2:]))
+        open_ranges.append(row)
+        cursor = row[0]
+    close(float('inf'))
+    return segments
+
+
+def build_database(source, output_dir):
+    """Compile a source file into the .npy arrays load_database() maps; returns rows per family."""
+    import numpy as np
+
+    rows = {version: [] for version in FAMILIES}
+    countries = ['']
+    country_index = {'': 0}
+    for start, end, asn, country in _parse_rows(source):
+        try:
+            first, last = ipaddress.ip_address(start.strip()), ipaddress.ip_address(end.strip())
+        except ValueError:
+            continue
+        asn = asn.strip().upper().removeprefix('AS')
+        country = country.strip().upper()
+        if country in ('NONE', 'ZZ', '-'):
+            country = ''
+        if country not in country_index:
+            country_index[country] = len(countries)
+            countries.append(country)
+        rows[first.version].append((_key(first), _key(last), int(asn) if asn.isdigit() else 0, country_index[country]))
+
+    os.makedirs(output_dir, exist_ok=True)
+    counts = {}
+    for version, dtype in FAMILIES.items():
+        table = _disjoint(rows[version])
+        counts[version] = len(table)
+        arrays = {
+            'start': np.array([row[0] for row in table], dtype=dtype),
+            'end': np.array([row[1] for row in table], dtype=dtype),
+            'asn': np.array([row[2] for row in table], dtype=np.uint32),
+            'country': np.array([row[3] for row in table], dtype=np.uint16),
+        }
+        for column, array in arrays.items():
+            np.save(os.path.join(output_dir, f'ipv{version}_{column}.npy'), array)
+    with open(os.path.join(output_dir, 'countries.json'), 'w') as fh:
+        json.dump(countries, fh)
+    logger.info(f"IP database built from {source}: ipv4={counts[4]}, ipv6={counts[6]}, countries={len(countries) - 1}")
+    return counts
+
+
+class IPDatabase:
+    """Memory-mapped range tables, loaded on first lookup."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._tables = None
+        self._countries = None
+        self._key_types = None
+
+    def _load(self):
+        import numpy as np
+
+        path = self.path or getattr(settings, 'GEOIP_DATABASE', None)
+        tables = {}
+        countries = ['']
+        try:
+            with open(os.path.join(path, 'countries.json')) as fh:
+                countries = json.load(fh)
+            for version in FAMILIES:
+                # Plain ndarray views of the mapped files: np.memmap indexing goes through Python
+                tables[version] = tuple(np.asarray(np.load(os.path.join(path, f'ipv{version}_{column}.npy'), mmap_mode='r'))
+                                        for column in COLUMNS)
+        except (OSError, TypeError, ValueError) as e:
+            # Without a database every lookup is a miss; clicks still get recorded
+            logger.warning(f"IP database not loaded from {path}: {e}")
+            tables = {}
+        self._key_types = {version: np.dtype(dtype).type for version, dtype in FAMILIES.items()}
+        self._countries, self._tables = countries, tables
+
+    def reload(self):
+        with self._lock:
+            self._load()
+
+    def lookup(self, ip):
+        """(country code, ASN) for an IP string; ('', None) when unknown."""
+        if self._tables is None:
+            with self._lock:
+                if self._tables is None:
+                    self._load()
+        parsed = _parse(ip)
+        if parsed is None:
+            return NO_MATCH
+        version, key = parsed
+        table = self._tables.get(version)
+        if table is None:
+            return NO_MATCH
+        starts, ends, asns, countries = table
+        # A key of the table's own dtype; a Python int would make NumPy cast the whole array
+        key = self._key_types[version](key)
+        i = int(starts.searchsorted(key, side='right')) - 1
+        if i < 0 or key > ends.item(i):
+            return NO_MATCH
+        return self._countries[countries.item(i)], asns.item(i) or None
+
+
+ip_database = IPDatabase()
+
+
+def lookup(ip):
+    return ip_database.lookup(ip)
@@ -0,0 +1,201 @@
+"""
+Double-entry cashback ledger, per-user balance snapshots and payout batching.
+
+Every posting is a LedgerTransaction whose LedgerEntry amounts sum to zero.
+The 'user' account holds what is owed to each user; UserBalance mirrors its
+per-user sum and is adjusted in the same database transaction as the
+posting, so reads never sum the history. rebuild_balances() recomputes all
+snapshots from the entries in one grouped query.
+"""
+import csv
+import logging
+import os
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, DecimalField, F, Sum, When
+from django.utils import timezone
+
+from .models import LedgerEntry, LedgerTransaction, Offer, Payout, PayoutBatch, UserBalance
+
+logger = logging.getLogger(__name__)
+
+ZERO = Decimal('0.00')
+BATCH_SIZE = 1000
+
+
+def cashback_key(user_id, offer_id):
+    # A user earns an offer's cashback once, whether the postback or a proof confirms it first
+    return f'cashback:{user_id}:{offer_id}'
+
+
+def _apply_balance_delta(user_id, amount, earned=ZERO):
+    updated = UserBalance.objects.filter(user_id=user_id).update(
+        balance=F('balance') + amount,
+        lifetime_earned=F('lifetime_earned') + earned,
+        updated_at=timezone.now(),
+    )
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            UserBalance.objects.create(user_id=user_id, balance=amount, lifetime_earned=earned)
+    except IntegrityError:
+        # Created concurrently; apply the delta to that row instead
+        UserBalance.objects.filter(user_id=user_id).update(
+            balance=F('balance') + amount,
+            lifetime_earned=F('lifetime_earned') + earned,
+            updated_at=timezone.now(),
+        )
+
+
+def post_cashback(user_id, offer, referral_id=None, source=''):
+    """Credit offer.cashback_amount to the user once. Returns the transaction, or None if
+    it was already posted (or there is nothing to credit)."""
+    amount = offer.cashback_amount or ZERO
+    if not user_id or amount <= 0:
+        return None
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                txn = LedgerTransaction.objects.create(
+                    idempotency_key=cashback_key(user_id, offer.id),
+                    kind='cashback',
+                    user_id=user_id,
+                    offer=offer,
+                    referral_id=referral_id,
+                    description=source,
+                )
+        except IntegrityError:
+            return None
+        LedgerEntry.objects.bulk_create([
+            LedgerEntry(transaction=txn, account='user', user_id=user_id, amount=amount),
+            LedgerEntry(transaction=txn, account='cashback_expense', amount=-amount),
+        ])
+        _apply_balance_delta(user_id, amount, earned=amount)
+    logger.info(f"Cashback posted: user_id={user_id}, offer_id={offer.id}, amount={amount}, source={source}")
+    return txn
+
+
+def post_referral_conversion(referral):
+    if referral.working_state != 'converted' or not referral.user_id:
+        return None
+    return post_cashback(referral.user_id, referral.offer, referral_id=referral.id, source='postback')
+
+
+def post_approved_proofs(proofs):
+    """Post cashback for approved ConversionProofs (a queryset or list); returns how many were new."""
+    posted = 0
+    offers = {}
+    for user_id, offer_id in {(proof.user_id, proof.offer_id) for proof in proofs if proof.status == 'approved'}:
+        if offer_id not in offers:
+            offers[offer_id] = Offer.objects.get(id=offer_id)
+        if post_cashback(user_id, offers[offer_id], source='conversion_proof'):
+            posted += 1
+    return posted
+
+
+def get_balance(user):
+    balance = UserBalance.objects.filter(user=user).values_list('balance', flat=True).first()
+    return balance if balance is not None else ZERO
+
+
+def rebuild_balances():
+    """Recompute every UserBalance from the ledger in one set-based statement; returns rows written.
+
+    The snapshot table is emptied and refilled with INSERT ... SELECT ... GROUP BY
+    inside one transaction, so the work stays in the database.
+    """
+    balance_table = UserBalance._meta.db_table
+    entry_table = LedgerEntry._meta.db_table
+    txn_table = LedgerTransaction._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {balance_table}")
+        cursor.execute(
+            f"INSERT INTO {balance_table} (user_id, balance, lifetime_earned, updated_at) "
+            f"SELECT e.user_id, SUM(e.amount), SUM(CASE WHEN t.kind = %s THEN e.amount ELSE 0 END), %s "
+            f"FROM {entry_table} e INNER JOIN {txn_table} t ON t.id = e.transaction_id "
+            f"WHERE e.account = %s AND e.user_id IS NOT NULL GROUP BY e.user_id",
+            ['cashback', timezone.now(), 'user'],
+        )
+        return cursor.rowcount
+
+
+def check_balances():
+    """User ids whose snapshot disagrees with the ledger, and whether the ledger itself balances."""
+    ledger = dict(LedgerEntry.objects.filter(account='user').values('user_id').annotate(total=Sum('amount'))
+                  .order_by().values_list('user_id', 'total'))
+    mismatched = [user_id for user_id, balance in UserBalance.objects.values_list('user_id', 'balance').iterator(chunk_size=10000)
+                  if ledger.pop(user_id, ZERO) != balance]
+    mismatched.extend(user_id for user_id, total in ledger.items() if total)
+    unbalanced = (LedgerEntry.objects.values('transaction_id').annotate(total=Sum('amount'))
+                  .exclude(total=0).order_by().count())
+    return mismatched, unbalanced
+
+
+def _write_payout_file(path, batch_id, rows):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', newline='') as fh:
+            writer = csv.writer(fh)
+            writer.writerow(['batch_id', 'user_id', 'username', 'email', 'amount'])
+            for user_id, username, email, amount in rows:
+                writer.writerow([batch_id, user_id, username, email, amount])
+    except OSError as e:
+        logger.error(f"Payout file not written: batch_id={batch_id}, file={path}, error={e}")
+
+
+def create_payout_batch(minimum=None, output_dir=None):
+    """Pay out every balance at or above `minimum` in one batch and write the payout CSV.
+
+    Eligible balances are read and debited in one database transaction, batch
+    by batch with set-based statements: one transaction row, two entries and
+    one Payout per user, then a single CASE update of the balance snapshots.
+    The CSV is written after the transaction commits, so a rolled-back batch
+    leaves no file behind. Returns the PayoutBatch, or None when nobody is eligible.
+    """
+    minimum = Decimal(minimum if minimum is not None else getattr(settings, 'PAYOUT_MINIMUM', '10.00'))
+    output_dir = output_dir or getattr(settings, 'PAYOUT_DIR', 'payouts')
+
+    with transaction.atomic():
+        eligible = list(UserBalance.objects.select_for_update()
+                        .filter(balance__gte=minimum, balance__gt=0)
+                        .order_by('user_id')
+                        .values_list('user_id', 'user__username', 'user__email', 'balance'))
+        if not eligible:
+            return None
+        batch = PayoutBatch.objects.create()
+        for start in range(0, len(eligible), BATCH_SIZE):
+            chunk = eligible[start:start + BATCH_SIZE]
+            LedgerTransaction.objects.bulk_create([
+                LedgerTransaction(idempotency_key=f'payout:{batch.id}:{user_id}', kind='payout', user_id=user_id,
+                                  description=f'Payout batch {batch.id}')
+                for user_id, _, _, _ in chunk
+            ])
+            txn_ids = dict(LedgerTransaction.objects.filter(
+                idempotency_key__in=[f'payout:{batch.id}:{user_id}' for user_id, _, _, _ in chunk]
+            ).values_list('user_id', 'id'))
+            entries = []
+            for user_id, _, _, amount in chunk:
+                entries.append(LedgerEntry(transaction_id=txn_ids[user_id], account='user', user_id=user_id, amount=-amount))
+                entries.append(LedgerEntry(transaction_id=txn_ids[user_id], account='payout_clearing', amount=amount))
+            LedgerEntry.objects.bulk_create(entries)
+            Payout.objects.bulk_create([Payout(batch=batch, user_id=user_id, amount=amount) for user_id, _, _, amount in chunk])
+            UserBalance.objects.filter(user_id__in=[user_id for user_id, _, _, _ in chunk]).update(
+                balance=Case(
+                    *[When(user_id=user_id, then=F('balance') - amount) for user_id, _, _, amount in chunk],
+                    output_field=DecimalField(max_digits=12, decimal_places=2),
+                ),
+                updated_at=timezone.now(),
+            )
+
+        path = os.path.join(str(output_dir), f'payout-batch-{batch.id}.csv')
+        batch.payout_count = len(eligible)
+        batch.total_amount = sum((amount for _, _, _, amount in eligible), ZERO)
+        batch.file_path = path
+        batch.save(update_fields=['payout_count', 'total_amount', 'file_path'])
+        # The file goes out only once the debits are durable, and the row locks are not held while it is written
+        transaction.on_commit(lambda: _write_payout_file(path, batch.id, eligible))
+    logger.info(f"Payout batch created: batch_id={batch.id}, payouts={batch.payout_count}, total={batch.total_amount}, file={path}")
+    return batch
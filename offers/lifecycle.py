@@ -0,0 +1,169 @@
+"""
+Offer lifecycle: scheduled start/end, click and conversion caps, auto-pause.
+
+Cap counters live in the cache (OFFER_CAPS_CACHE; use a shared backend when
+several workers serve traffic) under one key per offer, metric and day, so
+checking an offer in grab_offer is one get_many and counting a click is one
+incr. Missing counters are seeded from the database. Offers that hit a cap
+are paused on the spot; apply_schedule() flips scheduled offers in bulk and
+resumes paused ones once their window or daily counter allows it.
+
+Any state change goes through set_state(), which updates the rows with one
+statement (bumping updated_at, the cached offer fragments' version) and
+bumps the 'offers' cache namespace, so every worker's search index and
+ranking are rebuilt. Concurrent misses on a counter seed it once
+(offers.caching.get_or_set), not once per request.
+"""
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Q
+from django.utils import timezone
+
+from . import caching
+from .models import Offer, Referral, ReferralClick
+from .search import catalog
+
+logger = logging.getLogger(__name__)
+
+CAP_REASONS = ('click_cap', 'daily_click_cap', 'conversion_cap', 'daily_conversion_cap')
+# Counters outlive the day they count by a little, so late readers still find them
+DAY_TIMEOUT = 60 * 60 * 26
+
+
+def _cache():
+    return caches[getattr(settings, 'OFFER_CAPS_CACHE', 'default')]
+
+
+def _key(offer_id, metric, day=None):
+    return f'offer-cap:{offer_id}:{metric}:{day:%Y%m%d}' if day else f'offer-cap:{offer_id}:{metric}'
+
+
+def _seed(offer_id, metric, day):
+    if metric == 'clicks':
+        # Counted clicks, as record_click() counts them; Referral.click_count
+        # also goes up with every postback, so it is not used here
+        clicks = ReferralClick.objects.filter(referral__offer_id=offer_id, flagged=False)
+        return (clicks.filter(clicked_at__date=day) if day else clicks).count()
+    converted = Referral.objects.filter(offer_id=offer_id, working_state='converted')
+    return (converted.filter(updated_at__date=day) if day else converted).count()
+
+
+def _caps(offer):
+    """[(reason, cache key, metric, day, limit)] for the caps set on the offer."""
+    today = timezone.localdate()
+    caps = []
+    for reason, metric, day, limit in (
+        ('click_cap', 'clicks', None, offer.click_cap),
+        ('daily_click_cap', 'clicks', today, offer.daily_click_cap),
+        ('conversion_cap', 'conversions', None, offer.conversion_cap),
+        ('daily_conversion_cap', 'conversions', today, offer.daily_conversion_cap),
+    ):
+        if limit is not None:
+            caps.append((reason, _key(offer.id, metric, day), metric, day, limit))
+    return caps
+
+
+def _count(cache, key, offer_id, metric, day):
+    return caching.get_or_set(cache, key, lambda: _seed(offer_id, metric, day), timeout=DAY_TIMEOUT if day else None)[0]
+
+
+def _increment(cache, key, offer_id, metric, day):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Not counted yet (or evicted): the database already includes this event
+        value, hit = caching.get_or_set(cache, key, lambda: _seed(offer_id, metric, day), timeout=DAY_TIMEOUT if day else None)
+        return cache.incr(key) if hit else value
+
+
+def out_of_window(offer, now=None):
+    """'scheduled' or 'ended' when now is outside the offer's schedule, else None."""
+    now = now or timezone.now()
+    if offer.starts_at and now < offer.starts_at:
+        return 'scheduled'
+    if offer.ends_at and now >= offer.ends_at:
+        return 'ended'
+    return None
+
+
+def reached_cap(offer, exact=False):
+    """The first cap the offer has reached, or None.
+
+    The hot path reads the counters as they are (an unseeded counter counts as
+    zero until the next click seeds it); exact=True seeds missing ones first.
+    """
+    caps = _caps(offer)
+    if not caps:
+        return None
+    cache = _cache()
+    if exact:
+        values = {key: _count(cache, key, offer.id, metric, day) for _, key, metric, day, _ in caps}
+    else:
+        values = cache.get_many([key for _, key, _, _, _ in caps])
+    for reason, key, _, _, limit in caps:
+        if values.get(key, 0) >= limit:
+            return reason
+    return None
+
+
+def accepting_traffic(offer, now=None):
+    """O(1) check for grab_offer: active, inside the schedule and under every cap."""
+    return offer.is_active == 'active' and out_of_window(offer, now) is None and reached_cap(offer) is None
+
+
+def invalidate_catalog():
+    catalog.invalidate()
+
+
+def set_state(offers, is_active, reason=''):
+    """Switch a queryset of offers to is_active with one UPDATE; returns the number changed."""
+    changed = offers.exclude(is_active=is_active, paused_reason=reason).update(
+        is_active=is_active, paused_reason=reason, updated_at=timezone.now(),
+    )
+    if changed:
+        invalidate_catalog()
+    return changed
+
+
+def _record(offer, metric, reasons):
+    caps = [cap for cap in _caps(offer) if cap[0] in reasons]
+    if not caps:
+        return
+    cache = _cache()
+    for reason, key, _, day, limit in caps:
+        if _increment(cache, key, offer.id, metric, day) >= limit:
+            if set_state(Offer.objects.filter(id=offer.id, is_active='active'), 'inactive', reason):
+                offer.is_active, offer.paused_reason = 'inactive', reason
+                logger.warning(f"Offer auto-paused: offer_id={offer.id}, reason={reason}, limit={limit}")
+
+
+# Call these after the click or conversion is saved, so seeding from the
+# database counts it exactly once
+def record_click(offer):
+    _record(offer, 'clicks', ('click_cap', 'daily_click_cap'))
+
+
+def record_conversion(offer):
+    _record(offer, 'conversions', ('conversion_cap', 'daily_conversion_cap'))
+
+
+def apply_schedule(now=None):
+    """Start, end and resume offers in bulk; returns {action: offers changed}."""
+    now = now or timezone.now()
+    window = Q(starts_at__isnull=True) | Q(starts_at__lte=now)
+    window &= Q(ends_at__isnull=True) | Q(ends_at__gt=now)
+    changes = {
+        'ended': set_state(Offer.objects.filter(is_active='active', ends_at__lte=now), 'inactive', 'ended'),
+        'scheduled': set_state(Offer.objects.filter(is_active='active', starts_at__gt=now), 'inactive', 'scheduled'),
+        'started': set_state(Offer.objects.filter(window, is_active='inactive', paused_reason__in=('scheduled', 'ended')), 'active'),
+    }
+    # Capped offers resume once the counter that paused them allows it again:
+    # a new day for daily caps, a raised or cleared cap for the others
+    resumable = [offer.id for offer in Offer.objects.filter(window, is_active='inactive', paused_reason__in=CAP_REASONS)
+                 if reached_cap(offer, exact=True) is None]
+    changes['resumed'] = set_state(Offer.objects.filter(id__in=resumable), 'active') if resumable else 0
+    if any(changes.values()):
+        logger.info(f"Offer schedule applied: {changes}")
+    return changes
@@ -0,0 +1,201 @@
+import atexit
+import glob
+import gzip
+import json
+import logging
+import os
+import queue
+import random
+import shutil
+import time
+from datetime import datetime, timezone
+from logging.handlers import BaseRotatingHandler, QueueHandler, QueueListener
+
+from django.conf import settings
+
+# Attributes every LogRecord has; anything else was passed through `extra=`
+_RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: timestamp, level, logger, message plus any `extra=` fields."""
+
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class RotatingJsonFileHandler(BaseRotatingHandler):
+    """File handler that rotates on size or age, whichever comes first.
+
+    Rotated files are named <file>.<YYYYmmdd-HHMMSS>[.N], optionally gzipped,
+    and only the newest `backup_count` are kept.
+
+    Every worker process writes to the same file. Rotation runs under an flock
+    on <file>.lock and only renames the file if it is still the one the
+    rotating process has open, so a file is rotated once however many workers
+    reach the limit together. Before each write the handler compares the inode
+    at the path with its open stream (as WatchedFileHandler does) and reopens
+    when another process rotated, so no worker keeps appending to a renamed
+    or deleted file.
+    """
+
+    def __init__(self, filename, max_bytes=0, interval=86400, backup_count=14, compress=False, encoding='utf-8'):
+        super().__init__(filename, 'a', encoding=encoding, delay=True)
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backup_count = backup_count
+        self.compress = compress
+        self.lock_path = f'{self.baseFilename}.lock'
+        self.rollover_at = time.time() + interval if interval else None
+        self._file_id = None
+
+    def _open_stream(self):
+        self.stream = self._open()
+        stat = os.fstat(self.stream.fileno())
+        self._file_id = (stat.st_dev, stat.st_ino)
+
+    def _close_stream(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self._file_id = None
+
+    def _file_at_path(self):
+        try:
+            stat = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    def _due(self, length):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return bool(self.max_bytes) and os.fstat(self.stream.fileno()).st_size + length >= self.max_bytes
+
+    def emit(self, record):
+        try:
+            # Formatted once, for both the size check and the write
+            line = self.format(record) + self.terminator
+            if self.stream is not None and self._file_at_path() != self._file_id:
+                # Rotated by another process: continue in the new file
+                self._close_stream()
+                if self.interval:
+                    self.rollover_at = time.time() + self.interval
+            if self.stream is None:
+                self._open_stream()
+            if self._due(len(line.encode(self.encoding or 'utf-8'))):
+                self.doRollover()
+                self._open_stream()
+            self.stream.write(line)
+            self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def doRollover(self):
+        import fcntl
+
+        file_id = self._file_id
+        self._close_stream()
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # Unless another process rotated it while this one waited for the lock
+                current = self._file_at_path()
+                if current is not None and file_id in (None, current) and os.path.getsize(self.baseFilename):
+                    self._rotate()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+    def _rotate(self):
+        stamp = f"{self.baseFilename}.{time.strftime('%Y%m%d-%H%M%S')}"
+        target = stamp
+        n = 1
+        while os.path.exists(target) or os.path.exists(target + '.gz'):
+            target = f"{stamp}.{n}"
+            n += 1
+        os.rename(self.baseFilename, target)
+        if self.compress:
+            with open(target, 'rb') as src, gzip.open(target + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(target)
+        self._prune()
+
+    def _prune(self):
+        if not self.backup_count:
+            return
+        rotated = sorted((path for path in glob.glob(glob.escape(self.baseFilename) + '.*') if path != self.lock_path),
+                         key=os.path.getmtime)
+        for path in rotated[:-self.backup_count]:
+            os.remove(path)
+
+
+class QueuedRotatingFileHandler(QueueHandler):
+    """Hands records to a background thread that writes them as rotated JSON lines.
+
+    The request thread only filters the record and puts it on an in-memory
+    queue. JSON encoding, file I/O, rotation and compression all run in the
+    QueueListener thread.
+    """
+
+    def __init__(self, filename, max_bytes=50 * 1024 * 1024, interval=86400, backup_count=14, compress=True):
+        super().__init__(queue.SimpleQueue())
+        file_handler = RotatingJsonFileHandler(
+            filename, max_bytes=max_bytes, interval=interval, backup_count=backup_count, compress=compress,
+        )
+        file_handler.setFormatter(JsonFormatter())
+        self.listener = QueueListener(self.queue, file_handler, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def prepare(self, record):
+        # Keep the record's `extra=` fields; only merge args into the message so
+        # the record is safe to hand to another thread. Formatting to JSON is
+        # left to the listener.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        super().close()
+
+
+class ClickSamplingFilter(logging.Filter):
+    """Keep only a fraction of high-volume records, chosen by their `event` extra.
+
+    Rates come from settings.LOG_SAMPLE_RATES ({event: fraction kept}). Records
+    at WARNING or above, and events without a rate, are always kept. Records
+    that are kept carry `sample_rate` so counts can be scaled back up.
+    """
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if event is None or record.levelno >= logging.WARNING:
+            return True
+        rate = getattr(settings, 'LOG_SAMPLE_RATES', {}).get(event)
+        if rate is None or rate >= 1:
+            return True
+        if random.random() >= rate:
+            return False
+        record.sample_rate = rate
+        return True
@@ -0,0 +1,50 @@
+# offers/management/commands/backfill_click_geo.py
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+from offers.ipintel import lookup
+from offers.models import ReferralClick
+
+class Command(BaseCommand):
+    help = 'Fill country/ASN on stored clicks from the local IP database and print clicks per country and ASN'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Redo clicks that already have a country')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--top', type=int, default=10, help='Countries and ASNs to list in the report')
+
+    def handle(self, *args, **options):
+        clicks = ReferralClick.objects.order_by('id')
+        if not options['all']:
+            clicks = clicks.filter(country='', asn__isnull=True)
+        table = ReferralClick._meta.db_table
+        start = time.perf_counter()
+        last_id = 0
+        updated = 0
+        while True:
+            # Keyset pagination: each chunk is an indexed range scan on the primary key
+            chunk = list(clicks.filter(id__gt=last_id).values_list('id', 'ip_address')[:options['chunk_size']])
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+            rows = []
+            for click_id, ip_address in chunk:
+                country, asn = lookup(ip_address)
+                if country or asn or options['all']:
+                    rows.append((country, asn, click_id))
+            # A prepared primary-key UPDATE per row; bulk_update's CASE expressions
+            # get slow on chunks of this size
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.executemany(f"UPDATE {table} SET country = %s, asn = %s WHERE id = %s", rows)
+            updated += len(rows)
+        self.stdout.write(f"Updated {updated} clicks in {time.perf_counter() - start:.1f}s")
+
+        # The report groups on the stored columns; no IP is looked up again
+        for column in ('country', 'asn'):
+            self.stdout.write(self.style.MIGRATE_HEADING(f"Clicks by {column}"))
+            rows = (ReferralClick.objects.values(column).annotate(clicks=Count('id'))
+                    .order_by('-clicks')[:options['top']])
+            for row in rows:
+                self.stdout.write(f"  {row[column] or 'unknown':>10}  {row['clicks']}")
@@ -0,0 +1,13 @@
+# offers/management/commands/backfill_funnel_states.py
+from django.core.management.base import BaseCommand
+from offers.funnel import backfill
+
+class Command(BaseCommand):
+    help = 'Write the funnel state of contact info, Google Form and proof records from before the FunnelState table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Keys checked per query')
+
+    def handle(self, *args, **options):
+        created = backfill(batch_size=options['batch_size'])
+        self.stdout.write(f"Stored {created} funnel states")
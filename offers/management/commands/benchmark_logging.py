@@ -0,0 +1,47 @@
+# offers/management/commands/benchmark_logging.py
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from offers.log import ClickSamplingFilter, QueuedRotatingFileHandler
+
+class Command(BaseCommand):
+    help = 'Compare the per-call cost of the plain FileHandler click log with the queued JSON handler'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=20000)
+
+    def _run(self, handler, calls, event=None):
+        logger = logging.Logger('benchmark_logging')
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        timings = []
+        for i in range(calls):
+            start = time.perf_counter()
+            if event:
+                logger.info("Unique click recorded", extra={'event': event, 'referral_id': i, 'offer_id': 7, 'clicks': 3, 'ip': '203.0.113.9'})
+            else:
+                logger.info(f"Unique click recorded: referral_id={i}, clicks=3, client_ip=203.0.113.9")
+            timings.append((time.perf_counter() - start) * 1e6)
+        handler.close()
+        timings.sort()
+        return statistics.fmean(timings), timings[len(timings) // 2], timings[int(len(timings) * 0.99)], timings[-1]
+
+    def handle(self, *args, **options):
+        calls = options['calls']
+        with tempfile.TemporaryDirectory() as tmp:
+            results = [
+                ('FileHandler, f-string', self._run(logging.FileHandler(os.path.join(tmp, 'plain.log')), calls)),
+                ('Queued JSON handler', self._run(QueuedRotatingFileHandler(os.path.join(tmp, 'queued.log')), calls, 'click')),
+            ]
+            sampled = QueuedRotatingFileHandler(os.path.join(tmp, 'sampled.log'))
+            sampled.addFilter(ClickSamplingFilter())
+            # click_duplicate is sampled by LOG_SAMPLE_RATES
+            results.append(('Queued JSON handler, sampled', self._run(sampled, calls, 'click_duplicate')))
+
+        self.stdout.write(f"{'handler (µs per call)':32} {'mean':>8} {'p50':>8} {'p99':>8} {'max':>10}")
+        for name, (mean, p50, p99, worst) in results:
+            self.stdout.write(f"{name:32} {mean:8.2f} {p50:8.2f} {p99:8.2f} {worst:10.2f}")
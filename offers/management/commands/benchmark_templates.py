@@ -0,0 +1,119 @@
+# offers/management/commands/benchmark_templates.py
+import statistics
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.cache.utils import make_template_fragment_key
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import QuerySet
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+from offers.forms import ContactInfoForm, UpdateMobileForm
+from offers.middleware import minify_html
+from offers.models import AdBanner, Offer, TutorialVideo
+from offers.search import search_offers
+
+# {% cache %} fragments in the rendered templates, with the values they vary on
+FRAGMENTS = {
+    'offer_media': lambda offer: [offer.id, offer.updated_at.timestamp()],
+    'offer_terms': lambda offer: [offer.id, offer.updated_at.timestamp()],
+}
+
+
+def fragment_cache():
+    # The cache the {% cache %} tag writes to
+    try:
+        return caches['template_fragments']
+    except InvalidCacheBackendError:
+        return caches['default']
+
+
+def clear_fragments(offer):
+    """Delete the offer's cached fragments, leaving everything else in the cache alone."""
+    fragment_cache().delete_many([make_template_fragment_key(name, vary_on(offer)) for name, vary_on in FRAGMENTS.items()])
+
+
+class Command(BaseCommand):
+    help = 'Measure render time per template, cold and with fragment caching, and the effect of HTML minification'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--offer', type=int, help='Offer id to render (defaults to the first offer)')
+
+    def _request(self, user):
+        request = RequestFactory().get('/')
+        request.user = user
+        request.session = SessionStore()
+        request._messages = FallbackStorage(request)
+        return request
+
+    def _contexts(self, offer, user):
+        offer_ids, facets = search_offers()
+        offers = list(Offer.objects.filter(id__in=offer_ids[:24]))
+        contexts = {
+            'index.html': {'offers': offers, 'facets': facets, 'query': '', 'filters': {}, 'querystring': ''},
+            'offer_info.html': {'offer': offer, 'referral': None},
+            'offer_detail.html': {
+                'offer': offer,
+                'tutorial_videos': TutorialVideo.objects.filter(offer=offer),
+                'ad_banners': AdBanner.objects.filter(offer=offer),
+                'contact_form': ContactInfoForm(),
+                'fragment_cache_timeout': settings.OFFER_FRAGMENT_CACHE_TIMEOUT,
+            },
+            'refer_message.html': {'message': 'Referral submitted successfully!'},
+        }
+        if user.is_authenticated:
+            contexts['dashboard.html'] = {
+                'profile_info': {'username': user.username, 'email': user.email, 'joined': user.date_joined},
+                'user': user,
+                'mobile_form': UpdateMobileForm(user=user),
+                'referrals': [],
+                'referral_urls': {},
+                'contact_infos': [],
+            }
+        return contexts
+
+    def _render(self, template, context, request):
+        # Fresh querysets each time, so lazily evaluated sections pay their queries
+        context = {key: value.all() if isinstance(value, QuerySet) else value for key, value in context.items()}
+        start = time.perf_counter()
+        html = render_to_string(template, context, request)
+        return (time.perf_counter() - start) * 1000, html
+
+    def _stats(self, timings):
+        timings = sorted(timings)
+        return {
+            'mean': statistics.fmean(timings),
+            'p50': timings[len(timings) // 2],
+            'p95': timings[max(int(len(timings) * 0.95) - 1, 0)],
+        }
+
+    def handle(self, *args, **options):
+        offer = Offer.objects.filter(id=options['offer']).first() if options['offer'] else Offer.objects.first()
+        if offer is None:
+            raise CommandError("No offer to render; create or import one first.")
+        user = User.objects.filter(userprofile__isnull=False).first() or AnonymousUser()
+        request = self._request(user)
+        iterations = options['iterations']
+
+        self.stdout.write(f"{'template':<22}{'mode':<10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'bytes':>10}{'minified':>10}")
+        for template, context in self._contexts(offer, user).items():
+            # "cold" drops the offer's fragments before every render; "warm" reuses them
+            cold = []
+            for _ in range(iterations):
+                clear_fragments(offer)
+                cold.append(self._render(template, context, request)[0])
+            warm = []
+            for _ in range(iterations):
+                elapsed, html = self._render(template, context, request)
+                warm.append(elapsed)
+            size = len(html.encode())
+            minified = len(minify_html(html).encode())
+            for mode, stats in (('cold', self._stats(cold)), ('warm', self._stats(warm))):
+                self.stdout.write(
+                    f"{template:<22}{mode:<10}{stats['mean']:>10.3f}{stats['p50']:>10.3f}{stats['p95']:>10.3f}{size:>10}{minified:>10}"
+                )
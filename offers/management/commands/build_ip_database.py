@@ -0,0 +1,23 @@
+# offers/management/commands/build_ip_database.py
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from offers import ipintel
+
+class Command(BaseCommand):
+    help = 'Compile an IP range file (iptoasn TSV or CSV with start/end or network columns) for offers.ipintel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Path to the IP range file')
+        parser.add_argument('--output', help='Directory to write to (default: GEOIP_DATABASE)')
+
+    def handle(self, *args, **options):
+        output = options['output'] or getattr(settings, 'GEOIP_DATABASE', None)
+        if not output:
+            raise CommandError('No --output given and GEOIP_DATABASE is not set')
+        try:
+            counts = ipintel.build_database(options['source'], output)
+        except (OSError, KeyError, ValueError) as e:
+            raise CommandError(f"Could not build the IP database: {e}")
+        self.stdout.write(self.style.SUCCESS(
+            f"IP database written to {output}: {counts[4]} IPv4 and {counts[6]} IPv6 ranges"
+        ))
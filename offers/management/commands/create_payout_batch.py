@@ -0,0 +1,19 @@
+# offers/management/commands/create_payout_batch.py
+from django.core.management.base import BaseCommand
+from offers.ledger import create_payout_batch
+
+class Command(BaseCommand):
+    help = 'Pay out all cashback balances at or above the minimum into one batch and write its CSV file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minimum', help='Minimum balance to pay out (default: settings.PAYOUT_MINIMUM)')
+        parser.add_argument('--output-dir', help='Directory for the payout file (default: settings.PAYOUT_DIR)')
+
+    def handle(self, *args, **options):
+        batch = create_payout_batch(minimum=options['minimum'], output_dir=options['output_dir'])
+        if batch is None:
+            self.stdout.write('No balances eligible for payout')
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Payout batch {batch.id}: {batch.payout_count} payouts, total {batch.total_amount}, file {batch.file_path}"
+        ))
@@ -0,0 +1,46 @@
+# offers/management/commands/generate_benchmark_data.py
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from offers.benchmarks import BENCH_PREFIX, dataset_counts, flush_dataset, generate_dataset
+
+class Command(BaseCommand):
+    help = 'Fill the database with a reproducible synthetic dataset for run_benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--advertisers', type=int, default=20)
+        parser.add_argument('--offers', type=int, default=500)
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--referrals', type=int, default=100000)
+        parser.add_argument('--clicks', type=int, default=200000)
+        parser.add_argument('--contact-infos', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--flush', action='store_true', help=f'Delete existing {BENCH_PREFIX}* data first')
+        parser.add_argument('--flush-only', action='store_true', help='Delete the benchmark data and exit')
+
+    def handle(self, *args, **options):
+        if options['flush'] or options['flush_only']:
+            flush_dataset()
+            self.stdout.write('Removed existing benchmark data')
+            if options['flush_only']:
+                return
+        if dataset_counts()['offers']:
+            raise CommandError('Benchmark data already exists; pass --flush to regenerate it')
+
+        start = time.perf_counter()
+        counts = generate_dataset(
+            advertisers=options['advertisers'],
+            offers=options['offers'],
+            users=options['users'],
+            referrals=options['referrals'],
+            clicks=options['clicks'],
+            contact_infos=options['contact_infos'],
+            seed=options['seed'],
+            batch_size=options['batch_size'],
+            progress=lambda message: self.stdout.write(f'  {message}'),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated benchmark data in {time.perf_counter() - start:.1f}s: "
+            + ', '.join(f'{name}={count}' for name, count in counts.items())
+        ))
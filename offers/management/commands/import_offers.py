@@ -0,0 +1,45 @@
+# offers/management/commands/import_offers.py
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from offers.bulk_import import DEFAULT_BATCH_SIZE, DEFAULT_MEDIA_WORKERS, FeedError, import_offers, load_feed
+
+class Command(BaseCommand):
+    help = 'Bulk import offers, advertisers, banners and tutorial videos from a CSV or JSON feed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('feed', help='Path to the CSV or JSON feed')
+        parser.add_argument('--format', choices=['csv', 'json'], default=None, help='Feed format (detected from the file by default)')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--workers', type=int, default=DEFAULT_MEDIA_WORKERS, help='Threads used to copy media files')
+        parser.add_argument('--media-root', default=None, help='Directory the feed\'s media paths are relative to (default: OFFER_FEED_MEDIA_ROOT)')
+        parser.add_argument('--dry-run', action='store_true', help='Show what would change without writing anything')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['feed'], 'rb') as fh:
+                rows = load_feed(fh, fmt=options['format'], name=options['feed'])
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not read feed: {e}")
+
+        try:
+            result = import_offers(
+                rows,
+                batch_size=options['batch_size'],
+                dry_run=options['dry_run'],
+                workers=options['workers'],
+                media_root=options['media_root'],
+            )
+        except FeedError as e:
+            raise CommandError(str(e))
+
+        if options['dry_run']:
+            self.stdout.write(json.dumps(result, indent=2, default=str))
+            self.stdout.write(self.style.SUCCESS(
+                f"Dry run: {len(result['created'])} to create, {len(result['updated'])} to update, {result['unchanged']} unchanged"
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"Imported {result['offers']} offers, {result['advertisers']} advertisers, "
+                f"{result['banners']} banners, {result['videos']} videos ({result['media']} media files copied)"
+            ))
@@ -0,0 +1,18 @@
+# offers/management/commands/invalidate_cache.py
+from django.core.management.base import BaseCommand
+from offers import caching
+
+class Command(BaseCommand):
+    help = 'Show cache namespace versions, or bump namespaces so every worker drops what it cached'
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('namespaces', nargs='*', help="Namespaces to invalidate, e.g. offers advertisers")
+
+    def handle(self, *args, **options):
+        for name in options['namespaces']:
+            version = caching.namespace(name).invalidate()
+            self.stdout.write(f"{name}: now version {version}")
+        if not options['namespaces']:
+            for name, version in sorted(caching.bus().versions().items()):
+                self.stdout.write(f"{name}: version {version}")
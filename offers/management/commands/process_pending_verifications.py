@@ -4,6 +4,10 @@ from offers.utils import process_pending_verifications
 
 class Command(BaseCommand):
     help = 'Process pending mobile number verifications when free tier is available'
+    # Run from cron: system checks (URLconf, every view, PIL) belong to deploys, not every run.
+    # The cost is that a broken setting or model is not reported here; `manage.py check`
+    # at deploy time is what catches it, so keep it in the deploy.
+    requires_system_checks = []
 
     def handle(self, *args, **options):
         self.stdout.write("Processing pending verifications...")
@@ -0,0 +1,17 @@
+# offers/management/commands/purge_used_tokens.py
+from django.core.management.base import BaseCommand
+from offers.replay import purge_expired
+
+class Command(BaseCommand):
+    help = 'Delete expired postback signatures and CAPTCHA nonces in batches'
+    # Run from cron: system checks (URLconf, every view, PIL) belong to deploys, not every run.
+    # The cost is that a broken setting or model is not reported here; `manage.py check`
+    # at deploy time is what catches it, so keep it in the deploy.
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows deleted per statement')
+
+    def handle(self, *args, **options):
+        deleted = purge_expired(batch_size=options['batch_size'])
+        self.stdout.write(f"Deleted {deleted} expired used tokens")
@@ -0,0 +1,25 @@
+# offers/management/commands/rank_offers.py
+import time
+
+from django.core.management.base import BaseCommand
+from offers.ranking import FEATURES, offer_ranking, variants
+
+class Command(BaseCommand):
+    help = 'Recompute offer ranking scores and show the top offers per variant'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--variant', help='Only show this variant')
+        parser.add_argument('--limit', type=int, default=10)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        offer_ranking.refresh()
+        self.stdout.write(f"Scores computed in {(time.perf_counter() - start) * 1000:.0f} ms")
+        for variant, config in variants().items():
+            if options['variant'] and variant != options['variant']:
+                continue
+            weights = ', '.join(f"{feature}={config[feature]}" for feature in FEATURES if config.get(feature))
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{variant} (share {config.get('share', 0)}; {weights or 'catalogue order'})"))
+            for row in offer_ranking.explain(variant, options['limit']):
+                features = ' '.join(f"{feature}={row[feature]:.3f}" for feature in FEATURES)
+                self.stdout.write(f"  offer {row['offer_id']:>8}  score={row['score']:.4f}  {features}")
@@ -0,0 +1,26 @@
+# offers/management/commands/rebuild_balances.py
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from offers.ledger import check_balances, rebuild_balances
+
+class Command(BaseCommand):
+    help = 'Recompute every user cashback balance from the ledger, or check the snapshots against it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Only report mismatches; do not write')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        if options['check']:
+            mismatched, unbalanced = check_balances()
+            elapsed = time.perf_counter() - start
+            if unbalanced:
+                self.stdout.write(self.style.ERROR(f"{unbalanced} ledger transactions do not sum to zero"))
+            if mismatched:
+                raise CommandError(f"{len(mismatched)} balance snapshots disagree with the ledger, e.g. user ids {mismatched[:10]}")
+            self.stdout.write(self.style.SUCCESS(f"Balance snapshots match the ledger ({elapsed:.2f}s)"))
+            return
+
+        written = rebuild_balances()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} balances in {time.perf_counter() - start:.2f}s"))
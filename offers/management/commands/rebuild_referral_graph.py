@@ -0,0 +1,16 @@
+# offers/management/commands/rebuild_referral_graph.py
+import time
+
+from django.core.management.base import BaseCommand
+from offers import referral_graph
+
+class Command(BaseCommand):
+    help = 'Recompute the referral graph closure table (UserAncestry) from UserProfile.referred_by'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        rows = referral_graph.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f"Referral graph rebuilt: {rows} ancestry rows, max depth {referral_graph.max_depth()}, "
+            f"{time.perf_counter() - start:.1f}s"
+        ))
@@ -0,0 +1,35 @@
+# offers/management/commands/reconcile_conversions.py
+import json
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from offers.reconciliation import reconcile
+
+class Command(BaseCommand):
+    help = 'Reconcile clicks, postbacks, approved conversion proofs and leads per advertiser; write a JSON report'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='Report path (default: print to stdout)')
+        parser.add_argument('--since', help='Only referrals created and clicks recorded on or after this date (YYYY-MM-DD)')
+        parser.add_argument('--chunk-size', type=int, default=200000, help='Rows fetched per query')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = date.fromisoformat(options['since'])
+            except ValueError:
+                raise CommandError(f"Invalid --since date: {options['since']}")
+
+        report = reconcile(chunk_size=options['chunk_size'], since=since)
+        output = json.dumps(report, separators=(',', ':'))
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(output + '\n')
+            totals = report['totals']
+            self.stdout.write(self.style.SUCCESS(
+                f"Wrote {options['output']}: referrals={totals['referrals']}, clicks={totals['click_rows']}, "
+                f"converted={totals['converted']}, conversions without click={totals['conversion_without_click']}"
+            ))
+        else:
+            self.stdout.write(output)
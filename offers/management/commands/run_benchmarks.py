@@ -0,0 +1,56 @@
+# offers/management/commands/run_benchmarks.py
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from offers import benchmarks
+
+class Command(BaseCommand):
+    help = 'Run click-funnel microbenchmarks, end-to-end scenarios, a multi-process load test and the phone pre-validation count; report JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', choices=['micro', 'scenarios', 'load', 'phones'], action='append',
+                            help='Run only these parts (repeatable); default is all of them')
+        parser.add_argument('--iterations', type=int, default=1000, help='Calls per microbenchmark')
+        parser.add_argument('--funnels', type=int, default=100, help='Sequential funnels for the scenario run')
+        parser.add_argument('--workers', type=int, default=4, help='Processes for the load run')
+        parser.add_argument('--funnels-per-worker', type=int, default=50)
+        parser.add_argument('--signups', type=int, default=10000, help='Synthetic signup numbers for the phone pre-validation run')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+        parser.add_argument('--compare', help='Baseline JSON report to compare p95 against')
+        parser.add_argument('--max-regression', type=float,
+                            help='With --compare, fail if any p95 is slower by more than this fraction (e.g. 0.2)')
+
+    def handle(self, *args, **options):
+        parts = options['only'] or ['micro', 'scenarios', 'load', 'phones']
+        report = {'environment': benchmarks.environment()}
+        try:
+            if 'micro' in parts:
+                report['micro'] = benchmarks.run_microbenchmarks(options['iterations'])
+            if 'scenarios' in parts:
+                report['scenarios'] = benchmarks.run_scenarios(options['funnels'], seed=options['seed'])
+            if 'load' in parts:
+                report['load'] = benchmarks.run_load(options['workers'], options['funnels_per_worker'], seed=options['seed'])
+            if 'phones' in parts:
+                report['phones'] = benchmarks.run_phone_prevalidation(options['signups'], seed=options['seed'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['compare']:
+            with open(options['compare']) as fh:
+                report['p95_change'] = benchmarks.compare(json.load(fh), report)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(output + '\n')
+            self.stdout.write(f"Wrote {options['output']}")
+        else:
+            self.stdout.write(output)
+
+        limit = options['max_regression']
+        if limit is not None and options['compare']:
+            regressions = {name: change for name, change in report['p95_change'].items() if change > limit}
+            if regressions:
+                raise CommandError('p95 regressions over {:.0%}: {}'.format(
+                    limit, ', '.join(f'{name} {change:+.0%}' for name, change in sorted(regressions.items()))))
@@ -0,0 +1,23 @@
+# offers/management/commands/run_offer_scheduler.py
+import time
+
+from django.core.management.base import BaseCommand
+from offers.lifecycle import apply_schedule
+
+class Command(BaseCommand):
+    help = 'Start, end and resume offers by schedule and caps; runs once, or every --interval seconds'
+    # Run from cron: system checks (URLconf, every view, PIL) belong to deploys, not every run.
+    # The cost is that a broken setting or model is not reported here; `manage.py check`
+    # at deploy time is what catches it, so keep it in the deploy.
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, help='Keep running, applying the schedule every N seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            changes = apply_schedule()
+            self.stdout.write(', '.join(f"{action}={count}" for action, count in changes.items()))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
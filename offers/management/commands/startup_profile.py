@@ -0,0 +1,42 @@
+# offers/management/commands/startup_profile.py
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from offers.startup import PHASES, profile_startup
+
+class Command(BaseCommand):
+    help = 'Profile cold start (imports, AppConfig.ready(), URLconf, system checks) in fresh interpreters'
+    # The profile runs in child processes; checking this one would only add to its own start-up
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--phase', choices=PHASES, action='append',
+                            help='Phases to run after django.setup() (repeatable); default is all of them')
+        parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters to take the median over')
+        parser.add_argument('--top', type=int, default=15, help='Rows in the import tables')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        phases = ['setup', *(options['phase'] or PHASES)]
+        try:
+            report = profile_startup(tuple(dict.fromkeys(phases)), runs=options['runs'], top=options['top'])
+        except RuntimeError as e:
+            raise CommandError(f"Startup probe failed: {e}")
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        imports = report['imports']
+        self.stdout.write(f"Cold start: {report['total_ms']} ms (median of {report['runs']} runs, Python {report['python']}), "
+                          f"{report['modules_loaded']} modules, {imports['total_ms']} ms importing")
+        for phase, ms in report['phases_ms'].items():
+            self.stdout.write(f"  {phase:<8} {ms:>8.1f} ms")
+        self.stdout.write("AppConfig.ready():")
+        for label, ms in sorted(report['ready_ms'].items(), key=lambda item: -item[1]):
+            self.stdout.write(f"  {label:<24} {ms:>8.1f} ms")
+        self.stdout.write("Import time by package (self):")
+        for package, ms in imports['packages_ms'].items():
+            self.stdout.write(f"  {package:<24} {ms:>8.1f} ms")
+        self.stdout.write("Heaviest imports made by project modules (cumulative):")
+        for row in imports['project_imports_ms']:
+            self.stdout.write(f"  {row['module']:<40} {row['ms']:>8.1f} ms  from {row['imported_by']}")
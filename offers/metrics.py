@@ -0,0 +1,196 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.core.cache.backends.locmem import LocMemCache
+
+# Upper bounds (seconds / counts) of the histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def percentile(self, q):
+        """Approximate the q-th percentile as the upper bound of its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class MetricsRegistry:
+    """Process-wide histograms and counters, rendered in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+
+    def observe(self, name, labels, value, buckets=DURATION_BUCKETS, help_text=''):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+                self._help.setdefault(name, help_text)
+            histogram.observe(value)
+
+    def inc(self, name, labels, amount=1, help_text=''):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._help.setdefault(name, help_text)
+
+    def histograms(self, name):
+        with self._lock:
+            return {labels: h for (n, labels), h in self._histograms.items() if n == name}
+
+    def counters(self, name):
+        with self._lock:
+            return {labels: v for (n, labels), v in self._counters.items() if n == name}
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self):
+        lines = []
+        with self._lock:
+            names = sorted({name for name, _ in self._histograms} | {name for name, _ in self._counters})
+            for name in names:
+                kind = 'histogram' if any(n == name for n, _ in self._histograms) else 'counter'
+                lines.append(f"# HELP {name} {self._help.get(name, '')}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == 'counter':
+                    for (n, labels), value in sorted(self._counters.items()):
+                        if n == name:
+                            lines.append(f"{name}{_format_labels(labels)} {value}")
+                    continue
+                for (n, labels), histogram in sorted(self._histograms.items()):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+registry = MetricsRegistry()
+
+# Per-request tallies; populated by RequestMetricsMiddleware for the current thread
+_local = threading.local()
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.http_time = 0.0
+
+
+def current_stats():
+    return getattr(_local, 'stats', None)
+
+
+def start_request():
+    _local.stats = RequestStats()
+    return _local.stats
+
+
+def end_request():
+    _local.stats = None
+
+
+def record_cache(cache_name, hit):
+    registry.inc('cashback_cache_requests_total', {'cache': cache_name, 'result': 'hit' if hit else 'miss'},
+                 help_text='Cache lookups by cache and result')
+    stats = current_stats()
+    if stats is not None:
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+
+@contextmanager
+def track_http(provider):
+    """Time an outbound HTTP call, e.g. `with track_http('numverify'): requests.get(...)`."""
+    start = time.perf_counter()
+    status = 'ok'
+    try:
+        yield
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe('cashback_outbound_http_seconds', {'provider': provider, 'status': status}, elapsed,
+                         help_text='Outbound HTTP call duration by provider')
+        stats = current_stats()
+        if stats is not None:
+            stats.http_time += elapsed
+
+
+def query_wrapper(execute, sql, params, many, context):
+    """connection.execute_wrapper hook counting queries and their time for the current request."""
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats = current_stats()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_time += time.perf_counter() - start
+
+
+_MISSING = object()
+
+
+class InstrumentedLocMemCache(LocMemCache):
+    """LocMemCache that reports hits and misses (including {% cache %} fragments) to the registry.
+
+    Hits and misses are labelled with the cache LOCATION.
+    """
+
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        self.metrics_name = name or 'default'
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _MISSING, version)
+        record_cache(self.metrics_name, value is not _MISSING)
+        return default if value is _MISSING else value
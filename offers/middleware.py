@@ -0,0 +1,118 @@
+import logging
+import re
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Whitespace inside these blocks is significant and is left untouched
+PRESERVED_BLOCK_RE = re.compile(r'(<(pre|textarea)\b.*?</\2\s*>)', re.IGNORECASE | re.DOTALL)
+LEADING_WHITESPACE_RE = re.compile(r'^[ \t]+|[ \t]+$', re.MULTILINE)
+BLANK_LINES_RE = re.compile(r'\n{2,}')
+
+
+def minify_html(html):
+    """Strip indentation, trailing spaces and blank lines from rendered HTML.
+
+    Newlines are kept so inline scripts with // comments still work.
+    """
+    parts = PRESERVED_BLOCK_RE.split(html)
+    out = []
+    # split() with two groups yields [text, block, tag name, text, block, tag name, ...]
+    for i in range(0, len(parts), 3):
+        text = LEADING_WHITESPACE_RE.sub('', parts[i])
+        out.append(BLANK_LINES_RE.sub('\n', text))
+        if i + 1 < len(parts):
+            out.append(parts[i + 1])
+    return ''.join(out)
+
+
+class HTMLMinifyMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'HTML_MINIFY', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if (
+            response.status_code == 200
+            and not response.streaming
+            and response.get('Content-Type', '').startswith('text/html')
+            and not response.has_header('Content-Encoding')
+        ):
+            charset = response.charset or 'utf-8'
+            response.content = minify_html(response.content.decode(charset)).encode(charset)
+            if response.has_header('Content-Length'):
+                response['Content-Length'] = str(len(response.content))
+        return response
+
+
+class ViewBudgetExceeded(AssertionError):
+    pass
+
+
+class RequestMetricsMiddleware:
+    """Record wall time, DB queries, cache hits/misses and outbound HTTP time per view.
+
+    Views that go over their VIEW_BUDGETS entry log a warning. With
+    VIEW_BUDGETS_RAISE on (as the tests run), query budget overruns raise instead, so
+    a regression fails the test that hit it.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = metrics.start_request()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(metrics.query_wrapper):
+                response = self.get_response(request)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.end_request()
+
+        view = request.resolver_match.view_name if request.resolver_match else 'unresolved'
+        labels = {'view': view}
+        metrics.registry.observe('cashback_view_duration_seconds', labels, elapsed,
+                                 help_text='Wall time per view, including middleware')
+        metrics.registry.observe('cashback_view_db_queries', labels, stats.queries,
+                                 buckets=metrics.QUERY_COUNT_BUCKETS, help_text='Database queries per request')
+        metrics.registry.observe('cashback_view_db_seconds', labels, stats.query_time,
+                                 help_text='Database time per request')
+        for result, count in (('hit', stats.cache_hits), ('miss', stats.cache_misses)):
+            if count:
+                metrics.registry.inc('cashback_view_cache_requests_total', {'view': view, 'result': result}, count,
+                                     help_text='Cache lookups per view and result')
+        if stats.http_time:
+            metrics.registry.observe('cashback_view_outbound_http_seconds', labels, stats.http_time,
+                                     help_text='Outbound HTTP time per request')
+        metrics.registry.inc('cashback_view_responses_total', {'view': view, 'status': str(response.status_code)[0] + 'xx'},
+                             help_text='Responses per view and status class')
+
+        logger.info("Request handled", extra={
+            'event': 'request',
+            'view': view,
+            'status': response.status_code,
+            'latency_ms': round(elapsed * 1000, 2),
+            'queries': stats.queries,
+        })
+        self._check_budget(view, elapsed, stats)
+        return response
+
+    def _check_budget(self, view, elapsed, stats):
+        budget = settings.VIEW_BUDGETS.get(view, settings.DEFAULT_VIEW_BUDGET)
+        elapsed_ms = elapsed * 1000
+        if budget.get('ms') is not None and elapsed_ms > budget['ms']:
+            logger.warning(f"View over latency budget: view={view}, ms={elapsed_ms:.1f}, budget_ms={budget['ms']}, queries={stats.queries}")
+        if budget.get('queries') is not None and stats.queries > budget['queries']:
+            message = f"View over query budget: view={view}, queries={stats.queries}, budget_queries={budget['queries']}, db_ms={stats.query_time * 1000:.1f}"
+            if settings.VIEW_BUDGETS_RAISE:
+                raise ViewBudgetExceeded(message)
+            logger.warning(message)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.2 on 2026-10-19 12:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('offers', '0026_emailverification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='offer',
+            name='external_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+    ]
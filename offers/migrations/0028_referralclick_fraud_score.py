@@ -0,0 +1,23 @@
+# Generated by Django 5.2.2 on 2026-10-19 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('offers', '0027_offer_external_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='referralclick',
+            name='flagged',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='referralclick',
+            name='fraud_score',
+            field=models.FloatField(default=0),
+        ),
+    ]
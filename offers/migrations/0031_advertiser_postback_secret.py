@@ -0,0 +1,29 @@
+# Generated by Django 5.2.2 on 2026-10-19 12:53
+
+import secrets
+
+import offers.models
+from django.db import migrations, models
+
+
+def give_each_advertiser_a_secret(apps, schema_editor):
+    # AddField fills existing rows with one evaluated default; every advertiser needs its own key
+    Advertiser = apps.get_model('offers', 'Advertiser')
+    for advertiser in Advertiser.objects.only('id'):
+        Advertiser.objects.filter(id=advertiser.id).update(postback_secret=secrets.token_hex(32))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('offers', '0030_referral_graph'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='advertiser',
+            name='postback_secret',
+            field=models.CharField(default=offers.models.generate_postback_secret, max_length=64),
+        ),
+        migrations.RunPython(give_each_advertiser_a_secret, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.2 on 2026-10-19 12:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('offers', '0031_advertiser_postback_secret'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='offer',
+            name='click_cap',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='offer',
+            name='conversion_cap',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='offer',
+            name='daily_click_cap',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='offer',
+            name='daily_conversion_cap',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='offer',
+            name='ends_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='offer',
+            name='paused_reason',
+            field=models.CharField(blank=True, choices=[('scheduled', 'Not started yet'), ('ended', 'Ended'), ('click_cap', 'Click cap reached'), ('daily_click_cap', 'Daily click cap reached'), ('conversion_cap', 'Conversion cap reached'), ('daily_conversion_cap', 'Daily conversion cap reached')], default='', max_length=30),
+        ),
+        migrations.AddField(
+            model_name='offer',
+            name='starts_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='offer',
+            name='is_active',
+            field=models.CharField(choices=[('active', 'Active'), ('inactive', 'Inactive')], db_index=True, default='active', max_length=20),
+        ),
+    ]
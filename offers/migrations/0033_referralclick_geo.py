@@ -0,0 +1,23 @@
+# Generated by Django 5.2.2 on 2026-10-19 12:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('offers', '0032_offer_lifecycle'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='referralclick',
+            name='asn',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='referralclick',
+            name='country',
+            field=models.CharField(blank=True, default='', max_length=2),
+        ),
+    ]
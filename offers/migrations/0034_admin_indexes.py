@@ -0,0 +1,43 @@
+# Generated by Django 5.2.2 on 2026-10-19 13:14
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('offers', '0033_referralclick_geo'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='apilog',
+            name='timestamp',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='contactinfo',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='ledgertransaction',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='referral',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='referral',
+            index=models.Index(fields=['working_state', 'id'], name='offers_refe_working_bec848_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referralclick',
+            index=models.Index(fields=['country', 'id'], name='offers_refe_country_99c28a_idx'),
+        ),
+    ]
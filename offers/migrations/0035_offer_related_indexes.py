@@ -0,0 +1,27 @@
+# Generated by Django 5.2.2 on 2026-10-19 13:16
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('offers', '0034_admin_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='contactinfo',
+            index=models.Index(fields=['offer', 'id'], name='offers_cont_offer_i_672933_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversionproof',
+            index=models.Index(fields=['offer', 'id'], name='offers_conv_offer_i_1efc14_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='googleformsubmission',
+            index=models.Index(fields=['offer', 'id'], name='offers_goog_offer_i_a7e1e6_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.2 on 2026-10-19 13:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('offers', '0035_offer_related_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailverification',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='emailverification',
+            name='verified_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='emailverification',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
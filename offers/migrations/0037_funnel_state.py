@@ -0,0 +1,28 @@
+# Generated by Django 5.2.2 on 2026-10-19 13:39
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('offers', '0036_email_verification_store'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FunnelState',
+            fields=[
+                ('key', models.CharField(max_length=300, primary_key=True, serialize=False)),
+                ('visitor_identifier', models.CharField(blank=True, default='', max_length=255)),
+                ('steps', models.PositiveSmallIntegerField(default=0)),
+                ('proof_status', models.CharField(blank=True, default='', max_length=20)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('offer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='offers.offer')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.2 on 2026-10-19 14:15
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('offers', '0037_funnel_state'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversionproof',
+            index=models.Index(fields=['image'], name='offers_conv_image_0006fe_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.2 on 2026-10-19 14:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('offers', '0038_conversion_proof_image_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsedToken',
+            fields=[
+                ('key', models.CharField(max_length=200, primary_key=True, serialize=False)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -1,12 +1,22 @@
+import logging
+import secrets
+
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
 
+logger = logging.getLogger(__name__)
+
+
+def generate_postback_secret():
+    return secrets.token_hex(32)
 
 class Advertiser(models.Model):
     name = models.CharField(max_length=255, unique=True)
     base_url = models.URLField()
     query_param_prefix = models.CharField(max_length=50, default='aff_sub')
+    # HMAC key the advertiser signs postbacks with (see offers.postback_auth)
+    postback_secret = models.CharField(max_length=64, default=generate_postback_secret)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -15,6 +25,8 @@ class Advertiser(models.Model):
 
 class Offer(models.Model):
     advertiser = models.ForeignKey(Advertiser, on_delete=models.CASCADE, related_name='offers', null=True, blank=True)
+    # Feed key used by bulk imports to upsert offers
+    external_id = models.CharField(max_length=100, unique=True, null=True, blank=True)
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True, null=True)
     price = models.DecimalField(max_digits=10, decimal_places=2)
@@ -32,7 +44,7 @@ class Offer(models.Model):
     is_active = models.CharField(max_length=20, choices=[
         ('active', 'Active'),
         ('inactive', 'Inactive'),
-    ], default='active')
+    ], default='active', db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     requires_google_form = models.BooleanField(default=False)
@@ -51,6 +63,25 @@ class Offer(models.Model):
         ('signup', 'Signup'),
     ], default='lead')    
     requires_conversion_proof = models.BooleanField(default=False)    
+    # Credited to the user's ledger balance once per user and offer on conversion
+    cashback_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    # Lifecycle (offers.lifecycle): the offer takes traffic between starts_at and
+    # ends_at and until a cap is reached; empty fields mean no limit
+    starts_at = models.DateTimeField(null=True, blank=True)
+    ends_at = models.DateTimeField(null=True, blank=True)
+    click_cap = models.PositiveIntegerField(null=True, blank=True)
+    daily_click_cap = models.PositiveIntegerField(null=True, blank=True)
+    conversion_cap = models.PositiveIntegerField(null=True, blank=True)
+    daily_conversion_cap = models.PositiveIntegerField(null=True, blank=True)
+    # Why the scheduler deactivated the offer; blank when it was switched off by hand
+    paused_reason = models.CharField(max_length=30, blank=True, default='', choices=[
+        ('scheduled', 'Not started yet'),
+        ('ended', 'Ended'),
+        ('click_cap', 'Click cap reached'),
+        ('daily_click_cap', 'Daily click cap reached'),
+        ('conversion_cap', 'Conversion cap reached'),
+        ('daily_conversion_cap', 'Daily conversion cap reached'),
+    ])
 
     def __str__(self):
         return self.name
@@ -66,6 +97,14 @@ class ConversionProof(models.Model):
     ], default='pending')
     submitted_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # An offer's proofs, newest first (offer admin panels)
+            models.Index(fields=['offer', 'id']),
+            # The proof a private media request is for (offers.private_media)
+            models.Index(fields=['image']),
+        ]
+
     def __str__(self):
         return f"ConversionProof for Offer {self.offer.id} by {self.user.username}"
 
@@ -97,23 +136,93 @@ class Referral(models.Model):
         ('converted', 'Converted'),
         ('failed', 'Failed'),
     ], default='pending')
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
     click_count = models.PositiveIntegerField(default=0)
 
+    class Meta:
+        indexes = [
+            # Admin state filter, newest first
+            models.Index(fields=['working_state', 'id']),
+        ]
+
     def __str__(self):
         return f"Referral {self.id} for Offer {self.offer.name}"
 
+class UserProfileManager(models.Manager):
+    def update_for(self, user, **values):
+        """Set profile fields for a user, keeping an already loaded user.userprofile in step.
+
+        A loaded profile is saved dirty-tracked (nothing is written if it
+        already has these values); otherwise it is one UPDATE, with no SELECT.
+        A user without a profile (the signup signal did not run) gets one.
+        """
+        if User.userprofile.is_cached(user):
+            profile = user.userprofile
+            for field, value in values.items():
+                setattr(profile, field, value)
+            profile.save()
+        elif not self.filter(user=user).update(**values):
+            profile, created = self.get_or_create(user=user, defaults=values)
+            if created:
+                logger.warning(f"User profile was missing and has been created: user={user.pk}")
+            else:
+                # Created by another request between the UPDATE and here
+                self.filter(user=user).update(**values)
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     profile_level = models.IntegerField(default=1)
     email_verified = models.BooleanField(default=False)
     email_verification_token = models.CharField(max_length=100, blank=True, null=True)
     mobile_verified = models.BooleanField(default=False)
+    # Who referred this user at signup; the full ancestry is in UserAncestry
+    referred_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='referred_profiles')
+    referred_via = models.ForeignKey('Referral', on_delete=models.SET_NULL, null=True, blank=True, related_name='signups')
+
+    objects = UserProfileManager()
 
     def __str__(self):
         return f"Profile of {self.user.username}"
 
+    # Dirty tracking: the values as loaded (or last saved) are kept, so save()
+    # writes only the columns that changed and skips the UPDATE when none did.
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_values = {name: value for name, value in zip(field_names, values) if value is not models.DEFERRED}
+        return instance
+
+    def _remember(self, fields=None):
+        saved = getattr(self, '_saved_values', {})
+        deferred = self.get_deferred_fields()
+        for field in self._meta.concrete_fields:
+            if field.attname not in deferred and (fields is None or field.name in fields or field.attname in fields):
+                saved[field.attname] = getattr(self, field.attname)
+        self._saved_values = saved
+
+    def changed_fields(self):
+        """Fields changed since the profile was loaded or saved; None if that is not known."""
+        saved = getattr(self, '_saved_values', None)
+        if self._state.adding or saved is None:
+            return None
+        return [field.name for field in self._meta.concrete_fields
+                if field.attname in saved and getattr(self, field.attname) != saved[field.attname]]
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        self._remember(fields)
+
+    def save(self, *args, **kwargs):
+        if not args and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            changed = self.changed_fields()
+            if changed == []:
+                return
+            if changed:
+                kwargs['update_fields'] = changed
+        super().save(*args, **kwargs)
+        self._remember(kwargs.get('update_fields'))
+
 class ContactInfo(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     offer = models.ForeignKey(Offer, on_delete=models.CASCADE, related_name='contact_infos')
@@ -122,7 +231,12 @@ class ContactInfo(models.Model):
     name = models.CharField(max_length=255)
     email = models.EmailField(unique=True)
     mobile = models.CharField(max_length=15, unique=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['offer', 'id']),
+        ]
 
     def __str__(self):
         return f"Contact Info for {self.offer.name} by {self.user.username if self.user else 'Anonymous'}"
@@ -136,6 +250,9 @@ class GoogleFormSubmission(models.Model):
 
     class Meta:
         unique_together = (('user', 'offer'), ('visitor_identifier', 'offer'))
+        indexes = [
+            models.Index(fields=['offer', 'id']),
+        ]
 
     def __str__(self):
         return f"Google Form Submission for {self.offer.name} by {self.user.username if self.user else 'Anonymous'}"
@@ -145,12 +262,18 @@ class ReferralClick(models.Model):
     ip_address = models.GenericIPAddressField()
     session_key = models.CharField(max_length=40, blank=True, null=True)
     clicked_at = models.DateTimeField(auto_now_add=True)
+    fraud_score = models.FloatField(default=0)
+    flagged = models.BooleanField(default=False)  # Suspicious: kept for review, not counted in click_count
+    # Looked up from the local IP database when the click is recorded (offers.ipintel)
+    country = models.CharField(max_length=2, blank=True, default='')
+    asn = models.PositiveIntegerField(null=True, blank=True)
 
     class Meta:
         unique_together = ('referral', 'ip_address')  # Changed to only use referral and ip_address
         indexes = [
             models.Index(fields=['ip_address']),
             models.Index(fields=['clicked_at']),
+            models.Index(fields=['country', 'id']),
         ]
     
 class ApiUsage(models.Model):
@@ -205,16 +328,19 @@ class ApiLog(models.Model):
     api_name = models.CharField(max_length=50)
     message = models.TextField()
     level = models.CharField(max_length=10, choices=LEVEL_CHOICES)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
 
     def __str__(self):
         return f"{self.timestamp} - {self.api_name} - {self.level}: {self.message}"
     
 class EmailVerification(models.Model):
+    """The current verification code per email (offers.verification_codes)."""
     email = models.EmailField(unique=True)
     code = models.CharField(max_length=6)
     created_at = models.DateTimeField(auto_now_add=True)
-    expires_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)  # Wrong codes entered
+    verified_at = models.DateTimeField(null=True, blank=True)
 
     def save(self, *args, **kwargs):
         # Set expiration to 10 minutes from creation
@@ -226,4 +352,150 @@ class EmailVerification(models.Model):
         return timezone.now() > self.expires_at
 
     def __str__(self):
-        return f"{self.email} - {self.code}"
\ No newline at end of file
+        return f"{self.email} - {self.code}"
+
+class LedgerTransaction(models.Model):
+    """One balanced posting; idempotency_key makes retried postings no-ops."""
+    KIND_CHOICES = [
+        ('cashback', 'Cashback'),
+        ('payout', 'Payout'),
+        ('adjustment', 'Adjustment'),
+    ]
+    idempotency_key = models.CharField(max_length=100, unique=True)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    user = models.ForeignKey(User, on_delete=models.PROTECT, null=True, blank=True)
+    offer = models.ForeignKey(Offer, on_delete=models.SET_NULL, null=True, blank=True)
+    referral = models.ForeignKey(Referral, on_delete=models.SET_NULL, null=True, blank=True)
+    description = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Ledger transactions are append-only")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("Ledger transactions are append-only")
+
+    def __str__(self):
+        return f"{self.kind} {self.idempotency_key}"
+
+class LedgerEntry(models.Model):
+    """A signed amount on one account; the entries of a transaction sum to zero.
+
+    Positive amounts on a 'user' account are cashback owed to that user.
+    """
+    ACCOUNT_CHOICES = [
+        ('user', 'User balance'),
+        ('cashback_expense', 'Cashback expense'),
+        ('payout_clearing', 'Payout clearing'),
+    ]
+    transaction = models.ForeignKey(LedgerTransaction, on_delete=models.PROTECT, related_name='entries')
+    account = models.CharField(max_length=20, choices=ACCOUNT_CHOICES)
+    user = models.ForeignKey(User, on_delete=models.PROTECT, null=True, blank=True)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['account', 'user']),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Ledger entries are append-only")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("Ledger entries are append-only")
+
+    def __str__(self):
+        return f"{self.account} {self.user_id or ''} {self.amount}"
+
+class UserBalance(models.Model):
+    """Snapshot of the sum of a user's ledger entries, updated with every posting."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='cashback_balance')
+    balance = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    lifetime_earned = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user.username}: {self.balance}"
+
+class PayoutBatch(models.Model):
+    created_at = models.DateTimeField(auto_now_add=True)
+    payout_count = models.PositiveIntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    file_path = models.CharField(max_length=500, blank=True)
+
+    def __str__(self):
+        return f"Payout batch {self.id} ({self.payout_count} payouts, {self.total_amount})"
+
+class Payout(models.Model):
+    batch = models.ForeignKey(PayoutBatch, on_delete=models.PROTECT, related_name='payouts')
+    user = models.ForeignKey(User, on_delete=models.PROTECT)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    status = models.CharField(max_length=20, choices=[
+        ('pending', 'Pending'),
+        ('paid', 'Paid'),
+        ('failed', 'Failed'),
+    ], default='pending')
+
+    class Meta:
+        unique_together = ('batch', 'user')
+
+    def __str__(self):
+        return f"Payout {self.amount} to {self.user.username} (batch {self.batch_id})"
+
+class UserAncestry(models.Model):
+    """Closure table of the referral graph: one row per (ancestor, descendant) pair.
+
+    depth is 1 for the direct referrer, 2 for the referrer's referrer, and so
+    on up to REFERRAL_GRAPH_MAX_DEPTH. There are no depth-0 self rows.
+    """
+    ancestor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(User, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveSmallIntegerField()
+
+    class Meta:
+        unique_together = ('ancestor', 'descendant')
+        indexes = [
+            models.Index(fields=['ancestor', 'depth']),
+            models.Index(fields=['descendant', 'depth']),
+        ]
+
+    def __str__(self):
+        return f"{self.ancestor_id} -> {self.descendant_id} (depth {self.depth})"
+
+class FunnelState(models.Model):
+    """Offer funnel progress per user or anonymous visitor (offers.funnel), one primary-key lookup.
+
+    Derived from ContactInfo, GoogleFormSubmission and ConversionProof and
+    recomputed whenever one of them is written.
+    """
+    CONTACT_INFO = 1
+    GOOGLE_FORM = 2
+    CONVERSION_PROOF = 4
+
+    key = models.CharField(max_length=300, primary_key=True)  # 'u<user id>:<offer id>' or 'v<visitor>:<offer id>'
+    offer = models.ForeignKey(Offer, on_delete=models.CASCADE, related_name='+')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    visitor_identifier = models.CharField(max_length=255, blank=True, default='')
+    steps = models.PositiveSmallIntegerField(default=0)  # Bitset of the step constants above
+    proof_status = models.CharField(max_length=20, blank=True, default='')  # Of the latest ConversionProof
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.key}: steps={self.steps:03b}, proof={self.proof_status or '-'}"
+
+class UsedToken(models.Model):
+    """A single-use token (postback signature, CAPTCHA nonce) seen before (offers.replay).
+
+    The primary key makes a replay fail the INSERT; rows are deleted once
+    expired by python manage.py purge_used_tokens.
+    """
+    key = models.CharField(max_length=200, primary_key=True)  # '<kind>:<token>'
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key} (until {self.expires_at})"
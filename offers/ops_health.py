@@ -0,0 +1,196 @@
+"""
+Operations health snapshot for the staff ops page (/ops/).
+
+Everything read from the database is collected by collect() into one dict
+and kept in OPS_SNAPSHOT_CACHE. snapshot() returns the cached copy and, once
+it is older than OPS_SNAPSHOT_INTERVAL seconds, starts a refresh in a
+background thread (one per cache, guarded by an add() lock), so a page view
+never runs the queries itself and never waits for them. The queries are
+bounded: ApiUsage has one row per provider, ApiLog and ReferralClick are
+read over indexed timestamp ranges, and the backlogs are single aggregates.
+
+Per-view latency percentiles and the log queue depth are in-process state
+(offers.metrics, offers.log) and are read when the page renders.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from .log import QueuedRotatingFileHandler
+from .metrics import registry
+from .models import ApiLog, ApiUsage, EmailVerification, PendingVerification, ReferralClick
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_KEY = 'ops-health:snapshot'
+REFRESH_LOCK_KEY = 'ops-health:refreshing'
+# Monthly free quota per provider, as utils.validate_mobile_number enforces it
+PROVIDER_LIMITS = {
+    'numverify': 'NUMVERIFY_FREE_LIMIT',
+    'abstract': 'ABSTRACT_FREE_LIMIT',
+}
+PERCENTILES = (0.5, 0.95, 0.99)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _cache():
+    return caches[_setting('OPS_SNAPSHOT_CACHE', 'default')]
+
+
+def _month_start(now):
+    # UTC, like ApiUsage.reset_if_new_month(): a TIME_ZONE month would start hours apart
+    return now.astimezone(dt_timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(start):
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def provider_quotas(now):
+    """Requests used this month, burn rate per day and projected exhaustion per provider."""
+    month_start = _month_start(now)
+    resets_at = _next_month(month_start)
+    usage = {row.api_name: row for row in ApiUsage.objects.filter(api_name__in=PROVIDER_LIMITS)}
+    quotas = []
+    for provider, limit_setting in PROVIDER_LIMITS.items():
+        limit = _setting(limit_setting, 0)
+        row = usage.get(provider)
+        # Counters are reset lazily by the first request of a month
+        used = row.request_count if row and row.last_reset >= month_start else 0
+        since = max(row.last_reset, month_start) if row and used else month_start
+        days = max((now - since).total_seconds() / 86400, 1 / 24)
+        burn_rate = used / days
+        exhausted_at = None
+        if used >= limit:
+            exhausted_at = now
+        elif burn_rate:
+            projected = now + timedelta(days=(limit - used) / burn_rate)
+            exhausted_at = projected if projected < resets_at else None
+        quotas.append({
+            'provider': provider,
+            'used': used,
+            'limit': limit,
+            'percent': round(100 * used / limit, 1) if limit else None,
+            'burn_rate_per_day': round(burn_rate, 1),
+            'exhausted_at': exhausted_at,
+            'resets_at': resets_at,
+        })
+    return quotas
+
+
+def api_errors(now):
+    """ApiLog entries per provider and level over OPS_ERROR_WINDOW, with the error rate and latest errors."""
+    since = now - timedelta(seconds=_setting('OPS_ERROR_WINDOW', 86400))
+    recent = ApiLog.objects.filter(timestamp__gte=since)
+    providers = {}
+    for row in recent.values('api_name').annotate(
+        total=Count('id'),
+        warnings=Count('id', filter=Q(level='WARNING')),
+        errors=Count('id', filter=Q(level='ERROR')),
+    ).order_by('api_name'):
+        row['error_rate'] = round(100 * row['errors'] / row['total'], 1)
+        providers[row['api_name']] = row
+    return {
+        'since': since,
+        'providers': list(providers.values()),
+        'latest': list(recent.filter(level='ERROR').order_by('-timestamp').values('timestamp', 'api_name', 'message')[:5]),
+    }
+
+
+def backlogs(now):
+    pending = PendingVerification.objects.filter(is_processed=False).aggregate(count=Count('id'), oldest=Min('created_at'))
+    # Mail is sent inline by EMAIL_BACKEND, so the backlog is codes sent and not yet used
+    codes = EmailVerification.objects.filter(verified_at__isnull=True, expires_at__gt=now).aggregate(
+        count=Count('id'), oldest=Min('expires_at'))
+    return {
+        'pending_verifications': pending['count'],
+        'oldest_pending_verification': pending['oldest'],
+        'outstanding_email_codes': codes['count'],
+        'oldest_email_code_expires_at': codes['oldest'],
+    }
+
+
+def click_ingest(now):
+    latest = ReferralClick.objects.order_by('-clicked_at').values_list('clicked_at', flat=True).first()
+    window = _setting('OPS_CLICK_RATE_WINDOW', 300)
+    return {
+        'latest_click_at': latest,
+        'lag_seconds': round((now - latest).total_seconds(), 1) if latest else None,
+        'clicks_per_minute': round(
+            ReferralClick.objects.filter(clicked_at__gte=now - timedelta(seconds=window)).count() * 60 / window, 1),
+    }
+
+
+def collect():
+    """Everything the ops page reads from the database, computed now."""
+    start = time.perf_counter()
+    now = timezone.now()
+    snapshot = {
+        'computed_at': now,
+        'quotas': provider_quotas(now),
+        'api_errors': api_errors(now),
+        'backlogs': backlogs(now),
+        'clicks': click_ingest(now),
+    }
+    snapshot['duration_ms'] = round((time.perf_counter() - start) * 1e3, 1)
+    registry.observe('cashback_ops_snapshot_seconds', {}, snapshot['duration_ms'] / 1e3,
+                     help_text='Time to collect the ops health snapshot')
+    return snapshot
+
+
+def refresh():
+    snapshot = collect()
+    _cache().set(SNAPSHOT_KEY, snapshot, timeout=None)
+    return snapshot
+
+
+def _refresh_in_background():
+    try:
+        refresh()
+    except Exception as e:
+        logger.error(f"Ops health snapshot failed: {e}")
+    finally:
+        _cache().delete(REFRESH_LOCK_KEY)
+        connection.close()
+
+
+def snapshot():
+    """The latest snapshot (None until the first one is collected); stale ones are refreshed in the background."""
+    cache = _cache()
+    current = cache.get(SNAPSHOT_KEY)
+    interval = _setting('OPS_SNAPSHOT_INTERVAL', 60)
+    if current is None or (timezone.now() - current['computed_at']).total_seconds() > interval:
+        if cache.add(REFRESH_LOCK_KEY, 1, timeout=max(interval, 60)):
+            threading.Thread(target=_refresh_in_background, name='ops-health', daemon=True).start()
+    return current
+
+
+def view_latency():
+    """Per-view p50/p95/p99 (ms, bucket upper bounds) and request counts of this worker."""
+    rows = []
+    for labels, histogram in registry.histograms('cashback_view_duration_seconds').items():
+        if not histogram.count:
+            continue
+        row = {'view': dict(labels).get('view'), 'requests': histogram.count,
+               'mean_ms': round(histogram.sum / histogram.count * 1e3, 1)}
+        for q in PERCENTILES:
+            bound = histogram.percentile(q)
+            row[f'p{int(q * 100)}_ms'] = None if bound == float('inf') else round(bound * 1e3)
+        rows.append(row)
+    return sorted(rows, key=lambda row: -row['requests'])
+
+
+def log_queue_depth():
+    """Records waiting for the background log writer in this worker."""
+    return sum(handler.queue.qsize() for handler in logging.getLogger().handlers
+               if isinstance(handler, QueuedRotatingFileHandler))
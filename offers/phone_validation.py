@@ -0,0 +1,177 @@
+"""
+Offline mobile number pre-validation.
+
+Before a number is sent to NumVerify/Abstract (utils.validate_mobile_number)
+it is normalized to E.164 and checked against phone_metadata.json: the
+country calling code must exist and, for the countries the file describes,
+the national number must have a mobile length and start with a mobile
+prefix. Numbers that fail could never be valid, so they are rejected without
+spending a paid lookup.
+
+The metadata is compiled once per process into a digit trie: calling codes
+first (they are prefix-free, so the first node carrying an entry is the
+code), then each code's mobile prefixes below it, with `[a-b]` digit classes
+expanded and every accepting edge pointing at the same MOBILE marker. A
+check walks at most a few nodes and takes a few microseconds.
+"""
+import json
+import os
+import re
+from functools import lru_cache
+
+from django.conf import settings
+
+METADATA_PATH = os.path.join(os.path.dirname(__file__), 'phone_metadata.json')
+# Bounds of the old '^\+\d{10,15}$' check, kept for codes without length rules
+MIN_DIGITS = 10
+MAX_DIGITS = 15
+# Separators people type inside numbers
+FORMATTING = re.compile(r'[\s\-(). /]')
+ENTRY = 'entry'
+MOBILE = True
+
+
+class InvalidNumber(ValueError):
+    pass
+
+
+def _expand(pattern):
+    """Digit alternatives per position for a prefix pattern like '7[1-57-9]'."""
+    positions = []
+    for literal, klass in re.findall(r'(\d)|\[([\d-]+)\]', pattern):
+        if literal:
+            positions.append(literal)
+        else:
+            digits = ''
+            for start, end in re.findall(r'(\d)(?:-(\d))?', klass):
+                digits += ''.join(str(d) for d in range(int(start), int(end or start) + 1))
+            positions.append(digits)
+    return positions
+
+
+def _insert(node, positions):
+    """Add a prefix below a trie node; a shorter prefix already there covers it."""
+    *path, last = positions
+    nodes = [node]
+    for digits in path:
+        next_nodes = []
+        for current in nodes:
+            for digit in digits:
+                child = current.setdefault(digit, {})
+                if child is not MOBILE:
+                    next_nodes.append(child)
+        nodes = next_nodes
+    for current in nodes:
+        for digit in last:
+            current[digit] = MOBILE
+
+
+def compile_metadata(metadata):
+    """The lookup trie and region -> calling code map for parsed phone_metadata.json."""
+    root = {}
+    regions = {}
+    for code, entry in metadata['codes'].items():
+        node = root
+        for digit in code:
+            node = node.setdefault(digit, {})
+        node[ENTRY] = {
+            'code': code,
+            'region': entry['regions'][0],
+            'national_prefix': entry.get('national_prefix', ''),
+            'lengths': frozenset(entry.get('lengths', ())),
+            'has_mobile_prefixes': bool(entry.get('mobile')),
+        }
+        for pattern in entry.get('mobile', ()):
+            _insert(node, _expand(pattern))
+        for region in entry['regions']:
+            regions[region] = code
+    return root, regions
+
+
+@lru_cache(maxsize=1)
+def _compiled():
+    path = getattr(settings, 'PHONE_METADATA', None) or METADATA_PATH
+    with open(path, encoding='utf-8') as fh:
+        return compile_metadata(json.load(fh))
+
+
+def _digits(number, default_region=None):
+    """International digits (no '+') of a number as typed."""
+    number = FORMATTING.sub('', str(number or ''))
+    if number.startswith('+'):
+        digits = number[1:]
+    elif number.startswith('00'):
+        digits = number[2:]
+    elif default_region:
+        root, regions = _compiled()
+        code = regions.get(default_region)
+        if code is None:
+            raise InvalidNumber(f"Unknown default region {default_region}.")
+        node = root
+        for digit in code:
+            node = node[digit]
+        national_prefix = node[ENTRY]['national_prefix']
+        if national_prefix and number.startswith(national_prefix):
+            number = number[len(national_prefix):]
+        digits = code + number
+    else:
+        digits = number
+    if not digits.isdigit() or not digits.isascii():
+        raise InvalidNumber("Mobile number must start with a '+' followed by the country code and number (e.g., +919876543210).")
+    return digits
+
+
+def parse(number, default_region=None):
+    """(E.164 number, region) for a possible mobile number; raises InvalidNumber otherwise.
+
+    Numbers without '+' or '00' are read as national numbers of
+    default_region (PHONE_DEFAULT_REGION when not given), dropping the
+    national prefix ('0' in most countries).
+    """
+    if default_region is None:
+        default_region = getattr(settings, 'PHONE_DEFAULT_REGION', None)
+    digits = _digits(number, default_region)
+    if len(digits) > MAX_DIGITS:
+        raise InvalidNumber(f"Mobile number can have at most {MAX_DIGITS} digits including the country code.")
+
+    node = _compiled()[0]
+    entry = None
+    for i, digit in enumerate(digits):
+        node = node.get(digit)
+        if node is None:
+            break
+        entry = node.get(ENTRY)
+        if entry is not None:
+            national = digits[i + 1:]
+            break
+    if entry is None:
+        raise InvalidNumber("Unknown country code.")
+
+    if not entry['lengths']:
+        if len(digits) < MIN_DIGITS:
+            raise InvalidNumber(f"Mobile number must have at least {MIN_DIGITS} digits including the country code.")
+        return f'+{digits}', entry['region']
+    if len(national) not in entry['lengths']:
+        raise InvalidNumber(f"Mobile numbers with country code +{entry['code']} have "
+                            f"{' or '.join(str(n) for n in sorted(entry['lengths']))} digits after it.")
+    if entry['has_mobile_prefixes']:
+        for digit in national:
+            node = node.get(digit)
+            if node is MOBILE:
+                break
+            if node is None:
+                raise InvalidNumber(f"+{digits} is not a mobile number.")
+    return f'+{digits}', entry['region']
+
+
+def normalize(number, default_region=None):
+    """The E.164 form of a possible mobile number; raises InvalidNumber otherwise."""
+    return parse(number, default_region)[0]
+
+
+def is_possible(number, default_region=None):
+    try:
+        parse(number, default_region)
+    except InvalidNumber:
+        return False
+    return True
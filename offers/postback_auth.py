@@ -0,0 +1,115 @@
+"""
+HMAC authentication for advertiser postbacks.
+
+An advertiser signs each postback with its Advertiser.postback_secret:
+
+    signature = hex(HMAC-SHA256(secret, "<advertiser>:<referral_id>:<state>:<timestamp>:<nonce>"))
+
+and POSTs advertiser, referral_id, state, timestamp (unix seconds), nonce
+(optional, any string; lets identical postbacks within a second through) and
+signature. Secrets are held in a per-process cache that Advertiser saves and
+deletes clear in every worker (through the 'advertisers' cache namespace,
+with POSTBACK_KEY_CACHE_TTL as a backstop), so verifying a postback costs no
+queries. Timestamps
+outside POSTBACK_REPLAY_WINDOW are refused, and each signature is accepted
+once within that window: a used signature is one INSERT into the UsedToken
+table (offers.replay), which every worker shares.
+"""
+import hashlib
+import hmac
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from . import caching, replay
+from .models import Advertiser
+
+logger = logging.getLogger(__name__)
+
+REPLAY_KIND = 'postback'
+
+
+def signing_message(advertiser_id, referral_id, state, timestamp, nonce=''):
+    return f'{advertiser_id}:{referral_id}:{state}:{timestamp}:{nonce}'.encode()
+
+
+def sign(secret, advertiser_id, referral_id, state, timestamp, nonce=''):
+    message = signing_message(advertiser_id, referral_id, state, timestamp, nonce)
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+class AdvertiserKeyCache:
+    """advertiser id -> postback secret for every advertiser, reloaded after any advertiser save/delete.
+
+    The whole map is read with one query per reload, so a lookup never
+    queries and unknown (or forged) ids add nothing to it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = None
+        self._loaded_at = 0.0
+        self._namespace = caching.namespace('advertisers')
+        self._version = None
+
+    def invalidate(self):
+        """Drop the cached secrets in every worker."""
+        self._namespace.invalidate()
+
+    def _is_stale(self, version):
+        ttl = getattr(settings, 'POSTBACK_KEY_CACHE_TTL', 300)
+        return (self._keys is None or version != self._version
+                or (ttl is not None and time.monotonic() - self._loaded_at > ttl))
+
+    def get(self, advertiser_id):
+        version = self._namespace.version
+        if self._is_stale(version):
+            with self._lock:
+                if self._is_stale(version):
+                    self._keys = {advertiser: secret for advertiser, secret
+                                  in Advertiser.objects.values_list('id', 'postback_secret') if secret}
+                    self._loaded_at = time.monotonic()
+                    self._version = version
+        return self._keys.get(advertiser_id)
+
+
+advertiser_keys = AdvertiserKeyCache()
+
+
+class PostbackAuthError(ValueError):
+    pass
+
+
+def verify_postback(data, now=None):
+    """Check the signed fields of a postback (request.POST); returns the advertiser id.
+
+    Raises PostbackAuthError when a field is missing, the timestamp is outside
+    the replay window, the signature does not match, or it was already used.
+    """
+    try:
+        advertiser_id = int(data.get('advertiser', ''))
+        timestamp = int(data.get('timestamp', ''))
+    except ValueError:
+        raise PostbackAuthError('missing or malformed advertiser/timestamp')
+    signature = data.get('signature', '')
+    if not signature:
+        raise PostbackAuthError('missing signature')
+
+    window = getattr(settings, 'POSTBACK_REPLAY_WINDOW', 300)
+    now = time.time() if now is None else now
+    if abs(now - timestamp) > window:
+        raise PostbackAuthError('timestamp outside replay window')
+
+    secret = advertiser_keys.get(advertiser_id)
+    if secret is None:
+        raise PostbackAuthError('unknown advertiser')
+    expected = sign(secret, advertiser_id, data.get('referral_id', ''), data.get('state', ''), timestamp, data.get('nonce', ''))
+    if not hmac.compare_digest(expected, signature):
+        raise PostbackAuthError('bad signature')
+
+    # Only a correctly signed postback is recorded, so the table cannot be filled by forgeries
+    if not replay.claim(REPLAY_KIND, signature, 2 * window):
+        raise PostbackAuthError('replayed signature')
+    return advertiser_id
@@ -0,0 +1,66 @@
+"""
+Serving of private uploads (MEDIA_PRIVATE_PREFIXES), such as conversion proofs.
+
+cashback_zone.static_serving never answers these paths; they fall through to
+serve(), which finds the record the file belongs to and answers only its
+owner, or staff allowed to view that model. Everyone else gets a 404, so a
+guessed URL does not even confirm the file exists. The bytes go out through
+the front-end server when PRIVATE_MEDIA_SENDFILE is set ('x-accel-redirect'
+to PRIVATE_MEDIA_INTERNAL_URL for nginx, 'x-sendfile' for Apache/lighttpd),
+otherwise as a FileResponse from the worker.
+"""
+import mimetypes
+import os
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+
+from .models import ConversionProof
+
+PRIVATE_MEDIA_CACHE_CONTROL = 'private, no-store'
+# Private prefix -> (model, file field); the owner is the record's user
+OWNERS = {
+    'conversion_proofs/': (ConversionProof, 'image'),
+}
+
+
+def _owner_id(prefix, name):
+    model, field = OWNERS[prefix]
+    return model.objects.filter(**{field: name}).values_list('user_id', flat=True).first()
+
+
+def _may_view(user, prefix, owner_id):
+    if not user.is_authenticated:
+        return False
+    model = OWNERS[prefix][0]
+    return user.id == owner_id or (user.is_staff and user.has_perm(f'{model._meta.app_label}.view_{model._meta.model_name}'))
+
+
+def serve(request, prefix, path):
+    """A private upload, for its owner or staff who may view its records."""
+    if prefix not in OWNERS:
+        raise Http404
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, prefix + path)
+    except (ValueError, SuspiciousFileOperation):
+        raise Http404
+    name = os.path.relpath(full_path, settings.MEDIA_ROOT).replace(os.sep, '/')
+    if not name.startswith(prefix):
+        raise Http404
+    owner_id = _owner_id(prefix, name)
+    if owner_id is None or not _may_view(request.user, prefix, owner_id) or not os.path.isfile(full_path):
+        raise Http404
+
+    sendfile = getattr(settings, 'PRIVATE_MEDIA_SENDFILE', None)
+    if sendfile:
+        response = HttpResponse(content_type=mimetypes.guess_type(full_path)[0] or 'application/octet-stream')
+        if sendfile == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = getattr(settings, 'PRIVATE_MEDIA_INTERNAL_URL', '/protected-media/') + name
+        else:
+            response['X-Sendfile'] = full_path
+    else:
+        response = FileResponse(open(full_path, 'rb'))
+    response['Cache-Control'] = PRIVATE_MEDIA_CACHE_CONTROL
+    return response
@@ -0,0 +1,282 @@
+"""
+Offer ranking: per-offer scores recomputed periodically, served from memory.
+
+Every RANKING_REFRESH_INTERVAL seconds, and after any catalog change (a bump
+of the 'offers' cache namespace, from any worker), a background thread of each
+worker recomputes the scores and publishes a new snapshot; requests only read
+the published one and never wait for the aggregates. The per-offer rollups
+(referrals, Referral.click_count, conversions, approved proofs) are read with
+three grouped queries and turned into features with NumPy: smoothed click-through
+and conversion rates, recency and cashback payout, each scaled to 0..1.
+NumPy is imported by the first refresh, not with the module, so views that
+only assign variants (grab_offer, postbacks) do not load it.
+Each ranking variant is a set of feature weights; the ordered offer ids per
+variant (and per preferred-category set, for personalized lists) are computed
+once per refresh, so serving a ranking is a dictionary lookup. Until a worker
+has published its first snapshot, offers are served in catalogue order.
+RANKING_BACKGROUND_REFRESH = False leaves refreshing to the rank_offers command
+and explicit refresh() calls.
+
+Visitors are split between variants by a stable hash of their user id or
+session, so variants can be compared on the events they are logged with.
+"""
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from . import caching
+from .ipintel import client_ip
+from .metrics import registry
+from .models import ConversionProof, Offer, Referral
+from .search import offer_index, search_offers, search_offers_ordered
+
+logger = logging.getLogger(__name__)
+
+catalog = caching.namespace('offers')
+# Per process, so reading them costs no query; cleared per user by the worker
+# that records a new referral (signals.py), other workers catch up within the timeout
+referred_categories = caching.namespace('user-categories', tier='local', timeout=600)
+
+FEATURES = ('ctr', 'conversion_rate', 'recency', 'payout')
+
+# Weights per feature plus the share of traffic each variant receives.
+# 'control' has no weights, which keeps the catalogue order (by id).
+DEFAULT_VARIANTS = {
+    'control': {'share': 0},
+    'balanced': {'share': 100, 'ctr': 0.3, 'conversion_rate': 0.4, 'recency': 0.1, 'payout': 0.2},
+}
+
+# Pseudo-counts for the rate features, so offers with a handful of referrals
+# are pulled towards the catalogue average instead of ranking first or last
+CTR_PRIOR_WEIGHT = 20
+CONVERSION_PRIOR_WEIGHT = 50
+
+# Boost added to offers in categories the user has referred before
+PERSONAL_BOOST = 0.15
+
+
+def variants():
+    configured = getattr(settings, 'RANKING_VARIANTS', None)
+    return configured if configured else DEFAULT_VARIANTS
+
+
+def assign_variant(request):
+    """Stable variant for the visitor: hashed user id, else session key, else client IP."""
+    configured = variants()
+    if request.user.is_authenticated:
+        identity = f'user:{request.user.id}'
+    elif request.session.session_key:
+        identity = f'session:{request.session.session_key}'
+    else:
+        identity = f'ip:{client_ip(request.META)}'
+    total = sum(variant.get('share', 0) for variant in configured.values())
+    if not total:
+        return next(iter(configured))
+    bucket = int(hashlib.md5(identity.encode()).hexdigest()[:8], 16) % total
+    for name, variant in configured.items():
+        bucket -= variant.get('share', 0)
+        if bucket < 0:
+            return name
+    return next(iter(configured))
+
+
+def user_categories(user):
+    """Categories of the offers the user has already referred."""
+    if not user.is_authenticated:
+        return frozenset()
+    return referred_categories.get_or_set(user.pk, lambda: frozenset(
+        Referral.objects.filter(user=user).values_list('offer__category', flat=True).distinct()))
+
+
+class OfferRanking:
+    """Feature matrix and precomputed orderings for all active offers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._computed_at = None
+        self._version = None
+        self._refreshes = 0
+        self._refreshing = False
+        # (offer ids, categories, {feature: values}, {(variant, categories): order},
+        # (catalog version, refresh number)), replaced as a whole on refresh so
+        # readers never mix two refreshes; None until the first refresh
+        self._snapshot = None
+
+    def invalidate(self):
+        self._computed_at = None
+
+    def _is_stale(self):
+        if self._computed_at is None or self._version != catalog.version:
+            return True
+        interval = getattr(settings, 'RANKING_REFRESH_INTERVAL', 900)
+        return interval is not None and time.monotonic() - self._computed_at > interval
+
+    def _schedule_refresh(self):
+        """Start a background refresh when the scores are stale; never blocks the caller."""
+        if not self._is_stale() or not getattr(settings, 'RANKING_BACKGROUND_REFRESH', True):
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh_in_background, name='offer-ranking', daemon=True).start()
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"Offer ranking refresh failed: {e}")
+            # Retry after the interval rather than on the next request
+            self._computed_at = time.monotonic()
+            self._version = catalog.version
+        finally:
+            self._refreshing = False
+            connection.close()
+
+    def refresh(self):
+        import numpy as np
+
+        start = time.perf_counter()
+        version = catalog.version
+        offers = list(Offer.objects.filter(is_active='active').order_by('id')
+                      .values_list('id', 'category', 'created_at', 'cashback_amount'))
+        referrals = {row['offer_id']: row for row in Referral.objects.values('offer_id').annotate(
+            referrals=Count('id'),
+            clicks=Sum('click_count'),
+            clicked=Count('id', filter=Q(working_state__in=('clicked', 'converted'))),
+            converted=Count('id', filter=Q(working_state='converted')),
+        ).order_by()}
+        proofs = dict(ConversionProof.objects.filter(status='approved').values('offer_id')
+                      .annotate(approved=Count('id')).order_by().values_list('offer_id', 'approved'))
+
+        offer_ids = np.fromiter((offer_id for offer_id, _, _, _ in offers), dtype=np.int64, count=len(offers))
+        categories = np.array([category for _, category, _, _ in offers], dtype=object)
+
+        def column(key):
+            return np.fromiter((referrals.get(offer_id, {}).get(key) or 0 for offer_id in offer_ids),
+                               dtype=np.float64, count=len(offer_ids))
+
+        referral_count = column('referrals')
+        clicks = column('clicks')
+        clicked = column('clicked')
+        conversions = column('converted') + np.fromiter(
+            (proofs.get(offer_id, 0) for offer_id in offer_ids), dtype=np.float64, count=len(offer_ids))
+        now = timezone.now()
+        age_days = np.fromiter(((now - created_at).total_seconds() / 86400 for _, _, created_at, _ in offers),
+                               dtype=np.float64, count=len(offers))
+        payout = np.fromiter((float(amount or 0) for _, _, _, amount in offers), dtype=np.float64, count=len(offers))
+
+        ctr_prior = clicked.sum() / max(referral_count.sum(), 1)
+        conversion_prior = conversions.sum() / max(clicks.sum(), 1)
+        half_life = getattr(settings, 'RANKING_RECENCY_HALF_LIFE_DAYS', 30)
+        features = {
+            'ctr': (clicked + CTR_PRIOR_WEIGHT * ctr_prior) / (referral_count + CTR_PRIOR_WEIGHT),
+            'conversion_rate': (conversions + CONVERSION_PRIOR_WEIGHT * conversion_prior) / (clicks + CONVERSION_PRIOR_WEIGHT),
+            'recency': np.exp2(-np.maximum(age_days, 0) / half_life),
+            'payout': np.log1p(payout),
+        }
+        for feature, values in features.items():
+            top = values.max() if len(values) else 0
+            features[feature] = values / top if top > 0 else np.zeros_like(values)
+
+        self._refreshes += 1
+        self._snapshot = (offer_ids, categories, features, {}, (version, self._refreshes))
+        self._computed_at = time.monotonic()
+        self._version = version
+        elapsed = time.perf_counter() - start
+        registry.observe('cashback_ranking_refresh_seconds', {}, elapsed,
+                         help_text='Time to recompute offer ranking scores')
+        logger.info(f"Offer ranking refreshed: offers={len(offer_ids)}, variants={len(variants())}, took={elapsed * 1000:.0f}ms")
+
+    @staticmethod
+    def _scores(features, variant):
+        import numpy as np
+
+        weights = variants().get(variant, {})
+        total = np.zeros(len(features[FEATURES[0]]))
+        for feature in FEATURES:
+            if weights.get(feature):
+                total += weights[feature] * features[feature]
+        return total
+
+    def ordering(self, variant, categories=frozenset()):
+        """(offer ids best first, {offer_id: sort key}, snapshot stamp) for a variant and a set of
+        preferred categories; the stamp is (catalog version, refresh number) of the scores used.
+
+        Before the first snapshot is published this is ((), {}, None).
+        """
+        self._schedule_refresh()
+        snapshot = self._snapshot
+        if snapshot is None:
+            return (), {}, None
+        offer_ids, offer_categories, features, orders, stamp = snapshot
+        key = (variant, categories)
+        order = orders.get(key)
+        if order is None:
+            import numpy as np
+
+            scores = self._scores(features, variant)
+            if categories:
+                scores = scores + PERSONAL_BOOST * np.isin(offer_categories, list(categories))
+            # Stable sort keeps id order among equal scores (the control variant)
+            ranked = tuple(offer_ids[np.argsort(-scores, kind='stable')].tolist())
+            order = orders[key] = (ranked, {offer_id: (0, i) for i, offer_id in enumerate(ranked)})
+        return order + (stamp,)
+
+    def explain(self, variant, limit=10):
+        """Top offers with their feature values, for the rank_offers command (after refresh())."""
+        import numpy as np
+
+        offer_ids, _, features, _, _ = self._snapshot
+        scores = self._scores(features, variant)
+        rows = []
+        for i in np.argsort(-scores, kind='stable')[:limit]:
+            row = {'offer_id': int(offer_ids[i]), 'score': round(float(scores[i]), 4)}
+            row.update({feature: round(float(features[feature][i]), 4) for feature in FEATURES})
+            rows.append(row)
+        return rows
+
+
+offer_ranking = OfferRanking()
+
+
+def rank_offers(request, offer_ids=None, personalize=True):
+    """Order offer ids (default: every active offer) for this visitor; returns (variant, ids).
+
+    Ids the ranking has not seen yet (offers created since the last refresh)
+    follow the ranked ones in id order.
+    """
+    variant = assign_variant(request)
+    categories = user_categories(request.user) if personalize else frozenset()
+    ranked, positions, stamp = offer_ranking.ordering(variant, categories)
+    if offer_ids is None:
+        return variant, ranked if stamp is not None else search_offers()[0]
+    return variant, sorted(offer_ids, key=lambda offer_id: positions.get(offer_id, (1, offer_id)))
+
+
+def rank_search(request, query='', filters=None, personalize=True):
+    """search_offers() in this visitor's ranking order; returns (variant, ids, facets).
+
+    Without a query or filters the result is every active offer, which is the
+    precomputed ranking itself when both were built from the same catalog
+    version. Otherwise the ordered ids are cached by the search index per
+    (search, variant, categories, ranking refresh), next to the search result.
+    """
+    variant = assign_variant(request)
+    categories = user_categories(request.user) if personalize else frozenset()
+    ranked, positions, stamp = offer_ranking.ordering(variant, categories)
+    if not query.strip() and not any((filters or {}).values()):
+        offer_ids, facets = search_offers()
+        if stamp is not None and stamp[0] == offer_index.version and len(ranked) == len(offer_ids):
+            return variant, ranked, facets
+
+    def order(offer_ids):
+        return sorted(offer_ids, key=lambda offer_id: positions.get(offer_id, (1, offer_id)))
+    offer_ids, facets = search_offers_ordered(query, filters, (variant, categories, stamp), order)
+    return variant, offer_ids, facets
@@ -0,0 +1,279 @@
+"""
+Offline reconciliation of referral clicks, postbacks, conversion proofs and leads.
+
+Referrals, offers, proofs and leads are loaded once as NumPy columns (one
+slot per referral). ReferralClick rows, the large table, are streamed in
+keyset-paginated chunks straight from the database cursor and folded into
+per-referral aggregates, so memory grows with the number of referrals, not
+clicks. The report aggregates per advertiser.
+"""
+import time
+import warnings
+from datetime import datetime
+
+import numpy as np
+from django.db import connection
+from django.utils import timezone
+
+from .models import Advertiser, ContactInfo, ConversionProof, Offer, Referral, ReferralClick
+
+STATES = ('pending', 'clicked', 'converted', 'failed')
+# Upper bounds (hours) of the click-to-conversion lag histogram
+LAG_BUCKETS_HOURS = (1, 6, 24, 72, 168, 720)
+MISMATCH_SAMPLE_SIZE = 20
+NO_ADVERTISER = 0
+
+
+def _timestamps(values):
+    """Seconds since the epoch (float64) from DB datetimes or ISO strings; NaN for NULL."""
+    if not len(values):
+        return np.empty(0, dtype=np.float64)
+    with warnings.catch_warnings():
+        # Aware datetimes are UTC already; NumPy only warns that it drops the tzinfo
+        warnings.simplefilter('ignore', UserWarning)
+        stamps = np.array(values, dtype='datetime64[us]')
+    seconds = stamps.astype(np.int64) / 1e6
+    seconds[np.isnat(stamps)] = np.nan
+    return seconds
+
+
+def iter_columns(queryset, fields, chunk_size=200000):
+    """Yield {field: ndarray} chunks of `queryset` ordered and paginated by id.
+
+    `fields` must start with 'id'. Rows come from a raw cursor, skipping model
+    instances and Django's per-value converters.
+    """
+    last_id = 0
+    while True:
+        chunk_qs = queryset.filter(id__gt=last_id).order_by('id').values_list(*fields)[:chunk_size]
+        sql, params = chunk_qs.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        del rows
+        yield {field: column for field, column in zip(fields, columns)}
+        last_id = columns[0][-1]
+        if len(columns[0]) < chunk_size:
+            return
+
+
+def _int_column(values, missing=-1):
+    return np.fromiter((missing if value is None else value for value in values), dtype=np.int64, count=len(values))
+
+
+def _bool_column(values):
+    return np.fromiter((bool(value) for value in values), dtype=bool, count=len(values))
+
+
+class Reconciliation:
+    def __init__(self, chunk_size=200000, since=None):
+        self.chunk_size = chunk_size
+        self.since = since
+        self.timings = {}
+
+    def _since_start(self):
+        # A datetime bound, so the created_at/clicked_at indexes serve the range (a __date lookup casts the column)
+        return timezone.make_aware(datetime.combine(self.since, datetime.min.time()))
+
+    def _timed(self, name, func):
+        start = time.perf_counter()
+        result = func()
+        self.timings[name] = round(time.perf_counter() - start, 3)
+        return result
+
+    def run(self):
+        self._timed('load_referrals', self._load_referrals)
+        self._timed('fold_clicks', self._fold_clicks)
+        self._timed('load_leads', self._load_leads)
+        self._timed('load_proofs', self._load_proofs)
+        return self._timed('aggregate', self._report)
+
+    # --- Loading ----------------------------------------------------------
+
+    def _referral_index(self, referral_ids):
+        """Position of each referral id in self.ids, or -1 if unknown."""
+        if not len(self.ids):
+            return np.full(len(referral_ids), -1, dtype=np.int64)
+        positions = np.searchsorted(self.ids, referral_ids)
+        positions[positions >= len(self.ids)] = 0
+        return np.where(self.ids[positions] == referral_ids, positions, -1)
+
+    def _load_referrals(self):
+        offer_advertiser = dict(Offer.objects.values_list('id', 'advertiser_id'))
+        queryset = Referral.objects.all()
+        if self.since:
+            queryset = queryset.filter(created_at__gte=self._since_start())
+        chunks = {'id': [], 'offer_id': [], 'user_id': [], 'state': [], 'click_count': [], 'updated_at': []}
+        state_codes = {state: code for code, state in enumerate(STATES)}
+        fields = ['id', 'offer_id', 'user_id', 'working_state', 'click_count', 'updated_at']
+        for columns in iter_columns(queryset, fields, self.chunk_size):
+            chunks['id'].append(_int_column(columns['id']))
+            chunks['offer_id'].append(_int_column(columns['offer_id']))
+            chunks['user_id'].append(_int_column(columns['user_id']))
+            chunks['state'].append(np.fromiter((state_codes.get(s, -1) for s in columns['working_state']),
+                                               dtype=np.int8, count=len(columns['working_state'])))
+            chunks['click_count'].append(_int_column(columns['click_count'], missing=0))
+            chunks['updated_at'].append(_timestamps(columns['updated_at']))
+
+        def concat(name, dtype):
+            return np.concatenate(chunks[name]) if chunks[name] else np.empty(0, dtype=dtype)
+
+        # Keyset pagination returns ids ascending, so self.ids is sorted for searchsorted
+        self.ids = concat('id', np.int64)
+        self.offer_ids = concat('offer_id', np.int64)
+        self.user_ids = concat('user_id', np.int64)
+        self.states = concat('state', np.int8)
+        self.recorded_click_counts = concat('click_count', np.int64)
+        self.updated_at = concat('updated_at', np.float64)
+        self.advertiser_ids = np.fromiter((offer_advertiser.get(offer_id) or NO_ADVERTISER for offer_id in self.offer_ids),
+                                          dtype=np.int64, count=len(self.offer_ids))
+
+        n = len(self.ids)
+        self.clicks = np.zeros(n, dtype=np.int64)
+        self.flagged_clicks = np.zeros(n, dtype=np.int64)
+        self.first_click = np.full(n, np.inf)
+        self.leads = np.zeros(n, dtype=np.int64)
+        self.proof_approved_at = np.full(n, np.inf)
+        self.orphans = {'clicks_without_referral': 0, 'leads_without_referral': 0, 'approved_proofs_without_referral': 0}
+        self.orphan_samples = {'approved_proofs_without_referral': []}
+
+    def _fold_clicks(self):
+        queryset = ReferralClick.objects.all()
+        if self.since:
+            queryset = queryset.filter(clicked_at__gte=self._since_start())
+        n = len(self.ids)
+        self.click_rows = 0
+        for columns in iter_columns(queryset, ['id', 'referral_id', 'clicked_at', 'flagged'], self.chunk_size):
+            self.click_rows += len(columns['id'])
+            positions = self._referral_index(_int_column(columns['referral_id']))
+            known = positions >= 0
+            self.orphans['clicks_without_referral'] += int((~known).sum())
+            positions = positions[known]
+            clicked_at = _timestamps(columns['clicked_at'])[known]
+            flagged = _bool_column(columns['flagged'])[known]
+            self.clicks += np.bincount(positions[~flagged], minlength=n)
+            self.flagged_clicks += np.bincount(positions[flagged], minlength=n)
+            np.minimum.at(self.first_click, positions[~flagged], clicked_at[~flagged])
+
+    def _load_leads(self):
+        n = len(self.ids)
+        for columns in iter_columns(ContactInfo.objects.filter(referral__isnull=False), ['id', 'referral_id'], self.chunk_size):
+            positions = self._referral_index(_int_column(columns['referral_id']))
+            self.orphans['leads_without_referral'] += int((positions < 0).sum())
+            self.leads += np.bincount(positions[positions >= 0], minlength=n)
+
+    def _load_proofs(self):
+        # Proofs carry (user, offer), not a referral; match them to the user's referral for the offer
+        if not len(self.ids):
+            return
+        keys = self.user_ids * (1 << 32) + self.offer_ids
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        for columns in iter_columns(ConversionProof.objects.filter(status='approved'), ['id', 'user_id', 'offer_id', 'submitted_at'], self.chunk_size):
+            proof_keys = _int_column(columns['user_id']) * (1 << 32) + _int_column(columns['offer_id'])
+            positions = np.searchsorted(sorted_keys, proof_keys)
+            positions[positions >= len(sorted_keys)] = 0
+            found = sorted_keys[positions] == proof_keys
+            missing = np.asarray(columns['id'])[~found]
+            self.orphans['approved_proofs_without_referral'] += len(missing)
+            sample = self.orphan_samples['approved_proofs_without_referral']
+            sample.extend(int(proof_id) for proof_id in missing[:MISMATCH_SAMPLE_SIZE - len(sample)])
+            np.minimum.at(self.proof_approved_at, order[positions[found]], _timestamps(columns['submitted_at'])[found])
+
+    # --- Report -----------------------------------------------------------
+
+    def _report(self):
+        has_click = self.clicks > 0
+        postback_converted = self.states == STATES.index('converted')
+        proof_approved = np.isfinite(self.proof_approved_at)
+        converted = postback_converted | proof_approved
+        # Conversion time: the postback's state change (updated_at) or the earliest approved proof
+        converted_at = np.where(postback_converted, self.updated_at, np.inf)
+        converted_at = np.minimum(converted_at, self.proof_approved_at)
+        # Only where both ends are known: inf - inf would be NaN with a RuntimeWarning
+        lag_known = converted & has_click & np.isfinite(converted_at) & np.isfinite(self.first_click)
+        lag_hours = np.full(len(self.ids), np.nan)
+        lag_hours[lag_known] = (converted_at[lag_known] - self.first_click[lag_known]) / 3600
+
+        mismatches = {
+            'conversion_without_click': converted & ~has_click,
+            'conversion_before_first_click': lag_known & (lag_hours < 0),
+            'lead_without_click': (self.leads > 0) & ~has_click,
+            'click_count_below_recorded_clicks': self.recorded_click_counts < self.clicks,
+            'flagged_clicks_only': (self.flagged_clicks > 0) & ~has_click,
+        }
+
+        advertisers, advertiser_index = np.unique(self.advertiser_ids, return_inverse=True)
+        n_advertisers = len(advertisers)
+
+        def per_advertiser(mask):
+            return np.bincount(advertiser_index[mask], minlength=n_advertisers)
+
+        funnel = {
+            'referrals': np.bincount(advertiser_index, minlength=n_advertisers),
+            'clicked': per_advertiser(has_click),
+            'leads': per_advertiser(self.leads > 0),
+            'postback_converted': per_advertiser(postback_converted),
+            'proof_approved': per_advertiser(proof_approved),
+            'converted': per_advertiser(converted),
+        }
+        clicks = np.bincount(advertiser_index, weights=self.clicks, minlength=n_advertisers)
+        flagged = np.bincount(advertiser_index, weights=self.flagged_clicks, minlength=n_advertisers)
+        mismatch_counts = {name: per_advertiser(mask) for name, mask in mismatches.items()}
+
+        names = dict(Advertiser.objects.filter(id__in=[int(a) for a in advertisers if a != NO_ADVERTISER]).values_list('id', 'name'))
+        rows = []
+        for i, advertiser_id in enumerate(advertisers):
+            # Negative lags are reported as conversion_before_first_click, not in the distribution
+            lags = lag_hours[lag_known & (lag_hours >= 0) & (advertiser_index == i)]
+            rows.append({
+                'advertiser_id': int(advertiser_id) if advertiser_id != NO_ADVERTISER else None,
+                'advertiser': names.get(int(advertiser_id)),
+                'funnel': {stage: int(counts[i]) for stage, counts in funnel.items()},
+                'clicks': int(clicks[i]),
+                'flagged_clicks': int(flagged[i]),
+                'conversion_rate': round(funnel['converted'][i] / funnel['clicked'][i], 4) if funnel['clicked'][i] else None,
+                'lag_hours': _lag_summary(lags),
+                'mismatches': {name: int(counts[i]) for name, counts in mismatch_counts.items()},
+            })
+
+        return {
+            'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'since': str(self.since) if self.since else None,
+            'totals': {
+                'referrals': int(len(self.ids)),
+                'click_rows': int(self.click_rows),
+                'converted': int(converted.sum()),
+                **{name: int(mask.sum()) for name, mask in mismatches.items()},
+                **self.orphans,
+            },
+            'mismatch_samples': {
+                **{name: [int(referral_id) for referral_id in self.ids[mask][:MISMATCH_SAMPLE_SIZE]] for name, mask in mismatches.items()},
+                **self.orphan_samples,
+            },
+            'lag_buckets_hours': list(LAG_BUCKETS_HOURS),
+            'advertisers': rows,
+            'timings_s': self.timings,
+        }
+
+
+def _lag_summary(lags):
+    if not len(lags):
+        return None
+    p50, p90, p99 = np.percentile(lags, [50, 90, 99])
+    counts = np.bincount(np.searchsorted(LAG_BUCKETS_HOURS, lags, side='left'), minlength=len(LAG_BUCKETS_HOURS) + 1)
+    return {
+        'count': int(len(lags)),
+        'mean': round(float(lags.mean()), 2),
+        'p50': round(float(p50), 2),
+        'p90': round(float(p90), 2),
+        'p99': round(float(p99), 2),
+        'histogram': [int(count) for count in counts],
+    }
+
+
+def reconcile(chunk_size=200000, since=None):
+    return Reconciliation(chunk_size=chunk_size, since=since).run()
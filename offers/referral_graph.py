@@ -0,0 +1,145 @@
+"""
+Multi-level referral graph kept as a closure table (UserAncestry).
+
+A user who signs up through someone's referral link becomes that user's
+child (UserProfile.referred_by). Every (ancestor, descendant, depth) pair is
+stored, so downline counts and earnings per level are single indexed
+aggregate queries. Inserts are set-based INSERT ... SELECT statements, and
+ancestry is only kept up to REFERRAL_GRAPH_MAX_DEPTH levels, so very deep
+chains cost at most that many rows per user.
+"""
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+
+from .models import LedgerEntry, UserAncestry, UserProfile
+
+logger = logging.getLogger(__name__)
+
+# Session key set when an anonymous visitor opens someone's referral link
+SESSION_KEY = 'referred_by_referral_id'
+
+
+def max_depth():
+    return getattr(settings, 'REFERRAL_GRAPH_MAX_DEPTH', 20)
+
+
+def is_ancestor(ancestor_id, user_id):
+    """True if ancestor_id is anywhere above user_id, however deep.
+
+    The closure table only reaches max_depth() levels, so longer chains are
+    followed from the topmost stored ancestor, one query per max_depth() levels.
+    """
+    limit = max_depth()
+    seen = set()
+    while user_id is not None and user_id not in seen:
+        seen.add(user_id)
+        links = dict(UserAncestry.objects.filter(descendant_id=user_id).values_list('ancestor_id', 'depth'))
+        if ancestor_id in links:
+            return True
+        top = [aid for aid, depth in links.items() if depth == limit]
+        user_id = top[0] if top else None
+    return False
+
+
+def attach(user, parent, referral=None):
+    """Make `user` a child of `parent` and materialize the new ancestry rows.
+
+    Returns False (and changes nothing) if the user already has a referrer,
+    refers themselves, or the link would create a cycle.
+    """
+    if parent is None or parent.id == user.id:
+        return False
+    if is_ancestor(user.id, parent.id):
+        logger.warning(f"Referral graph cycle refused: user_id={user.id}, parent_id={parent.id}")
+        return False
+
+    table = UserAncestry._meta.db_table
+    with transaction.atomic():
+        attached = UserProfile.objects.filter(user_id=user.id, referred_by__isnull=True).update(
+            referred_by_id=parent.id, referred_via=referral,
+        )
+        if not attached:
+            return False
+        # Every ancestor of parent (and parent itself) becomes an ancestor of
+        # user and of everything already below user
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (ancestor_id, descendant_id, depth) "
+                f"SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1 FROM "
+                f"(SELECT ancestor_id, depth FROM {table} WHERE descendant_id = %s UNION ALL SELECT %s, 0) a "
+                f"CROSS JOIN "
+                f"(SELECT descendant_id, depth FROM {table} WHERE ancestor_id = %s UNION ALL SELECT %s, 0) d "
+                f"WHERE a.depth + d.depth + 1 <= %s",
+                [parent.id, parent.id, user.id, user.id, max_depth()],
+            )
+    logger.info(f"Referral graph: user_id={user.id} attached under parent_id={parent.id}")
+    return True
+
+
+def rebuild():
+    """Recompute the whole closure table from UserProfile.referred_by, one depth level per statement."""
+    table = UserAncestry._meta.db_table
+    profile_table = UserProfile._meta.db_table
+    total = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {table}")
+        cursor.execute(
+            f"INSERT INTO {table} (ancestor_id, descendant_id, depth) "
+            f"SELECT referred_by_id, user_id, 1 FROM {profile_table} "
+            f"WHERE referred_by_id IS NOT NULL AND referred_by_id <> user_id",
+        )
+        inserted = cursor.rowcount
+        depth = 1
+        while inserted and depth < max_depth():
+            total += inserted
+            # Extend every path of length `depth` by one direct edge below it
+            cursor.execute(
+                f"INSERT INTO {table} (ancestor_id, descendant_id, depth) "
+                f"SELECT p.ancestor_id, e.descendant_id, p.depth + 1 FROM {table} p "
+                f"INNER JOIN {table} e ON e.ancestor_id = p.descendant_id AND e.depth = 1 "
+                f"WHERE p.depth = %s AND p.ancestor_id <> e.descendant_id",
+                [depth],
+            )
+            inserted = cursor.rowcount
+            depth += 1
+        total += inserted
+    return total
+
+
+def downline_counts(user):
+    """{depth: number of users} below `user`."""
+    rows = (UserAncestry.objects.filter(ancestor=user).values('depth')
+            .annotate(users=Count('id')).order_by('depth'))
+    return {row['depth']: row['users'] for row in rows}
+
+
+def earnings_by_level(user):
+    """Cashback earned by the user's downline, per depth: [{'depth', 'users', 'earnings'}]."""
+    rows = (LedgerEntry.objects
+            .filter(account='user', transaction__kind='cashback', user__ancestor_links__ancestor=user)
+            .values('user__ancestor_links__depth')
+            .annotate(users=Count('user', distinct=True), earnings=Sum('amount'))
+            .order_by('user__ancestor_links__depth'))
+    return [{'depth': row['user__ancestor_links__depth'], 'users': row['users'], 'earnings': row['earnings']} for row in rows]
+
+
+def downline(user):
+    """Per-level downline users and their earnings for the dashboard."""
+    earnings = {row['depth']: row for row in earnings_by_level(user)}
+    return [
+        {
+            'depth': depth,
+            'users': users,
+            'earning_users': earnings.get(depth, {}).get('users', 0),
+            'earnings': earnings.get(depth, {}).get('earnings') or 0,
+        }
+        for depth, users in downline_counts(user).items()
+    ]
+
+
+def ancestors(user):
+    """The user's referrers, nearest first."""
+    return [link.ancestor for link in UserAncestry.objects.filter(descendant=user).select_related('ancestor').order_by('depth')]
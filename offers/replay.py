@@ -0,0 +1,42 @@
+"""
+Single-use tokens shared by every worker: postback signatures and CAPTCHA nonces.
+
+Each use is one INSERT into the UsedToken table that skips the row when the
+token (its primary key) is already there, in the backend's syntax (INSERT OR
+IGNORE, ON CONFLICT DO NOTHING, INSERT IGNORE); the row count tells a first
+use from a replay without reading anything first. A token is only claimed
+while it is still valid (inside the postback window or the CAPTCHA TTL), so
+its row is needed until then and no longer: purge_expired() deletes expired
+rows in batches (python manage.py purge_used_tokens).
+"""
+from datetime import timedelta
+
+from django.db import connection
+from django.db.models.constants import OnConflict
+from django.utils import timezone
+
+from .models import UsedToken
+
+
+def claim(kind, token, ttl):
+    """Record token as used for ttl seconds; False when it was already used."""
+    ops = connection.ops
+    fields = [UsedToken._meta.get_field('key'), UsedToken._meta.get_field('expires_at')]
+    sql = (f"{ops.insert_statement(on_conflict=OnConflict.IGNORE)} {ops.quote_name(UsedToken._meta.db_table)} "
+           f"({', '.join(ops.quote_name(field.column) for field in fields)}) VALUES (%s, %s) "
+           f"{ops.on_conflict_suffix_sql(fields, OnConflict.IGNORE, None, None)}").strip()
+    expires_at = fields[1].get_db_prep_value(timezone.now() + timedelta(seconds=ttl), connection)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [f'{kind}:{token}', expires_at])
+        return cursor.rowcount == 1
+
+
+def purge_expired(batch_size=1000):
+    """Delete expired rows in batches of batch_size (short transactions); returns the number deleted."""
+    now = timezone.now()
+    total = 0
+    while True:
+        keys = list(UsedToken.objects.filter(expires_at__lte=now).values_list('key', flat=True)[:batch_size])
+        if not keys:
+            return total
+        total += UsedToken.objects.filter(key__in=keys).delete()[0]
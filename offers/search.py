@@ -0,0 +1,274 @@
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+
+from . import caching
+from .models import Offer
+
+logger = logging.getLogger(__name__)
+
+# Bumped on every catalog change, in any process
+catalog = caching.namespace('offers')
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+FACETS = ('category', 'conversion_type', 'advertiser')
+RESULT_CACHE_SIZE = 256
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+class OfferSearchIndex:
+    """In-memory inverted index and facet table over the offer catalog.
+
+    Built lazily from one query, then kept current by the Offer/Advertiser
+    signals in signals.py. Changes made by other processes bump the 'offers'
+    cache namespace (offers.caching), which rebuilds the index on its next
+    search. Every offer is indexed; active-only filtering is a set
+    intersection like any other facet.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._built_at = None
+        self._version = None
+        # Recently computed (ids, facets) per query, and those ids put in some
+        # order per (query, order key); both cleared on any index change
+        self._results = OrderedDict()
+        self._orderings = OrderedDict()
+        self._postings = defaultdict(set)
+        self._doc_tokens = {}
+        self._docs = {}
+        self._active = set()
+        self._advertiser_names = {}
+        self._sorted_tokens = None
+        self._facet_values = {facet: defaultdict(set) for facet in FACETS}
+
+    def invalidate(self):
+        with self._lock:
+            self._built_at = None
+
+    @property
+    def version(self):
+        """The 'offers' namespace version the index reflects (None before the first build)."""
+        return self._version
+
+    def _is_stale(self):
+        if self._built_at is None or self._version != catalog.version:
+            return True
+        ttl = getattr(settings, 'OFFER_SEARCH_INDEX_TTL', 300)
+        return ttl is not None and time.monotonic() - self._built_at > ttl
+
+    def _ensure_built(self):
+        if self._is_stale():
+            with self._lock:
+                if self._is_stale():
+                    self.build()
+
+    def build(self):
+        with self._lock:
+            self._reset()
+            version = catalog.version
+            rows = Offer.objects.values(
+                'id', 'name', 'description', 'reward', 'category', 'conversion_type',
+                'is_active', 'advertiser_id', 'advertiser__name',
+            )
+            for row in rows.iterator(chunk_size=2000):
+                self._add(row)
+            self._built_at = time.monotonic()
+            self._version = version
+            logger.info(f"Offer search index built: offers={len(self._docs)}, tokens={len(self._postings)}")
+
+    def _add(self, row):
+        offer_id = row['id']
+        tokens = set(tokenize(row['name']) + tokenize(row['description']) + tokenize(row['reward']) + tokenize(row['advertiser__name']))
+        for token in tokens:
+            self._postings[token].add(offer_id)
+        self._doc_tokens[offer_id] = tokens
+        doc = {
+            'category': row['category'],
+            'conversion_type': row['conversion_type'],
+            'advertiser': row['advertiser_id'],
+        }
+        self._docs[offer_id] = doc
+        for facet in FACETS:
+            self._facet_values[facet][doc[facet]].add(offer_id)
+        if row['advertiser_id']:
+            self._advertiser_names[row['advertiser_id']] = row['advertiser__name']
+        if row['is_active'] == 'active':
+            self._active.add(offer_id)
+        self._sorted_tokens = None
+        self._results.clear()
+        self._orderings.clear()
+
+    def _remove(self, offer_id):
+        for token in self._doc_tokens.pop(offer_id, ()):
+            ids = self._postings.get(token)
+            if ids is not None:
+                ids.discard(offer_id)
+                if not ids:
+                    del self._postings[token]
+        doc = self._docs.pop(offer_id, None)
+        if doc:
+            for facet in FACETS:
+                self._facet_values[facet][doc[facet]].discard(offer_id)
+        self._active.discard(offer_id)
+        self._sorted_tokens = None
+        self._results.clear()
+        self._orderings.clear()
+
+    def update_offer(self, offer, version=None):
+        """Apply a saved offer in place; version is the 'offers' version its change published."""
+        with self._lock:
+            if self._built_at is None:
+                return
+            if version is not None:
+                if self._version != version - 1:
+                    # Missed another change: rebuild on the next search instead
+                    self._built_at = None
+                    return
+                self._version = version
+            self._remove(offer.id)
+            self._add({
+                'id': offer.id,
+                'name': offer.name,
+                'description': offer.description,
+                'reward': offer.reward,
+                'category': offer.category,
+                'conversion_type': offer.conversion_type,
+                'is_active': offer.is_active,
+                'advertiser_id': offer.advertiser_id,
+                'advertiser__name': offer.advertiser.name if offer.advertiser_id else None,
+            })
+
+    def remove_offer(self, offer_id, version=None):
+        with self._lock:
+            if self._built_at is None:
+                return
+            if version is not None:
+                if self._version != version - 1:
+                    self._built_at = None
+                    return
+                self._version = version
+            self._remove(offer_id)
+
+    def _match_term(self, term, prefix):
+        if not prefix:
+            return self._postings.get(term, set())
+        if self._sorted_tokens is None:
+            self._sorted_tokens = sorted(self._postings)
+        matches = set()
+        i = bisect_left(self._sorted_tokens, term)
+        while i < len(self._sorted_tokens) and self._sorted_tokens[i].startswith(term):
+            matches |= self._postings[self._sorted_tokens[i]]
+            i += 1
+        return matches
+
+    def _label(self, facet, value):
+        if facet == 'advertiser':
+            return self._advertiser_names.get(value, '')
+        return dict(Offer._meta.get_field(facet).choices).get(value, value)
+
+    @staticmethod
+    def _key(query, filters, active_only):
+        """(active_only, terms, sorted filter items) identifying a search, or None if a filter can match nothing."""
+        filters = {facet: value for facet, value in (filters or {}).items() if facet in FACETS and value not in (None, '')}
+        if 'advertiser' in filters:
+            try:
+                filters['advertiser'] = int(filters['advertiser'])
+            except (TypeError, ValueError):
+                return None
+        return active_only, tuple(tokenize(query)), tuple(sorted(filters.items()))
+
+    def search(self, query='', filters=None, active_only=True):
+        """Return (ordered offer ids, facet counts) for a text query and facet filters.
+
+        All query terms must match; the last term also matches as a prefix so
+        search-as-you-type works. Facet counts for each dimension ignore that
+        dimension's own filter, so the UI can offer the alternatives.
+        """
+        self._ensure_built()
+        key = self._key(query, filters, active_only)
+        if key is None:
+            return [], {facet: [] for facet in FACETS}
+        _, terms, filters = key
+        filters = dict(filters)
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None:
+                self._results.move_to_end(key)
+                return cached
+
+            candidates = self._active if active_only else set(self._docs)
+            for i, term in enumerate(terms):
+                candidates = candidates & self._match_term(term, prefix=i == len(terms) - 1)
+                if not candidates:
+                    break
+
+            filter_sets = {facet: self._facet_values[facet].get(value, set()) for facet, value in filters.items()}
+            results = candidates
+            for ids in filter_sets.values():
+                results = results & ids
+
+            facets = {}
+            for facet in FACETS:
+                base = candidates
+                for other, ids in filter_sets.items():
+                    if other != facet:
+                        base = base & ids
+                # Set intersections run in C and only walk the smaller side, so
+                # counting stays linear in the candidate set even with many values.
+                counts = [
+                    (value, len(ids & base))
+                    for value, ids in self._facet_values[facet].items()
+                    if value is not None
+                ]
+                facets[facet] = [
+                    {'value': value, 'label': self._label(facet, value), 'count': count, 'selected': filters.get(facet) == value}
+                    for value, count in sorted(counts, key=lambda item: -item[1]) if count
+                ]
+            self._results[key] = (sorted(results), facets)
+            if len(self._results) > RESULT_CACHE_SIZE:
+                self._results.popitem(last=False)
+            return self._results[key]
+
+    def search_ordered(self, query, filters, order_key, order, active_only=True):
+        """search() with the ids put in order(ids) instead of by id.
+
+        The ordered list is cached per (search, order_key) until the index
+        changes, so order_key must identify everything order() depends on.
+        """
+        ids, facets = self.search(query, filters, active_only)
+        key = (self._key(query, filters, active_only), order_key)
+        with self._lock:
+            cached = self._orderings.get(key)
+            # Only valid for the very result list it was computed from
+            if cached is not None and cached[0] is ids:
+                self._orderings.move_to_end(key)
+                return cached[1], facets
+        ordered = order(ids)
+        with self._lock:
+            self._orderings[key] = (ids, ordered)
+            if len(self._orderings) > RESULT_CACHE_SIZE:
+                self._orderings.popitem(last=False)
+        return ordered, facets
+
+
+offer_index = OfferSearchIndex()
+
+
+def search_offers(query='', filters=None, active_only=True):
+    return offer_index.search(query, filters, active_only)
+
+
+def search_offers_ordered(query, filters, order_key, order, active_only=True):
+    return offer_index.search_ordered(query, filters, order_key, order, active_only)
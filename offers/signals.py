@@ -1,7 +1,13 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, pre_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import UserProfile
+from django.utils import timezone
+from .models import AdBanner, Advertiser, ContactInfo, ConversionProof, GoogleFormSubmission, Offer, Referral, TutorialVideo, UserProfile
+from .ledger import post_cashback, post_referral_conversion
+from . import funnel, referral_graph
+from .postback_auth import advertiser_keys
+from .ranking import referred_categories
+from .search import catalog, offer_index
 from allauth.account.signals import user_signed_up
 
 @receiver(post_save, sender=User)
@@ -10,12 +16,92 @@ def create_user_profile(sender, instance, created, **kwargs):
         UserProfile.objects.create(user=instance)
 
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    try:
+def save_user_profile(sender, instance, created, update_fields=None, **kwargs):
+    # Logins save the user with update_fields={'last_login'}: nothing for the profile to do
+    if created or (update_fields and set(update_fields) <= {'last_login'}):
+        return
+    if User.userprofile.is_cached(instance):
+        # Dirty-tracked: writes only what changed on the loaded profile, if anything
         instance.userprofile.save()
-    except UserProfile.DoesNotExist:
-        UserProfile.objects.create(user=instance)
+    elif update_fields is None:
+        UserProfile.objects.get_or_create(user=instance)
 
 @receiver(user_signed_up)
 def create_user_profile_social(sender, request, user, **kwargs):
-    UserProfile.objects.get_or_create(user=user)
\ No newline at end of file
+    UserProfile.objects.get_or_create(user=user)
+
+@receiver(user_signed_up)
+def attach_to_referrer(sender, request, user, **kwargs):
+    # Visitors who opened a referral link before signing up join the referrer's downline
+    referral_id = request.session.pop(referral_graph.SESSION_KEY, None) if request is not None else None
+    if not referral_id:
+        return
+    referral = Referral.objects.select_related('user').filter(id=referral_id, user__isnull=False).first()
+    if referral:
+        referral_graph.attach(user, referral.user, referral=referral)
+
+@receiver(pre_save, sender=Offer)
+def clear_paused_reason(sender, instance, **kwargs):
+    # Switching an offer on by hand overrides whatever paused it
+    if instance.is_active == 'active':
+        instance.paused_reason = ''
+
+# Catalog edits bump the 'offers' cache namespace, so every worker's search
+# index and ranking catch up; this process applies the edit to its index in place
+@receiver(post_save, sender=Offer)
+def update_offer_search_index(sender, instance, **kwargs):
+    offer_index.update_offer(instance, catalog.invalidate())
+
+@receiver(post_delete, sender=Offer)
+def remove_offer_from_search_index(sender, instance, **kwargs):
+    offer_index.remove_offer(instance.id, catalog.invalidate())
+
+@receiver(post_save, sender=Advertiser)
+def refresh_search_index_for_advertiser(sender, instance, **kwargs):
+    # Advertiser names are indexed on every offer, so rebuild on next search
+    catalog.invalidate()
+
+@receiver(post_save, sender=Advertiser)
+@receiver(post_delete, sender=Advertiser)
+def invalidate_postback_key(sender, instance, **kwargs):
+    advertiser_keys.invalidate()
+
+@receiver(post_save, sender=Referral)
+def invalidate_referred_categories(sender, instance, created, **kwargs):
+    if created and instance.user_id:
+        referred_categories.delete(instance.user_id)
+
+# Banners and videos are cached as part of the offer page, keyed by the offer's
+# updated_at, so editing them bumps the offer version without a full save.
+@receiver(post_save, sender=AdBanner)
+@receiver(post_delete, sender=AdBanner)
+@receiver(post_save, sender=TutorialVideo)
+@receiver(post_delete, sender=TutorialVideo)
+def bump_offer_version(sender, instance, **kwargs):
+    Offer.objects.filter(id=instance.offer_id).update(updated_at=timezone.now())
+
+# Credit cashback when a referral converts or a conversion proof is approved;
+# postings are idempotent per user and offer, so repeated saves are harmless.
+@receiver(post_save, sender=Referral)
+def post_cashback_for_conversion(sender, instance, **kwargs):
+    if instance.working_state == 'converted':
+        post_referral_conversion(instance)
+
+@receiver(post_save, sender=ConversionProof)
+def post_cashback_for_proof(sender, instance, **kwargs):
+    if instance.status == 'approved':
+        post_cashback(instance.user_id, instance.offer, source='conversion_proof')
+
+# Keep the per-visitor funnel state (offers.funnel) in step with its source rows
+@receiver(post_save, sender=ContactInfo)
+@receiver(post_save, sender=GoogleFormSubmission)
+@receiver(post_save, sender=ConversionProof)
+def refresh_funnel_state(sender, instance, **kwargs):
+    funnel.refresh_for(instance)
+
+@receiver(post_delete, sender=ContactInfo)
+@receiver(post_delete, sender=GoogleFormSubmission)
+@receiver(post_delete, sender=ConversionProof)
+def forget_funnel_state(sender, instance, **kwargs):
+    # The offer or user may be going too (cascades), so recompute once the deletion commits
+    funnel.forget(instance.offer_id, instance.user_id, getattr(instance, 'visitor_identifier', None))
@@ -0,0 +1,143 @@
+"""
+Cold-start profile of the project: what a new worker or management command
+pays before it can do any work.
+
+Each run is a fresh interpreter (`python -X importtime`) that sets Django up
+the way manage.py does and times the phases:
+
+* setup: django.setup(), i.e. settings, every app's models and ready()
+  (including admin autodiscovery), with ready() timed per app
+* urls: importing the URLconf and every view module, which a worker does on
+  its first request
+* checks: the system checks every management command runs unless it sets
+  requires_system_checks = []
+
+Import costs come from the -X importtime report of the same run.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PHASES = ('setup', 'urls', 'checks')
+PROJECT_PACKAGES = ('offers', 'cashback_zone', 'theme')
+
+# Runs in the child interpreter; argv[1] is the comma-separated phases
+PROBE = r'''
+import json, sys, time
+start = time.perf_counter()
+from django.apps.config import AppConfig
+
+ready = {}
+create = AppConfig.create.__func__
+
+
+def timed_create(cls, entry):
+    config = create(cls, entry)
+    method = config.ready
+
+    def timed_ready():
+        began = time.perf_counter()
+        method()
+        ready[config.label] = (time.perf_counter() - began) * 1e3
+
+    config.ready = timed_ready
+    return config
+
+
+AppConfig.create = classmethod(timed_create)
+phases = sys.argv[1].split(',')
+result = {'phases_ms': {}, 'ready_ms': ready}
+import django
+django.setup()
+result['phases_ms']['setup'] = (time.perf_counter() - start) * 1e3
+if 'urls' in phases:
+    began = time.perf_counter()
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+    result['phases_ms']['urls'] = (time.perf_counter() - began) * 1e3
+if 'checks' in phases:
+    began = time.perf_counter()
+    from django.core import checks
+    checks.run_checks()
+    result['phases_ms']['checks'] = (time.perf_counter() - began) * 1e3
+result['modules'] = len(sys.modules)
+print(json.dumps(result))
+'''
+
+
+def parse_importtime(text):
+    """[(module, self us, cumulative us, importer)] from `-X importtime` output, in import order."""
+    rows = []
+    for line in text.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append([name.strip(), int(own), int(cumulative), depth, None])
+    # A module is listed after everything it imported: its importer is the next row one level up
+    pending = {}
+    for row in reversed(rows):
+        row[4] = pending.get(row[3] - 1)
+        pending[row[3]] = row[0]
+    return [(name, own, cumulative, importer) for name, own, cumulative, depth, importer in rows]
+
+
+def _is_project(module):
+    return module is not None and module.split('.')[0] in PROJECT_PACKAGES
+
+
+def summarize_imports(rows, top=15):
+    by_package = {}
+    for name, own, cumulative, importer in rows:
+        package = name.split('.')[0]
+        by_package[package] = by_package.get(package, 0) + own
+    # Third-party/stdlib modules the project imports itself: the ones it can defer
+    from_project = [(name, cumulative, importer) for name, own, cumulative, importer in rows
+                    if _is_project(importer) and not _is_project(name)]
+    return {
+        'modules': len(rows),
+        'total_ms': round(sum(own for name, own, cumulative, importer in rows) / 1e3, 1),
+        'packages_ms': {package: round(us / 1e3, 1) for package, us in
+                        sorted(by_package.items(), key=lambda item: -item[1])[:top]},
+        'project_imports_ms': [
+            {'module': name, 'imported_by': importer, 'ms': round(cumulative / 1e3, 1)}
+            for name, cumulative, importer in sorted(from_project, key=lambda item: -item[1])[:top]
+        ],
+    }
+
+
+def profile_startup(phases=PHASES, runs=5, top=15):
+    """Median phase and ready() times over `runs` fresh interpreters, with the import summary of the median run."""
+    from django.conf import settings
+
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'cashback_zone.settings')
+    samples = []
+    for _ in range(runs):
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', PROBE, ','.join(phases)],
+            capture_output=True, text=True, env=env, cwd=str(settings.BASE_DIR), check=False,
+        )
+        if completed.returncode:
+            raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'probe failed')
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        result['total_ms'] = sum(result['phases_ms'].values())
+        result['importtime'] = completed.stderr
+        samples.append(result)
+
+    samples.sort(key=lambda sample: sample['total_ms'])
+    median = samples[len(samples) // 2]
+    labels = median['ready_ms'].keys()
+    return {
+        'runs': runs,
+        'python': sys.version.split()[0],
+        'total_ms': round(median['total_ms'], 1),
+        'phases_ms': {phase: round(statistics.median(s['phases_ms'][phase] for s in samples), 1)
+                      for phase in median['phases_ms']},
+        'ready_ms': {label: round(statistics.median(s['ready_ms'].get(label, 0) for s in samples), 1)
+                     for label in labels},
+        'modules_loaded': median['modules'],
+        'imports': summarize_imports(parse_importtime(median['importtime']), top),
+    }
@@ -1,3 +1,1535 @@
-from django.test import TestCase
+import glob
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from urllib.parse import urlencode
 
-# Create your tests here.
+from allauth.account.signals import user_signed_up
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import AnonymousUser, Permission, User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache, caches
+from django.core.cache.utils import make_template_fragment_key
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from cashback_zone.static_serving import StaticFilesLayer, parse_accept_encoding
+
+from . import admin_scaling, benchmarks, bulk_import, caching, captcha, fraud, funnel, ipintel, ledger, lifecycle, metrics, ops_health, phone_validation, postback_auth, ranking, reconciliation, referral_graph, replay, startup, verification_codes
+from .management.commands import benchmark_templates
+from .fraud import ClickFraudEngine, click_fraud_engine
+from .log import JsonFormatter, RotatingJsonFileHandler
+from .middleware import ViewBudgetExceeded
+from .postback_auth import REPLAY_KIND, PostbackAuthError, verify_postback
+from .models import (
+    AdBanner, Advertiser, ApiLog, ApiUsage, ContactInfo, ConversionProof, EmailVerification, FunnelState, LedgerEntry,
+    LedgerTransaction, Offer, Payout, PayoutBatch, Referral, ReferralClick, TutorialVideo, UsedToken, UserAncestry, UserBalance,
+    UserProfile,
+)
+from .search import catalog, offer_index, search_offers
+from .utils import validate_mobile_number
+
+# Requests made by the tests fail when a view goes over its query budget
+enforce_view_budgets = override_settings(VIEW_BUDGETS_RAISE=True)
+# Namespace bumps go to a bus of their own instead of BASE_DIR/cache_bus.json
+cache_bus_dir = tempfile.mkdtemp()
+isolated_cache_bus = override_settings(CACHE_BUS_URL=f"file://{os.path.join(cache_bus_dir, 'cache_bus.json')}")
+# Ranking refreshes run where the tests call them, not in threads outside the test transaction
+foreground_ranking = override_settings(RANKING_BACKGROUND_REFRESH=False)
+
+
+def setUpModule():
+    isolated_cache_bus.enable()
+    foreground_ranking.enable()
+    caching._bus = None
+
+
+def tearDownModule():
+    isolated_cache_bus.disable()
+    foreground_ranking.disable()
+    caching._bus = None
+    shutil.rmtree(cache_bus_dir, ignore_errors=True)
+
+
+@enforce_view_budgets
+class LoginQueryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'correct-horse-battery')
+
+    def test_login_queries(self):
+        self.client.get('/accounts/login/')
+        # Email lookup, user, session insert and update, last_login update (plus
+        # savepoints); the User post_save cascade leaves the profile alone
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/accounts/login/', {'login': 'alice@example.com', 'password': 'correct-horse-battery'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.client.session['_auth_user_id'], str(self.user.pk))
+        self.assertEqual(len(queries), 10)
+        self.assertFalse([q['sql'] for q in queries if UserProfile._meta.db_table in q['sql']])
+
+
+class UserProfileDirtyTrackingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('bob', 'bob@example.com', 'correct-horse-battery')
+
+    def test_unchanged_profile_is_not_written(self):
+        profile = self.user.userprofile
+        with self.assertNumQueries(0):
+            profile.save()
+        # Only the user row: the loaded profile has nothing to write
+        with self.assertNumQueries(1):
+            self.user.save()
+
+    def test_only_changed_columns_are_written(self):
+        profile = UserProfile.objects.get(user=self.user)
+        profile.email_verified = True
+        with CaptureQueriesContext(connection) as queries:
+            profile.save()
+        self.assertEqual(len(queries), 1)
+        self.assertIn('"email_verified"', queries[0]['sql'])
+        self.assertNotIn('"mobile_verified"', queries[0]['sql'])
+        with self.assertNumQueries(0):
+            profile.save()
+
+    def test_update_for_writes_once_without_loading(self):
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(1):
+            UserProfile.objects.update_for(user, mobile_verified=True)
+        self.assertTrue(UserProfile.objects.get(user=self.user).mobile_verified)
+
+    def test_update_for_creates_a_missing_profile(self):
+        UserProfile.objects.filter(user=self.user).delete()
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertLogs('offers.models', 'WARNING'):
+            UserProfile.objects.update_for(user, email_verified=True)
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual((profile.email_verified, profile.mobile_verified), (True, False))
+
+
+class PhoneValidationTests(TestCase):
+    def test_normalizes_to_e164(self):
+        self.assertEqual(phone_validation.normalize('+91 98765-43210'), '+919876543210')
+        self.assertEqual(phone_validation.normalize('0044 7911 123456'), '+447911123456')
+        self.assertEqual(phone_validation.normalize('09876543210', default_region='IN'), '+919876543210')
+
+    def test_rejects_impossible_numbers(self):
+        for number in ('+911234567890', '+9198765432100', '+447611123456', '+99912345678', '+93123', 'not a number'):
+            with self.subTest(number=number), self.assertRaises(phone_validation.InvalidNumber):
+                phone_validation.normalize(number)
+
+    def test_impossible_number_skips_the_apis(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(validate_mobile_number(None, '+911234567890'), (False, "Invalid mobile number"))
+        self.assertFalse(ApiUsage.objects.exists())
+        self.assertFalse(ApiLog.objects.exists())
+
+
+class CacheNamespaceTests(TestCase):
+    def test_offer_save_bumps_the_catalog_version(self):
+        offer = Offer.objects.create(name='Quokka savings', price=10, reward='50', advertiser=Advertiser.objects.create(name='Acme'))
+        offer_index.build()
+        version = catalog.version
+        offer.name = 'Wombat savings'
+        offer.save()
+        self.assertEqual(catalog.version, version + 1)
+        # Applied in place by this process; other workers see the new version and rebuild
+        self.assertFalse(offer_index._is_stale())
+        self.assertIn(offer.id, search_offers('wombat')[0])
+        catalog.invalidate()
+        self.assertTrue(offer_index._is_stale())
+
+    def test_concurrent_misses_compute_once(self):
+        namespace = caching.namespace('tests-single-flight', tier='shared')
+        namespace.invalidate()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.05)
+            return 42
+
+        threads = [threading.Thread(target=namespace.get_or_set, args=('key', compute)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(namespace.get('key'), 42)
+        namespace.invalidate()
+        self.assertIsNone(namespace.get('key'))
+
+    def test_bumps_go_to_the_configured_bus(self):
+        catalog.invalidate()
+        self.assertTrue(caching.bus().path.startswith(cache_bus_dir))
+        self.assertFalse(os.path.exists(os.path.join(settings.BASE_DIR, 'cache_bus.json')))
+
+    def test_shared_tier_refuses_a_local_memory_cache(self):
+        self.assertIs(caching.shared_tier(), caches['shared'])
+        with override_settings(CACHE_SHARED_ALIAS='default'), self.assertRaises(ImproperlyConfigured):
+            caching.shared_tier()
+
+
+@enforce_view_budgets
+class OpsHealthPageTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user('ops', 'ops@example.com', 'correct-horse-battery', is_staff=True)
+        ApiUsage.objects.create(api_name='numverify', request_count=40)
+        ApiLog.objects.create(api_name='numverify', message='Timeout', level='ERROR')
+
+    def test_page_reads_the_snapshot_only(self):
+        ops_health.refresh()
+        self.client.force_login(self.staff)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/ops/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q['sql'] for q in queries if '"offers_' in q['sql']])
+        quota = response.context['snapshot']['quotas'][0]
+        self.assertEqual((quota['provider'], quota['used']), ('numverify', 40))
+        self.assertContains(response, 'Timeout')
+
+    def test_staff_only(self):
+        self.client.force_login(User.objects.create_user('carol', 'carol@example.com', 'correct-horse-battery'))
+        self.assertEqual(self.client.get('/ops/').status_code, 302)
+
+    def test_quota_month_is_the_utc_month_the_counters_reset_on(self):
+        # Already November 1st in TIME_ZONE (Asia/Kolkata), still October in UTC
+        now = datetime(2026, 10, 31, 20, 0, tzinfo=dt_timezone.utc)
+        ApiUsage.objects.filter(api_name='numverify').update(last_reset=now - timedelta(days=10))
+        quota = ops_health.provider_quotas(now)[0]
+        self.assertEqual(quota['used'], 40)
+        self.assertEqual(quota['resets_at'], datetime(2026, 11, 1, tzinfo=dt_timezone.utc))
+        self.assertEqual(quota['burn_rate_per_day'], 4.0)
+
+
+class FunnelStateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('dave', 'dave@example.com', 'correct-horse-battery')
+        self.offer = Offer.objects.create(name='Savings account', price=10)
+
+    def test_writes_keep_the_state_current(self):
+        self.assertEqual(funnel.state(self.offer.id, user_id=self.user.id), funnel.EMPTY)
+        ContactInfo.objects.create(user=self.user, offer=self.offer, name='Dave', email='dave@example.com', mobile='+919876543210')
+        proof = ConversionProof.objects.create(user=self.user, offer=self.offer, image='proof.png')
+        state = funnel.state(self.offer.id, user_id=self.user.id)
+        self.assertTrue(state.contact_info_submitted and state.proof_submitted)
+        self.assertFalse(state.google_form_completed)
+        self.assertEqual(state.proof_status, 'pending')
+        proof.status = 'rejected'
+        proof.save()
+        self.assertEqual(funnel.state(self.offer.id, user_id=self.user.id).proof_status, 'rejected')
+
+    def test_state_is_one_primary_key_lookup(self):
+        ConversionProof.objects.create(user=self.user, offer=self.offer, image='proof.png')
+        with self.assertNumQueries(1):
+            self.assertTrue(funnel.state(self.offer.id, user_id=self.user.id).proof_submitted)
+        # A browsing visitor costs the same single lookup and stores nothing
+        with self.assertNumQueries(1):
+            self.assertEqual(funnel.state(self.offer.id, visitor_identifier='browsing'), funnel.EMPTY)
+        self.assertEqual(FunnelState.objects.count(), 1)
+
+    def test_deleting_a_source_row_recomputes_after_commit(self):
+        contact = ContactInfo.objects.create(user=self.user, offer=self.offer, name='Dave', email='dave@example.com', mobile='+919876543210')
+        ConversionProof.objects.create(user=self.user, offer=self.offer, image='proof.png')
+        with self.captureOnCommitCallbacks(execute=True):
+            contact.delete()
+        state = funnel.state(self.offer.id, user_id=self.user.id)
+        self.assertEqual((state.contact_info_submitted, state.proof_submitted), (False, True))
+        # When the offer goes, its states go with it rather than being rewritten
+        with self.captureOnCommitCallbacks(execute=True):
+            self.offer.delete()
+        self.assertFalse(FunnelState.objects.exists())
+
+    @override_settings(CACHES={**settings.CACHES, 'funnel': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                                             'LOCATION': 'funnel-tests'}},
+                       FUNNEL_STATE_CACHE='funnel')
+    def test_a_write_replaces_only_its_own_cached_state(self):
+        caches['funnel'].clear()
+        other = Offer.objects.create(name='Card', price=1)
+        self.assertEqual(funnel.state(self.offer.id, user_id=self.user.id), funnel.EMPTY)
+        self.assertEqual(funnel.state(other.id, user_id=self.user.id), funnel.EMPTY)
+        with self.assertNumQueries(0):
+            funnel.state(self.offer.id, user_id=self.user.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            ContactInfo.objects.create(user=self.user, offer=self.offer, name='Dave', email='dave@example.com', mobile='+919876543210')
+        with self.assertNumQueries(0):
+            self.assertTrue(funnel.state(self.offer.id, user_id=self.user.id).contact_info_submitted)
+            self.assertEqual(funnel.state(other.id, user_id=self.user.id), funnel.EMPTY)
+
+    def test_backfill_stores_states_for_older_data(self):
+        ConversionProof.objects.create(user=self.user, offer=self.offer, image='proof.png')
+        ContactInfo.objects.create(offer=self.offer, visitor_identifier='guest', name='Eve', email='eve@example.com', mobile='+919876543211')
+        FunnelState.objects.all().delete()
+        self.assertEqual(funnel.state(self.offer.id, user_id=self.user.id), funnel.EMPTY)
+        out = io.StringIO()
+        call_command('backfill_funnel_states', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Stored 2 funnel states')
+        self.assertTrue(funnel.state(self.offer.id, user_id=self.user.id).proof_submitted)
+        self.assertTrue(funnel.state(self.offer.id, visitor_identifier='guest').contact_info_submitted)
+        self.assertEqual(funnel.backfill(), 0)
+
+
+class FeedImportTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.feeds = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        self.addCleanup(shutil.rmtree, self.feeds)
+        settings_override = override_settings(MEDIA_ROOT=self.media, OFFER_FEED_MEDIA_ROOT=self.feeds)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def _feed_file(self, name, content):
+        with open(os.path.join(self.feeds, name), 'wb') as fh:
+            fh.write(content)
+
+    def _import(self, text):
+        return bulk_import.import_offers(bulk_import.load_feed(io.StringIO(text)), workers=2)
+
+    def test_upserts_offers_advertisers_banners_and_videos(self):
+        feed = ('external_id,name,price,advertiser,banners,videos\n'
+                'A1,Card offer,10,Acme,,https://example.com/v1|https://example.com/v2\n'
+                'A2,Loan offer,20,Acme,,\n')
+        result = self._import(feed)
+        self.assertEqual((result['offers'], result['advertisers'], result['videos']), (2, 1, 2))
+        self._import('external_id,name,price\nA1,Card offer v2,15\n')
+        offer = Offer.objects.get(external_id='A1')
+        self.assertEqual((offer.name, offer.price, offer.advertiser.name), ('Card offer v2', 15, 'Acme'))
+        self.assertEqual(TutorialVideo.objects.filter(offer=offer).count(), 2)
+
+    def test_rows_need_id_name_and_price(self):
+        with self.assertRaises(bulk_import.FeedError):
+            bulk_import.load_feed(io.StringIO('external_id,name\nA1,Card offer\n'))
+        with self.assertRaises(bulk_import.FeedError):
+            bulk_import.load_feed(io.StringIO('[{"external_id": "A1", "name": "x", "price": "ten"}]'))
+
+    def test_media_outside_the_feed_root_is_not_copied(self):
+        secret = os.path.join(tempfile.mkdtemp(), 'secret.env')
+        self.addCleanup(shutil.rmtree, os.path.dirname(secret))
+        with open(secret, 'w') as fh:
+            fh.write('SECRET_KEY=x')
+        os.symlink(secret, os.path.join(self.feeds, 'link.png'))
+        feed = [{'external_id': f'A{i}', 'name': 'Offer', 'price': '1', 'image': path}
+                for i, path in enumerate((secret, '../' + os.path.basename(self.media), 'link.png', '/etc/passwd'))]
+        result = bulk_import.import_offers([bulk_import.normalize_row(row) for row in feed], workers=2)
+        self.assertEqual(result['media'], 0)
+        self.assertFalse(Offer.objects.exclude(image='').exclude(image=None).exists())
+        self.assertEqual(os.listdir(self.media), [])
+
+    def test_media_copy_is_reused_only_for_identical_content(self):
+        self._feed_file('banner.png', b'first')
+        self._import('[{"external_id": "A1", "name": "Offer", "price": "1", "image": "banner.png", "banners": ["banner.png"]}]')
+        first = Offer.objects.get(external_id='A1').image.name
+        self.assertEqual(AdBanner.objects.get().image.name.split('/')[-1], first.split('/')[-1])
+        self._import('[{"external_id": "A1", "name": "Offer", "price": "1", "image": "banner.png"}]')
+        self.assertEqual(Offer.objects.get(external_id='A1').image.name, first)
+        # Same name and size, different bytes: copied again
+        self._feed_file('banner.png', b'other')
+        self._import('[{"external_id": "A1", "name": "Offer", "price": "1", "image": "banner.png"}]')
+        second = Offer.objects.get(external_id='A1').image.name
+        self.assertNotEqual(second, first)
+        with default_storage.open(second) as fh:
+            self.assertEqual(fh.read(), b'other')
+
+    def test_without_a_feed_root_no_media_is_copied(self):
+        self._feed_file('banner.png', b'first')
+        with override_settings(OFFER_FEED_MEDIA_ROOT=None):
+            result = self._import('external_id,name,price,image\nA1,Offer,1,banner.png\n')
+        self.assertEqual(result['media'], 0)
+
+
+@enforce_view_budgets
+class OfferSearchTests(TestCase):
+    def setUp(self):
+        acme = Advertiser.objects.create(name='Acme')
+        self.card = Offer.objects.create(name='Platinum credit card', price=1, category='finance', conversion_type='signup', advertiser=acme)
+        self.loan = Offer.objects.create(name='Personal loan', description='Low rate credit', price=1, category='finance')
+        self.shoes = Offer.objects.create(name='Running shoes', price=1, category='ecommerce', conversion_type='sale')
+        self.paused = Offer.objects.create(name='Paused credit offer', price=1, is_active='inactive')
+        offer_index.build()
+
+    def test_all_terms_match_and_the_last_one_as_a_prefix(self):
+        self.assertEqual(search_offers('credit')[0], sorted([self.card.id, self.loan.id]))
+        self.assertEqual(search_offers('credit ca')[0], [self.card.id])
+        self.assertEqual(search_offers('acm')[0], [self.card.id])
+        self.assertEqual(search_offers('cred shoes')[0], [])
+        self.assertEqual(search_offers('credit', active_only=False)[0], sorted([self.card.id, self.loan.id, self.paused.id]))
+
+    def test_facet_counts_ignore_their_own_filter(self):
+        ids, facets = search_offers('', {'category': 'finance'})
+        self.assertEqual(ids, sorted([self.card.id, self.loan.id]))
+        categories = {row['value']: (row['count'], row['selected']) for row in facets['category']}
+        self.assertEqual(categories, {'finance': (2, True), 'ecommerce': (1, False)})
+        types = {row['value']: row['count'] for row in facets['conversion_type']}
+        self.assertEqual(types, {'signup': 1, 'lead': 1})
+        self.assertEqual(search_offers('', {'advertiser': 'not-an-id'})[0], [])
+
+    def test_saved_offers_replace_cached_results(self):
+        self.assertEqual(search_offers('shoes')[0], [self.shoes.id])
+        self.shoes.name = 'Trail sneakers'
+        self.shoes.save()
+        self.assertEqual(search_offers('shoes')[0], [])
+        self.assertEqual(search_offers('sneakers')[0], [self.shoes.id])
+        self.shoes.delete()
+        self.assertEqual(search_offers('sneakers')[0], [])
+
+    def test_search_endpoint_pages_results(self):
+        response = self.client.get('/search/', {'q': 'credit', 'category': 'finance'})
+        data = response.json()
+        self.assertEqual(data['count'], 2)
+        self.assertEqual({row['id'] for row in data['results']}, {self.card.id, self.loan.id})
+        self.assertEqual(data['filters'], {'category': 'finance'})
+
+
+@enforce_view_budgets
+class TemplateBenchmarkTests(TestCase):
+    def setUp(self):
+        self.offer = Offer.objects.create(name='Cashback card', price=1, terms='Spend once.')
+
+    def _fragment_keys(self):
+        return [make_template_fragment_key(name, vary_on(self.offer))
+                for name, vary_on in benchmark_templates.FRAGMENTS.items()]
+
+    def test_cold_renders_only_drop_the_offer_fragments(self):
+        self.client.get(f'/offer/{self.offer.id}/')
+        self.assertTrue(all(cache.get(key) is not None for key in self._fragment_keys()))
+        cache.set('unrelated', 1)
+        benchmark_templates.clear_fragments(self.offer)
+        self.assertEqual([cache.get(key) for key in self._fragment_keys()], [None, None])
+        self.assertEqual(cache.get('unrelated'), 1)
+
+    def test_command_reports_cold_and_warm_timings(self):
+        cache.set('unrelated', 1)
+        out = io.StringIO()
+        call_command('benchmark_templates', iterations=2, offer=self.offer.id, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertIn('offer_detail.html     cold', out.getvalue())
+        self.assertIn('offer_detail.html     warm', out.getvalue())
+        self.assertEqual(len(lines), 1 + 2 * 4)
+        self.assertEqual(cache.get('unrelated'), 1)
+
+
+class StaticServingTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        static_root, self.media_root = os.path.join(self.root, 'static'), os.path.join(self.root, 'media')
+        for directory in (os.path.join(static_root, 'css'), os.path.join(self.media_root, 'offers'),
+                          os.path.join(self.media_root, 'conversion_proofs')):
+            os.makedirs(directory)
+        for name, content in (('css/site.css', b'body{}'), ('css/site.css.gz', b'gz'), ('css/site.css.br', b'br')):
+            with open(os.path.join(static_root, name), 'wb') as fh:
+                fh.write(content)
+        for name in ('offers/banner.png', 'conversion_proofs/proof.png'):
+            with open(os.path.join(self.media_root, name), 'wb') as fh:
+                fh.write(b'0123456789')
+        self.layer = StaticFilesLayer(self._django, static_root, '/static/', self.media_root, '/media/')
+
+    def _django(self, environ, start_response):
+        start_response('404 Not Found', [])
+        return [b'django']
+
+    def _get(self, path, **headers):
+        environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'GET', **headers}
+        response = {}
+
+        def start_response(status, headers):
+            response['status'], response['headers'] = status, dict(headers)
+        response['body'] = b''.join(self.layer(environ, start_response))
+        return response
+
+    def test_accept_encoding_honours_q_values(self):
+        self.assertEqual(parse_accept_encoding('gzip;q=0.5, br;q=0, *;q=0.1'), {'gzip': 0.5, 'br': 0.0, '*': 0.1})
+        self.assertEqual(self._get('/static/css/site.css', HTTP_ACCEPT_ENCODING='gzip, br')['body'], b'br')
+        self.assertEqual(self._get('/static/css/site.css', HTTP_ACCEPT_ENCODING='gzip, br;q=0')['body'], b'gz')
+        self.assertEqual(self._get('/static/css/site.css', HTTP_ACCEPT_ENCODING='gzip;q=0.9, br;q=0.5')['body'], b'gz')
+        self.assertEqual(self._get('/static/css/site.css', HTTP_ACCEPT_ENCODING='*')['body'], b'br')
+        # Substrings of other codings are not matches
+        response = self._get('/static/css/site.css', HTTP_ACCEPT_ENCODING='x-gzip-not, identity')
+        self.assertEqual(response['body'], b'body{}')
+        self.assertNotIn('Content-Encoding', response['headers'])
+        self.assertEqual(response['headers']['Vary'], 'Accept-Encoding')
+
+    def test_private_media_falls_through_to_django(self):
+        with override_settings(MEDIA_PRIVATE_PREFIXES=('conversion_proofs/',)):
+            self.layer = StaticFilesLayer(self._django, None, '/static/', self.media_root, '/media/')
+        public = self._get('/media/offers/banner.png')
+        self.assertEqual(public['headers']['Cache-Control'], 'public, max-age=86400')
+        self.assertEqual(self._get('/media/conversion_proofs/proof.png')['body'], b'django')
+        self.assertEqual(self._get('/media/offers/../conversion_proofs/proof.png')['body'], b'django')
+
+    def test_media_ranges_and_fallthrough(self):
+        partial = self._get('/media/offers/banner.png', HTTP_RANGE='bytes=2-4')
+        self.assertEqual((partial['status'], partial['body']), ('206 Partial Content', b'234'))
+        self.assertEqual(self._get('/media/offers/banner.png', HTTP_RANGE='bytes=-3')['body'], b'789')
+        self.assertEqual(self._get('/media/offers/banner.png', HTTP_RANGE='bytes=20-')['status'], '416 Range Not Satisfiable')
+        self.assertEqual(self._get('/media/../static/css/site.css')['body'], b'django')
+        self.assertEqual(self._get('/media/offers/missing.png')['body'], b'django')
+
+
+class PrivateMediaTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        os.makedirs(os.path.join(self.media_root, 'conversion_proofs'))
+        with open(os.path.join(self.media_root, 'conversion_proofs', 'proof.png'), 'wb') as fh:
+            fh.write(b'0123456789')
+        self.owner = User.objects.create(username='owner')
+        offer = Offer.objects.create(name='Card', price=1)
+        ConversionProof.objects.create(user=self.owner, offer=offer, image='conversion_proofs/proof.png')
+        self.url = '/media/conversion_proofs/proof.png'
+
+    def test_owner_gets_the_file_uncached(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Cache-Control'], 'private, no-store')
+
+    def test_others_get_a_404(self):
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.client.force_login(User.objects.create(username='other'))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.get('/media/conversion_proofs/../conversion_proofs/missing.png').status_code, 404)
+
+    def test_staff_with_view_permission_and_sendfile(self):
+        staff = User.objects.create(username='staff', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        staff.user_permissions.set(Permission.objects.filter(codename='view_conversionproof'))
+        with override_settings(PRIVATE_MEDIA_SENDFILE='x-accel-redirect'):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/conversion_proofs/proof.png')
+        self.assertEqual(response.content, b'')
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        Offer.objects.create(name='Budget card', price=1)
+        offer_index.build()
+
+    def test_query_budget_overruns_raise_only_when_enabled(self):
+        with override_settings(VIEW_BUDGETS={'offer_search': {'queries': 0, 'ms': None}}):
+            with self.assertLogs('offers.middleware', 'WARNING') as logs:
+                self.assertEqual(self.client.get('/search/').status_code, 200)
+            self.assertIn('View over query budget: view=offer_search', logs.output[0])
+            with enforce_view_budgets, self.assertRaises(ViewBudgetExceeded):
+                self.client.get('/search/')
+
+    def test_requests_are_counted_per_view(self):
+        before = dict(metrics.registry.histograms('cashback_view_db_queries')).get((('view', 'offer_search'),))
+        count = before.count if before else 0
+        self.client.get('/search/')
+        after = dict(metrics.registry.histograms('cashback_view_db_queries'))[(('view', 'offer_search'),)]
+        self.assertEqual(after.count, count + 1)
+
+
+class CountingJsonFormatter(JsonFormatter):
+    calls = 0
+
+    def format(self, record):
+        CountingJsonFormatter.calls += 1
+        return super().format(record)
+
+
+class RotatingLogTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'clicks.log')
+
+    def _handler(self, **options):
+        handler = RotatingJsonFileHandler(self.path, **{'interval': 0, **options})
+        handler.setFormatter(CountingJsonFormatter())
+        self.addCleanup(handler.close)
+        return handler
+
+    def _emit(self, handler, message):
+        handler.handle(logging.LogRecord('clicks', logging.INFO, __file__, 1, message, (), None))
+
+    def _messages(self):
+        messages = []
+        for path in glob.glob(self.path + '*'):
+            if path.endswith('.lock'):
+                continue
+            with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path)) as fh:
+                messages += [json.loads(line)['message'] for line in fh]
+        return sorted(messages)
+
+    def test_records_are_formatted_once(self):
+        handler = self._handler(max_bytes=10 ** 6)
+        CountingJsonFormatter.calls = 0
+        for i in range(3):
+            self._emit(handler, f'click {i}')
+        self.assertEqual(CountingJsonFormatter.calls, 3)
+
+    def test_size_rotation_keeps_every_record_and_prunes(self):
+        handler = self._handler(max_bytes=200, backup_count=2, compress=True)
+        for i in range(10):
+            self._emit(handler, f'click {i:02}')
+        rotated = [path for path in glob.glob(self.path + '.*') if not path.endswith('.lock')]
+        self.assertEqual(len(rotated), 2)
+        self.assertTrue(all(path.endswith('.gz') for path in rotated))
+        self.assertLess(os.path.getsize(self.path), 200)
+
+    def test_workers_sharing_a_file_rotate_it_once(self):
+        # Two handlers on one path stand in for two worker processes
+        first, second = self._handler(max_bytes=10 ** 6), self._handler(max_bytes=10 ** 6)
+        self._emit(first, 'first before')
+        self._emit(second, 'second before')
+        # Both reach the limit; the second finds the file already rotated
+        first.doRollover()
+        second.doRollover()
+        self._emit(second, 'second after')
+        self._emit(first, 'first after')
+        # A worker whose stream is on the rotated file moves to the new one before writing
+        third = self._handler(max_bytes=10 ** 6)
+        self._emit(third, 'third')
+        os.rename(self.path, self.path + '.elsewhere')
+        self._emit(third, 'third moved')
+        rotated = [path for path in glob.glob(self.path + '.*') if not path.endswith(('.lock', '.elsewhere'))]
+        self.assertEqual(len(rotated), 1)
+        with open(self.path) as fh:
+            self.assertEqual([json.loads(line)['message'] for line in fh], ['third moved'])
+        with open(self.path + '.elsewhere') as fh:
+            self.assertEqual([json.loads(line)['message'] for line in fh], ['second after', 'first after', 'third'])
+        self.assertEqual(self._messages(), ['first after', 'first before', 'second after', 'second before', 'third', 'third moved'])
+
+
+class BenchmarkSuiteTests(TestCase):
+    def test_percentiles_and_regression_comparison(self):
+        stats = benchmarks.percentiles([0.001 * i for i in range(1, 101)], scale=1e3)
+        self.assertEqual((stats['count'], stats['p50'], stats['p95'], stats['p99'], stats['max']), (100, 51.0, 96.0, 100.0, 100.0))
+        self.assertEqual(benchmarks.percentiles([]), {})
+        baseline = {'micro': {'dedup': {'p95': 10.0}}, 'scenarios': {'steps_ms': {'postback': {'p95': 4.0}}}}
+        current = {'micro': {'dedup': {'p95': 12.0}}, 'scenarios': {'steps_ms': {'postback': {'p95': 3.0}, 'index': {'p95': 1.0}}}}
+        self.assertEqual(benchmarks.compare(baseline, current), {'micro.dedup': 0.2, 'scenarios.postback': -0.25})
+
+    def test_generated_dataset_drives_the_funnel_and_flushes(self):
+        counts = benchmarks.generate_dataset(advertisers=2, offers=10, users=5, referrals=30, clicks=20,
+                                             contact_infos=5, batch_size=7)
+        self.assertEqual(counts, {'advertisers': 2, 'offers': 10, 'users': 5, 'referrals': 30, 'clicks': 20, 'contact_infos': 5})
+        self.assertEqual(UserProfile.objects.filter(user__username__startswith=benchmarks.BENCH_PREFIX).count(), 5)
+        result = benchmarks.run_scenarios(funnels=3)
+        self.assertEqual((result['funnels'], result['requests'], result['errors']), (3, 12, 0))
+        self.assertEqual(set(result['steps_ms']), {'index', 'offer_detail', 'grab_offer', 'postback'})
+        benchmarks.flush_dataset()
+        self.assertEqual(set(benchmarks.dataset_counts().values()), {0})
+
+    def test_scenarios_need_a_dataset(self):
+        with self.assertRaises(ValueError):
+            benchmarks.run_scenarios(funnels=1)
+
+
+class ClickFraudTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.state_file = os.path.join(self.root, 'fraud_state.json')
+
+    def _engine(self, **rules):
+        return ClickFraudEngine(rules={**{name: dict(rule) for name, rule in fraud.DEFAULT_RULES.items()}, **rules},
+                                state_file=self.state_file, snapshot_interval=0)
+
+    def test_velocity_flags_then_discards(self):
+        engine = self._engine()
+        actions = [engine.score_click('10.0.0.1', 'session', 1, now=1000 + i * 0.1).action for i in range(20)]
+        self.assertEqual(actions[:10], ['allow'] * 10)
+        self.assertIn('flag', actions)
+        self.assertEqual(actions[-1], 'discard')
+        # Outside the window the IP starts over
+        self.assertEqual(engine.score_click('10.0.0.1', 'other', 2, now=2000).action, 'allow')
+
+    def test_click_conversion_ratio_and_idle_referrals_are_pruned(self):
+        engine = self._engine(referral_click_conversion_ratio={'limit': 3, 'min_clicks': 4, 'weight': 1.0, 'idle': 100})
+        for i in range(4):
+            verdict = engine.score_click(f'10.0.{i}.1', None, 7, now=1000)
+        self.assertEqual(verdict.reasons, ['referral_click_conversion_ratio'])
+        engine.record_conversion(7, now=1000)
+        engine.record_conversion(7, now=1000)
+        self.assertNotIn('referral_click_conversion_ratio', engine.score_click('10.0.9.1', None, 7, now=1000).reasons)
+        engine.score_click('10.0.9.2', None, 8, now=1050)
+        engine._sweep(1120)
+        self.assertEqual(set(engine._referral_totals), {8})
+
+    def test_snapshot_round_trips_without_leaving_temporary_files(self):
+        engine = self._engine()
+        engine.score_click('10.0.0.1', 'session', 3, now=time.time())
+        engine.record_conversion(3)
+        engine.snapshot()
+        self.assertEqual(os.listdir(self.root), [f'fraud_state.json.{os.getpid()}'])
+        restored = self._engine()
+        restored._ensure_loaded()
+        self.assertEqual(restored.stats()['referrals_tracked'], 1)
+        self.assertEqual(restored._referral_totals[3][:2], [1, 1])
+        self.assertEqual(list(restored._velocity['referral']), [3])
+
+    def test_worker_snapshots_are_merged_on_load(self):
+        now = time.time()
+        first, second = self._engine(), self._engine()
+        for i in range(3):
+            first.score_click('10.0.0.1', 'a', 3, now=now + i)
+        second.score_click('10.0.0.2', 'b', 3, now=now + 10)
+        second.score_click('10.0.0.1', 'b', 4, now=now + 11)
+        first.snapshot(f'{self.state_file}.101')
+        second.snapshot(f'{self.state_file}.102')
+        # A worker restarted from both files, then snapshotted itself
+        restored = self._engine()
+        restored._ensure_loaded()
+        self.assertEqual(len(restored._velocity['referral'][3]), 4)
+        self.assertEqual(list(restored._ip_referrals['10.0.0.1']), [3, 4])
+        restored.snapshot(f'{self.state_file}.103')
+        merged_again = self._engine()
+        merged_again._ensure_loaded()
+        # History shared by several files is not counted twice
+        self.assertEqual(len(merged_again._velocity['referral'][3]), 4)
+        self.assertEqual(merged_again._referral_totals[3][0], 3)
+
+    def test_snapshots_of_stopped_workers_are_pruned(self):
+        stale = f'{self.state_file}.101'
+        self._engine().snapshot(stale)
+        os.utime(stale, (time.time() - 3600, time.time() - 3600))
+        engine = ClickFraudEngine(state_file=self.state_file, snapshot_interval=60)
+        engine._ensure_loaded()
+        engine.snapshot()
+        self.assertEqual(os.listdir(self.root), [f'fraud_state.json.{os.getpid()}'])
+
+    def test_unwritable_snapshot_is_logged(self):
+        engine = self._engine()
+        with self.assertLogs('offers.fraud', 'ERROR'):
+            engine.snapshot(os.path.join(self.root, 'missing', 'fraud_state.json'))
+
+    def test_only_converted_postbacks_count_as_conversions(self):
+        advertiser = Advertiser.objects.create(name='Acme')
+        offer = Offer.objects.create(name='Card', price=1, advertiser=advertiser)
+        referral = Referral.objects.create(offer=offer, visitor_identifier='visitor')
+        click_fraud_engine.reset()
+        self.addCleanup(click_fraud_engine.reset)
+        self.client.post('/postback/', benchmarks.signed_postback(advertiser.id, advertiser.postback_secret, referral.id, 'clicked'))
+        self.assertEqual(click_fraud_engine.stats()['referrals_tracked'], 0)
+        self.client.post('/postback/', benchmarks.signed_postback(advertiser.id, advertiser.postback_secret, referral.id, 'converted'))
+        self.assertEqual(click_fraud_engine._referral_totals[referral.id][:2], [0, 1])
+
+
+class ReconciliationTests(TestCase):
+    def setUp(self):
+        self.acme = Advertiser.objects.create(name='Acme')
+        offer = Offer.objects.create(name='Card', price=1, advertiser=self.acme)
+        self.user = User.objects.create_user('dave', 'dave@example.com', 'correct-horse-battery')
+        clicked_at = timezone.now() - timedelta(days=1)
+        # Clicked twice, converted two hours after the first click
+        self.converted = Referral.objects.create(offer=offer, user=self.user, working_state='converted', click_count=2)
+        self._click(self.converted, clicked_at)
+        self._click(self.converted, clicked_at + timedelta(minutes=5))
+        Referral.objects.filter(id=self.converted.id).update(updated_at=clicked_at + timedelta(hours=2))
+        # Converted by postback without any click, and counting fewer clicks than recorded
+        self.unclicked = Referral.objects.create(offer=offer, visitor_identifier='v1', working_state='converted')
+        self.undercounted = Referral.objects.create(offer=offer, visitor_identifier='v2', click_count=0)
+        self._click(self.undercounted, clicked_at)
+        # Only a flagged click, plus a lead
+        self.flagged = Referral.objects.create(offer=offer, visitor_identifier='v3')
+        self._click(self.flagged, clicked_at, flagged=True)
+        ContactInfo.objects.create(offer=offer, referral=self.flagged, name='Lead', email='lead@example.com', mobile='+919800000001')
+        # An approved proof for an offer the user has no referral for
+        other = Offer.objects.create(name='Loan', price=1)
+        self.orphan = ConversionProof.objects.create(user=self.user, offer=other, image='conversion_proofs/p.png', status='approved')
+
+    def _click(self, referral, clicked_at, flagged=False):
+        ip_address = f'10.0.0.{ReferralClick.objects.count() + 1}'
+        click = ReferralClick.objects.create(referral=referral, ip_address=ip_address, flagged=flagged)
+        ReferralClick.objects.filter(id=click.id).update(clicked_at=clicked_at)
+
+    def test_report_counts_funnel_lag_and_mismatches(self):
+        # One row per query, so keyset pagination is exercised
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            report = reconciliation.reconcile(chunk_size=1)
+        totals = report['totals']
+        self.assertEqual((totals['referrals'], totals['click_rows'], totals['converted']), (4, 4, 2))
+        self.assertEqual(report['mismatch_samples']['conversion_without_click'], [self.unclicked.id])
+        self.assertEqual(report['mismatch_samples']['click_count_below_recorded_clicks'], [self.undercounted.id])
+        self.assertEqual(report['mismatch_samples']['flagged_clicks_only'], [self.flagged.id])
+        self.assertEqual(report['mismatch_samples']['lead_without_click'], [self.flagged.id])
+        self.assertEqual(report['mismatch_samples']['approved_proofs_without_referral'], [self.orphan.id])
+        row, = report['advertisers']
+        self.assertEqual(row['advertiser'], 'Acme')
+        self.assertEqual(row['funnel'], {'referrals': 4, 'clicked': 2, 'leads': 1, 'postback_converted': 2,
+                                         'proof_approved': 0, 'converted': 2})
+        self.assertEqual((row['clicks'], row['flagged_clicks'], row['conversion_rate']), (3, 1, 1.0))
+        self.assertEqual((row['lag_hours']['count'], row['lag_hours']['p50']), (1, 2.0))
+        self.assertEqual(row['lag_hours']['histogram'], [0, 1, 0, 0, 0, 0, 0])
+
+    def test_command_writes_the_report_and_rejects_bad_dates(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'report.json')
+        out = io.StringIO()
+        call_command('reconcile_conversions', output=path, since=str(timezone.now().date() - timedelta(days=2)), stdout=out)
+        self.assertIn('referrals=4, clicks=4, converted=2, conversions without click=1', out.getvalue())
+        with open(path) as fh:
+            self.assertEqual(json.load(fh)['totals']['referrals'], 4)
+        with self.assertRaises(CommandError):
+            call_command('reconcile_conversions', since='yesterday')
+
+    def test_since_is_a_range_on_the_indexed_columns(self):
+        old = Referral.objects.create(offer=self.converted.offer, visitor_identifier='old')
+        Referral.objects.filter(id=old.id).update(created_at=timezone.now() - timedelta(days=30))
+        self._click(old, timezone.now() - timedelta(days=30))
+        with CaptureQueriesContext(connection) as queries:
+            report = reconciliation.reconcile(since=timezone.localdate() - timedelta(days=2))
+        self.assertEqual((report['totals']['referrals'], report['totals']['click_rows']), (4, 4))
+        self.assertFalse([q['sql'] for q in queries if 'django_datetime_cast_date' in q['sql']])
+
+    def test_empty_database(self):
+        Referral.objects.all().delete()
+        ConversionProof.objects.all().delete()
+        report = reconciliation.reconcile()
+        self.assertEqual((report['totals']['referrals'], report['advertisers']), (0, []))
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'correct-horse-battery')
+        self.bob = User.objects.create_user('bob', 'bob@example.com', 'correct-horse-battery')
+        self.card = Offer.objects.create(name='Card', price=1, cashback_amount=Decimal('12.50'))
+        self.loan = Offer.objects.create(name='Loan', price=1, cashback_amount=Decimal('4.00'))
+
+    def test_cashback_is_credited_once_per_user_and_offer(self):
+        # Saving a converted referral posts through the post_save signal
+        referral = Referral.objects.create(user=self.alice, offer=self.card, working_state='converted')
+        self.assertEqual(ledger.get_balance(self.alice), Decimal('12.50'))
+        # A proof for the same offer, or the postback again, credits nothing more
+        proof = ConversionProof.objects.create(user=self.alice, offer=self.card, image='conversion_proofs/p.png', status='approved')
+        self.assertEqual(ledger.post_approved_proofs([proof]), 0)
+        self.assertIsNone(ledger.post_referral_conversion(referral))
+        self.assertEqual(ledger.get_balance(self.alice), Decimal('12.50'))
+        self.assertEqual(LedgerTransaction.objects.filter(kind='cashback').count(), 1)
+        self.assertEqual(ledger.check_balances(), ([], 0))
+
+    def test_nothing_is_posted_without_an_amount_or_a_user(self):
+        free = Offer.objects.create(name='Free', price=1)
+        self.assertIsNone(ledger.post_cashback(self.alice.id, free))
+        self.assertIsNone(ledger.post_cashback(None, self.card))
+        pending = Referral.objects.create(user=self.alice, offer=self.card)
+        self.assertIsNone(ledger.post_referral_conversion(pending))
+        self.assertEqual(ledger.get_balance(self.alice), Decimal('0.00'))
+
+    def test_rebuild_repairs_drifted_snapshots(self):
+        ledger.post_cashback(self.alice.id, self.card)
+        ledger.post_cashback(self.alice.id, self.loan)
+        ledger.post_cashback(self.bob.id, self.loan)
+        UserBalance.objects.filter(user=self.alice).update(balance=Decimal('1.00'))
+        UserBalance.objects.filter(user=self.bob).delete()
+        self.assertEqual(sorted(ledger.check_balances()[0]), [self.alice.id, self.bob.id])
+        self.assertEqual(ledger.rebuild_balances(), 2)
+        self.assertEqual(ledger.check_balances(), ([], 0))
+        balance = UserBalance.objects.get(user=self.alice)
+        self.assertEqual((balance.balance, balance.lifetime_earned), (Decimal('16.50'), Decimal('16.50')))
+
+    def test_payout_batch_debits_eligible_balances(self):
+        ledger.post_cashback(self.alice.id, self.card)
+        ledger.post_cashback(self.bob.id, self.loan)
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        with self.captureOnCommitCallbacks(execute=True):
+            batch = ledger.create_payout_batch(minimum='10.00', output_dir=output_dir)
+        self.assertEqual((batch.payout_count, batch.total_amount), (1, Decimal('12.50')))
+        self.assertEqual(list(Payout.objects.values_list('user_id', 'amount')), [(self.alice.id, Decimal('12.50'))])
+        with open(batch.file_path) as fh:
+            self.assertEqual(fh.read().splitlines()[1], f'{batch.id},{self.alice.id},alice,alice@example.com,12.50')
+        self.assertEqual(ledger.get_balance(self.alice), Decimal('0.00'))
+        self.assertEqual(ledger.get_balance(self.bob), Decimal('4.00'))
+        self.assertEqual(UserBalance.objects.get(user=self.alice).lifetime_earned, Decimal('12.50'))
+        self.assertEqual(ledger.check_balances(), ([], 0))
+        self.assertEqual(LedgerEntry.objects.filter(account='payout_clearing').get().amount, Decimal('12.50'))
+        # Nobody is left above the minimum
+        self.assertIsNone(ledger.create_payout_batch(minimum='10.00', output_dir=output_dir))
+
+    def test_payout_file_is_not_written_when_the_batch_rolls_back(self):
+        ledger.post_cashback(self.alice.id, self.card)
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                batch = ledger.create_payout_batch(minimum='10.00', output_dir=output_dir)
+                raise RuntimeError('failed after the batch')
+        self.assertEqual(callbacks, [])
+        self.assertEqual(os.listdir(output_dir), [])
+        self.assertFalse(PayoutBatch.objects.filter(pk=batch.pk).exists())
+        self.assertEqual(ledger.get_balance(self.alice), Decimal('12.50'))
+
+    def test_batch_admin_links_to_its_payouts(self):
+        ledger.post_cashback(self.alice.id, self.card)
+        ledger.post_cashback(self.bob.id, self.card)
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        batch = ledger.create_payout_batch(minimum='10.00', output_dir=output_dir)
+        self.client.force_login(User.objects.create(username='staff', is_staff=True, is_superuser=True))
+        response = self.client.get(f'/admin/offers/payoutbatch/{batch.id}/change/')
+        self.assertContains(response, f'/admin/offers/payout/?batch__id__exact={batch.id}')
+        response = self.client.get(f'/admin/offers/payout/?batch__id__exact={batch.id}')
+        self.assertEqual(sorted(payout.user_id for payout in response.context['cl'].result_list), [self.alice.id, self.bob.id])
+
+
+class ReferralGraphTests(TestCase):
+    def setUp(self):
+        self.users = {name: User.objects.create(username=name, email=f'{name}@example.com') for name in 'abcde'}
+
+    def _closure(self):
+        names = {user.id: name for name, user in self.users.items()}
+        return sorted((names[a], names[d], depth) for a, d, depth in UserAncestry.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+
+    def test_attaching_materializes_every_ancestor(self):
+        a, b, c, d = (self.users[name] for name in 'abcd')
+        self.assertTrue(referral_graph.attach(b, a))
+        # c already has d below it; attaching c links d to a and b too
+        self.assertTrue(referral_graph.attach(d, c))
+        self.assertTrue(referral_graph.attach(c, b))
+        self.assertEqual(self._closure(), [('a', 'b', 1), ('a', 'c', 2), ('a', 'd', 3), ('b', 'c', 1), ('b', 'd', 2), ('c', 'd', 1)])
+        self.assertEqual(referral_graph.downline_counts(a), {1: 1, 2: 1, 3: 1})
+        self.assertEqual(referral_graph.ancestors(d), [c, b, a])
+        self.assertEqual(UserProfile.objects.get(user=d).referred_by, c)
+
+    def test_cycles_second_referrers_and_self_referrals_are_refused(self):
+        a, b, c = (self.users[name] for name in 'abc')
+        referral_graph.attach(b, a)
+        referral_graph.attach(c, b)
+        with self.assertLogs('offers.referral_graph', 'WARNING'):
+            self.assertFalse(referral_graph.attach(a, c))
+        self.assertFalse(referral_graph.attach(c, a))
+        self.assertFalse(referral_graph.attach(a, a))
+        self.assertFalse(referral_graph.attach(a, None))
+        self.assertEqual(len(self._closure()), 3)
+
+    @override_settings(REFERRAL_GRAPH_MAX_DEPTH=2)
+    def test_depth_limit_and_rebuild(self):
+        chain = [self.users[name] for name in 'abcde']
+        for parent, child in zip(chain, chain[1:]):
+            referral_graph.attach(child, parent)
+        incremental = self._closure()
+        self.assertEqual(max(depth for _, _, depth in incremental), 2)
+        # Ancestry beyond the stored depth is still found
+        self.assertTrue(referral_graph.is_ancestor(chain[0].id, chain[4].id))
+        self.assertFalse(referral_graph.attach(chain[0], chain[4]))
+        UserAncestry.objects.all().delete()
+        self.assertEqual(referral_graph.rebuild(), len(incremental))
+        self.assertEqual(self._closure(), incremental)
+
+    def test_signing_up_from_a_referral_link_joins_the_downline(self):
+        a, b = self.users['a'], self.users['b']
+        referral = Referral.objects.create(user=a, offer=Offer.objects.create(name='Card', price=1))
+        request = RequestFactory().get('/')
+        request.session = {referral_graph.SESSION_KEY: referral.id}
+        user_signed_up.send(sender=User, request=request, user=b)
+        self.assertEqual(self._closure(), [('a', 'b', 1)])
+        self.assertEqual(UserProfile.objects.get(user=b).referred_via, referral)
+        self.assertNotIn(referral_graph.SESSION_KEY, request.session)
+
+    def test_earnings_by_level(self):
+        a, b, c = (self.users[name] for name in 'abc')
+        referral_graph.attach(b, a)
+        referral_graph.attach(c, b)
+        ledger.post_cashback(b.id, Offer.objects.create(name='Card', price=1, cashback_amount=Decimal('5.00')))
+        ledger.post_cashback(c.id, Offer.objects.create(name='Loan', price=1, cashback_amount=Decimal('2.50')))
+        self.assertEqual(referral_graph.downline(a), [
+            {'depth': 1, 'users': 1, 'earning_users': 1, 'earnings': Decimal('5.00')},
+            {'depth': 2, 'users': 1, 'earning_users': 1, 'earnings': Decimal('2.50')},
+        ])
+
+
+class OfferRankingTests(TestCase):
+    def setUp(self):
+        self.plain = Offer.objects.create(name='Plain card', price=1, category='finance')
+        self.popular = Offer.objects.create(name='Popular card', price=1, category='finance', cashback_amount=Decimal('50.00'))
+        self.shoes = Offer.objects.create(name='Running shoes', price=1, category='ecommerce')
+        for i in range(30):
+            Referral.objects.create(offer=self.popular, visitor_identifier=f'v{i}', working_state='converted', click_count=1)
+        offer_index.build()
+        ranking.offer_ranking.refresh()
+
+    def _request(self, user=None):
+        request = RequestFactory().get('/')
+        request.user = user or AnonymousUser()
+        request.session = SessionStore()
+        return request
+
+    def test_unfiltered_listing_is_the_precomputed_ranking(self):
+        request = self._request()
+        variant, ids, facets = ranking.rank_search(request)
+        self.assertEqual(variant, 'balanced')
+        self.assertIs(ids, ranking.offer_ranking.ordering(variant)[0])
+        self.assertEqual(ids[0], self.popular.id)
+        self.assertEqual({row['value'] for row in facets['category']}, {'finance', 'ecommerce'})
+
+    def test_search_rankings_are_cached_until_the_catalog_changes(self):
+        request = self._request()
+        _, first, _ = ranking.rank_search(request, 'card')
+        self.assertEqual(first, [self.popular.id, self.plain.id])
+        self.assertIs(ranking.rank_search(request, 'card')[1], first)
+        self.assertEqual(ranking.rank_search(request, '', {'category': 'finance'})[1], first)
+        self.plain.name = 'Plain loan'
+        self.plain.save()
+        self.assertEqual(ranking.rank_search(request, 'card')[1], [self.popular.id])
+
+    def test_personal_boost_and_control_variant(self):
+        user = User.objects.create(username='erin')
+        Referral.objects.create(offer=self.shoes, user=user)
+        ranking.offer_ranking.refresh()
+        # Shoes outrank the plain card for a user who has referred an ecommerce offer
+        _, ids, _ = ranking.rank_search(self._request(user))
+        self.assertLess(ids.index(self.shoes.id), ids.index(self.plain.id))
+        _, ids, _ = ranking.rank_search(self._request())
+        self.assertLess(ids.index(self.plain.id), ids.index(self.shoes.id))
+        with override_settings(RANKING_VARIANTS={'control': {'share': 1}}):
+            variant, ids, _ = ranking.rank_search(self._request(), 'card')
+        self.assertEqual((variant, ids), ('control', [self.plain.id, self.popular.id]))
+
+    def test_offers_newer_than_the_ranking_follow_it(self):
+        _, ranked = ranking.rank_offers(self._request(), [self.shoes.id, 999, self.popular.id])
+        self.assertEqual(ranked, [self.popular.id, self.shoes.id, 999])
+
+    def test_requests_only_read_the_published_snapshot(self):
+        cold = ranking.OfferRanking()
+        started = threading.Event()
+        cold._refresh_in_background = started.set
+        self.addCleanup(setattr, ranking, 'offer_ranking', ranking.offer_ranking)
+        ranking.offer_ranking = cold
+        with override_settings(RANKING_BACKGROUND_REFRESH=True):
+            # Nothing published yet: catalogue order, and the refresh runs in the background
+            with self.assertNumQueries(0):
+                self.assertEqual(ranking.rank_offers(self._request(), personalize=False)[1],
+                                 [self.plain.id, self.popular.id, self.shoes.id])
+            self.assertTrue(started.wait(5))
+            cold.refresh()
+            cold._refreshing = False
+            with self.assertNumQueries(0):
+                self.assertEqual(ranking.rank_offers(self._request(), personalize=False)[1][0], self.popular.id)
+            # A catalog change schedules a refresh; the published scores are served meanwhile
+            started.clear()
+            self.plain.save()
+            with self.assertNumQueries(0):
+                self.assertEqual(ranking.rank_offers(self._request(), personalize=False)[1][0], self.popular.id)
+            self.assertTrue(started.wait(5))
+
+    def test_referred_categories_are_cached_in_process(self):
+        user = User.objects.create(username='erin')
+        Referral.objects.create(offer=self.shoes, user=user)
+        self.assertEqual(ranking.user_categories(user), {'ecommerce'})
+        with self.assertNumQueries(0):
+            self.assertEqual(ranking.user_categories(user), {'ecommerce'})
+        Referral.objects.create(offer=self.plain, user=user)
+        self.assertEqual(ranking.user_categories(user), {'ecommerce', 'finance'})
+
+
+@enforce_view_budgets
+class PostbackAuthTests(TestCase):
+    def setUp(self):
+        self.acme = Advertiser.objects.create(name='Acme')
+        self.offer = Offer.objects.create(name='Card', price=1, advertiser=self.acme)
+        self.referral = Referral.objects.create(offer=self.offer, visitor_identifier='visitor')
+
+    def _post(self, data):
+        return self.client.post('/postback/', data)
+
+    def _signed(self, state='clicked', advertiser=None, referral_id=None):
+        advertiser = advertiser or self.acme
+        return benchmarks.signed_postback(advertiser.id, advertiser.postback_secret, referral_id or self.referral.id, state)
+
+    def test_signed_postback_is_accepted_once(self):
+        data = self._signed()
+        self.assertEqual(self._post(data).status_code, 200)
+        self.referral.refresh_from_db()
+        self.assertEqual((self.referral.working_state, self.referral.click_count), ('clicked', 1))
+        # The used signature is a UsedToken row, so no worker accepts it again
+        self.assertTrue(UsedToken.objects.filter(key=f"{REPLAY_KIND}:{data['signature']}").exists())
+        self.assertEqual(self._post(data).status_code, 401)
+        with self.assertRaisesMessage(PostbackAuthError, 'replayed signature'):
+            verify_postback(data)
+
+    def test_forged_stale_and_incomplete_postbacks_are_refused(self):
+        forged = {**self._signed(), 'state': 'converted'}
+        self.assertEqual(self._post(forged).status_code, 401)
+        stale = self._signed()
+        with self.assertRaisesMessage(PostbackAuthError, 'timestamp outside replay window'):
+            verify_postback(stale, now=int(stale['timestamp']) + 301)
+        unknown = {**self._signed(), 'advertiser': 999}
+        self.assertEqual(self._post(unknown).status_code, 401)
+        self.assertEqual(self._post({**self._signed(), 'signature': ''}).status_code, 401)
+        self.assertEqual(self._post({'referral_id': self.referral.id}).status_code, 401)
+        self.assertEqual(self.client.get('/postback/').status_code, 400)
+        self.referral.refresh_from_db()
+        self.assertEqual(self.referral.click_count, 0)
+
+    def test_postbacks_only_touch_the_advertisers_own_referrals(self):
+        other = Advertiser.objects.create(name='Other')
+        self.assertEqual(self._post(self._signed(advertiser=other)).status_code, 404)
+        self.assertEqual(self._post(self._signed(state='refunded')).status_code, 400)
+
+    def test_expired_used_tokens_are_purged(self):
+        self.assertTrue(replay.claim('test', 'fresh', 60))
+        self.assertTrue(replay.claim('test', 'old', 60))
+        UsedToken.objects.filter(key='test:old').update(expires_at=timezone.now() - timedelta(seconds=1))
+        # One INSERT, whether or not the token was used before
+        with self.assertNumQueries(1):
+            self.assertFalse(replay.claim('test', 'fresh', 60))
+        out = io.StringIO()
+        call_command('purge_used_tokens', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Deleted 1 expired used tokens')
+        self.assertEqual(list(UsedToken.objects.values_list('key', flat=True)), ['test:fresh'])
+
+    def test_secrets_are_loaded_in_one_query_and_unknown_ids_are_not_kept(self):
+        keys = postback_auth.AdvertiserKeyCache()
+        other = Advertiser.objects.create(name='Other')
+        with self.assertNumQueries(1):
+            self.assertEqual(keys.get(self.acme.id), self.acme.postback_secret)
+            self.assertEqual(keys.get(other.id), other.postback_secret)
+            for forged in range(1000, 1100):
+                self.assertIsNone(keys.get(forged))
+        self.assertEqual(set(keys._keys), {self.acme.id, other.id})
+
+    def test_rotated_secrets_take_effect_immediately(self):
+        old = self._signed()
+        self.acme.postback_secret = 'rotated'
+        self.acme.save()
+        self.assertEqual(self._post(old).status_code, 401)
+        self.assertEqual(self._post(self._signed()).status_code, 200)
+
+
+@enforce_view_budgets
+class OfferLifecycleTests(TestCase):
+    def setUp(self):
+        self.acme = Advertiser.objects.create(name='Acme')
+
+    def _offer(self, **fields):
+        offer = Offer.objects.create(name='Card', price=1, advertiser=self.acme, **fields)
+        # Offer ids are reused between tests; start every counter from the database
+        lifecycle._cache().delete_many([key for _, key, _, _, _ in lifecycle._caps(offer)])
+        return offer
+
+    def _click(self, referral, n):
+        ReferralClick.objects.create(referral=referral, ip_address=f'10.0.1.{n}')
+        lifecycle.record_click(referral.offer)
+
+    def _postback(self, referral, state):
+        return self.client.post('/postback/', benchmarks.signed_postback(self.acme.id, self.acme.postback_secret, referral.id, state))
+
+    def test_click_cap_pauses_the_offer(self):
+        offer = self._offer(click_cap=2)
+        referral = Referral.objects.create(offer=offer, visitor_identifier='v')
+        self._click(referral, 1)
+        self.assertTrue(lifecycle.accepting_traffic(offer))
+        with self.assertLogs('offers.lifecycle', 'WARNING'):
+            self._click(referral, 2)
+        offer.refresh_from_db()
+        self.assertEqual((offer.is_active, offer.paused_reason), ('inactive', 'click_cap'))
+        self.assertEqual(lifecycle.reached_cap(offer), 'click_cap')
+
+    def test_click_counters_are_seeded_from_counted_clicks(self):
+        offer = self._offer(click_cap=3, daily_click_cap=3)
+        # Postbacks raise click_count without being clicks
+        referral = Referral.objects.create(offer=offer, visitor_identifier='v', click_count=40)
+        ReferralClick.objects.create(referral=referral, ip_address='10.0.1.1')
+        ReferralClick.objects.create(referral=referral, ip_address='10.0.1.2', flagged=True)
+        self.assertIsNone(lifecycle.reached_cap(offer, exact=True))
+        self.assertEqual(lifecycle._cache().get(lifecycle._key(offer.id, 'clicks')), 1)
+
+    def test_resent_conversions_count_once(self):
+        offer = self._offer(conversion_cap=5)
+        referral = Referral.objects.create(offer=offer, visitor_identifier='v')
+        for _ in range(3):
+            self.assertEqual(self._postback(referral, 'converted').status_code, 200)
+        self.assertEqual(lifecycle._cache().get(lifecycle._key(offer.id, 'conversions')), 1)
+        # A late 'clicked' postback neither reverts the state nor moves the conversion time
+        converted_at = Referral.objects.get(id=referral.id).updated_at
+        self._postback(referral, 'clicked')
+        referral.refresh_from_db()
+        self.assertEqual((referral.working_state, referral.updated_at, referral.click_count), ('converted', converted_at, 4))
+
+    def test_conversion_cap_pauses_and_resumes_when_raised(self):
+        offer = self._offer(conversion_cap=1)
+        referral = Referral.objects.create(offer=offer, visitor_identifier='v')
+        with self.assertLogs('offers.lifecycle', 'WARNING'):
+            self._postback(referral, 'converted')
+        offer.refresh_from_db()
+        self.assertEqual(offer.paused_reason, 'conversion_cap')
+        self.assertEqual(lifecycle.apply_schedule()['resumed'], 0)
+        Offer.objects.filter(id=offer.id).update(conversion_cap=2)
+        self.assertEqual(lifecycle.apply_schedule()['resumed'], 1)
+        self.assertEqual(Offer.objects.get(id=offer.id).is_active, 'active')
+
+    def test_schedule_starts_and_ends_offers(self):
+        now = timezone.now()
+        ended = self._offer(ends_at=now - timedelta(hours=1))
+        upcoming = self._offer(starts_at=now + timedelta(hours=1))
+        self.assertEqual(lifecycle.out_of_window(upcoming, now), 'scheduled')
+        self.assertFalse(lifecycle.accepting_traffic(ended, now))
+        version = catalog.version
+        self.assertEqual(lifecycle.apply_schedule(now), {'ended': 1, 'scheduled': 1, 'started': 0, 'resumed': 0})
+        self.assertGreater(catalog.version, version)
+        self.assertEqual(Offer.objects.get(id=upcoming.id).paused_reason, 'scheduled')
+        changes = lifecycle.apply_schedule(now + timedelta(hours=2))
+        self.assertEqual((changes['started'], Offer.objects.get(id=upcoming.id).is_active), (1, 'active'))
+        self.assertEqual(Offer.objects.get(id=ended.id).paused_reason, 'ended')
+
+
+@override_settings(TRUSTED_PROXIES=['127.0.0.1', '::1', '10.0.0.0/8'])
+class IPIntelTests(TestCase):
+    def test_client_ip_is_the_first_untrusted_hop_from_the_right(self):
+        meta = {'REMOTE_ADDR': '127.0.0.1', 'HTTP_X_FORWARDED_FOR': '6.6.6.6, 203.0.113.5, 10.0.0.2'}
+        self.assertEqual(ipintel.client_ip(meta), '203.0.113.5')
+
+    def test_forwarded_for_from_an_untrusted_peer_is_ignored(self):
+        meta = {'REMOTE_ADDR': '198.51.100.7', 'HTTP_X_FORWARDED_FOR': '6.6.6.6'}
+        self.assertEqual(ipintel.client_ip(meta), '198.51.100.7')
+
+    def test_garbage_hop_stops_at_the_last_trusted_address(self):
+        meta = {'REMOTE_ADDR': '127.0.0.1', 'HTTP_X_FORWARDED_FOR': '6.6.6.6, not-an-ip, 10.0.0.2'}
+        self.assertEqual(ipintel.client_ip(meta), '10.0.0.2')
+        self.assertEqual(ipintel.client_ip({'REMOTE_ADDR': '127.0.0.1', 'HTTP_X_FORWARDED_FOR': ' , '}), '127.0.0.1')
+        self.assertEqual(ipintel.client_ip({'REMOTE_ADDR': 'unix-socket'}), 'unix-socket')
+
+    def test_ipv6_chain(self):
+        meta = {'REMOTE_ADDR': '::1', 'HTTP_X_FORWARDED_FOR': '2001:db8::1, 10.0.0.2'}
+        self.assertEqual(ipintel.client_ip(meta), '2001:db8::1')
+
+    def _database(self, filename, content):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        source = os.path.join(root, filename)
+        with open(source, 'w') as fh:
+            fh.write(content)
+        output = os.path.join(root, 'geoip')
+        counts = ipintel.build_database(source, output)
+        return counts, ipintel.IPDatabase(output)
+
+    def test_lookup_ip2asn_ranges(self):
+        counts, database = self._database('ip2asn.tsv', (
+            '1.0.0.0\t1.0.0.255\t13335\tUS\tCLOUDFLARENET\n'
+            '2.0.0.0\t2.0.0.255\t0\tNone\tNot routed\n'
+            '2001:db8::\t2001:db8:ffff:ffff:ffff:ffff:ffff:ffff\t64500\tDE\tEXAMPLE\n'
+        ))
+        self.assertEqual(counts, {4: 2, 6: 1})
+        self.assertEqual(database.lookup('1.0.0.7'), ('US', 13335))
+        self.assertEqual(database.lookup('2.0.0.1'), ('', None))
+        self.assertEqual(database.lookup('2001:db8::42'), ('DE', 64500))
+        self.assertEqual(database.lookup('1.0.1.0'), ipintel.NO_MATCH)
+        self.assertEqual(database.lookup('0.0.0.1'), ipintel.NO_MATCH)
+        self.assertEqual(database.lookup('garbage'), ipintel.NO_MATCH)
+
+    def test_overlapping_ranges_resolve_to_the_most_specific(self):
+        _, database = self._database('ranges.csv', (
+            'network,country,asn\n'
+            '10.0.0.0/8,US,100\n'
+            '10.1.0.0/16,CA,200\n'
+            '10.1.2.0/24,MX,AS300\n'
+            '10.200.0.0/16,FR,400\n'
+        ))
+        self.assertEqual(database.lookup('10.1.2.3'), ('MX', 300))
+        self.assertEqual(database.lookup('10.1.3.1'), ('CA', 200))
+        # Past the end of the nested ranges, the enclosing block still matches
+        self.assertEqual(database.lookup('10.2.0.1'), ('US', 100))
+        self.assertEqual(database.lookup('10.200.0.1'), ('FR', 400))
+        self.assertEqual(database.lookup('10.255.255.255'), ('US', 100))
+        self.assertEqual(database.lookup('11.0.0.0'), ipintel.NO_MATCH)
+
+    def test_missing_database_is_a_miss(self):
+        with self.assertLogs('offers.ipintel', 'WARNING'):
+            self.assertEqual(ipintel.IPDatabase(os.path.join(tempfile.gettempdir(), 'no-such-geoip')).lookup('1.0.0.1'),
+                             ipintel.NO_MATCH)
+
+
+class LargeTableAdminTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create(username='staff', is_staff=True, is_superuser=True))
+        self.logs = [ApiLog.objects.create(api_name='numverify' if i % 2 else 'abstract', level='ERROR',
+                                           message=f'Timeout talking to provider #{i}') for i in range(5)]
+
+    def _changelist(self, query=''):
+        response = self.client.get(f'/admin/offers/apilog/{query}')
+        self.assertEqual(response.status_code, 200)
+        return response.context['cl']
+
+    def _ids(self, changelist):
+        return [row.id for row in changelist.result_list]
+
+    def test_paginator_estimates_large_tables_and_bounds_filtered_counts(self):
+        unfiltered = admin_scaling.EstimatedCountPaginator(ApiLog.objects.order_by('-id'), 2)
+        filtered = admin_scaling.EstimatedCountPaginator(ApiLog.objects.filter(level='ERROR').order_by('-id'), 2)
+        with override_settings(ADMIN_ESTIMATED_COUNT_THRESHOLD=1, ADMIN_COUNT_LIMIT=3):
+            # MAX(rowid) on SQLite
+            self.assertEqual((unfiltered.count, unfiltered.estimated), (self.logs[-1].id, True))
+            self.assertEqual((filtered.count, filtered.estimated), (3, True))
+        exact = admin_scaling.EstimatedCountPaginator(ApiLog.objects.filter(api_name='abstract').order_by('-id'), 2)
+        self.assertEqual((exact.count, exact.estimated), (3, False))
+
+    def test_keyset_pages_newest_first(self):
+        model_admin = admin.site._registry[ApiLog]
+        model_admin.list_per_page = 2
+        self.addCleanup(delattr, model_admin, 'list_per_page')
+        newest_first = [log.id for log in reversed(self.logs)]
+
+        changelist = self._changelist()
+        self.assertTrue(changelist.keyset)
+        self.assertEqual(self._ids(changelist), newest_first[:2])
+        self.assertIsNone(changelist.first_page_url)
+        changelist = self._changelist(changelist.next_page_url)
+        self.assertEqual(self._ids(changelist), newest_first[2:4])
+        changelist = self._changelist(changelist.next_page_url)
+        self.assertEqual(self._ids(changelist), newest_first[4:])
+        self.assertIsNone(changelist.next_page_url)
+        self.assertEqual(changelist.first_page_url, '?')
+        # Another ordering falls back to offset pages
+        self.assertFalse(self._changelist('?o=2').keyset)
+
+    def test_search_is_exact_except_for_named_lookups(self):
+        self.assertEqual(len(self._changelist('?q=numverify').result_list), 2)
+        self.assertEqual(len(self._changelist('?q=NumVerify').result_list), 0)
+        self.assertEqual(self._ids(self._changelist('?q=%233')), [self.logs[3].id])
+        self.assertEqual(len(self._changelist('?q=timeout+abstract').result_list), 3)
+
+    def test_date_filter_keeps_rows_saved_out_of_id_order(self):
+        now = timezone.now()
+        ApiLog.objects.filter(id=self.logs[0].id).update(timestamp=now + timedelta(days=2))
+        ApiLog.objects.filter(id=self.logs[1].id).update(timestamp=now + timedelta(days=1))
+        query = '?' + urlencode({'timestamp__gte': str(now + timedelta(hours=12))})
+        self.assertEqual(set(self._ids(self._changelist(query))), {self.logs[0].id, self.logs[1].id})
+        with override_settings(ADMIN_DATE_PK_SLACK=0):
+            # The first row of the period has the larger id, so the other falls below the range
+            self.assertEqual(self._ids(self._changelist(query)), [self.logs[1].id])
+
+
+class OfferRelatedPanelTests(TestCase):
+    def setUp(self):
+        self.offer = Offer.objects.create(name='Card', price=1, advertiser=Advertiser.objects.create(name='Acme'))
+        other = Offer.objects.create(name='Loan', price=1, advertiser=self.offer.advertiser)
+        self.user = User.objects.create(username='lead')
+        self.leads = [ContactInfo.objects.create(offer=self.offer, name=f'Lead {i}', email=f'lead{i}@example.com',
+                                                 mobile=f'+91980000000{i}') for i in range(5)]
+        ContactInfo.objects.create(offer=other, name='Other', email='other@example.com', mobile='+919800000099')
+        ConversionProof.objects.create(user=self.user, offer=self.offer, image='proof.png')
+        self.staff = User.objects.create(username='staff', is_staff=True)
+        self.staff.user_permissions.set(Permission.objects.filter(codename__in=['view_offer', 'change_offer', 'view_contactinfo']))
+        self.client.force_login(self.staff)
+
+    def _page(self, kind, cursor=''):
+        return self.client.get(f'/admin/offers/offer/{self.offer.id}/related/{kind}/', {'cursor': cursor} if cursor else {})
+
+    def test_change_page_counts_the_panels_it_may_show(self):
+        response = self.client.get(f'/admin/offers/offer/{self.offer.id}/change/')
+        self.assertEqual(response.status_code, 200)
+        panels = {panel['title']: panel['count'] for panel in response.context['related_panels']}
+        # No permission to view proofs or form submissions
+        self.assertEqual(panels, {'Contact info': 5})
+        self.assertEqual(admin.site._registry[Offer].related_counts(self.offer.id),
+                         {'contact_infos': 5, 'google_form_submissions': 0, 'conversion_proofs': 1})
+
+    def test_related_rows_page_newest_first_by_cursor(self):
+        model_admin = admin.site._registry[Offer]
+        model_admin.related_per_page = 2
+        self.addCleanup(delattr, model_admin, 'related_per_page')
+        ids, cursor = [], ''
+        while True:
+            page = self._page('contact_infos', cursor).json()
+            ids += [row['id'] for row in page['results']]
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(ids, [lead.id for lead in reversed(self.leads)])
+        self.assertEqual(page['results'][0]['url'], f'/admin/offers/contactinfo/{self.leads[0].id}/change/')
+
+    def test_unknown_or_forbidden_panels(self):
+        self.assertEqual(self._page('referrals').status_code, 404)
+        self.assertEqual(self._page('conversion_proofs').status_code, 403)
+
+
+class VerificationCodeTests(TestCase):
+    def setUp(self):
+        # Throttle counters live in the process cache and would carry over between tests
+        verification_codes._cache().clear()
+
+    def _wrong(self, code):
+        return f'{(int(code) + 1) % 10 ** 6:06d}'
+
+    def test_code_verifies_once_issued(self):
+        code = verification_codes.issue(' Dave@Example.com ', ip='203.0.113.5')
+        self.assertFalse(verification_codes.is_verified('dave@example.com'))
+        self.assertTrue(verification_codes.check('DAVE@example.com', code))
+        # Checking again is accepted until the code is consumed
+        self.assertTrue(verification_codes.check('dave@example.com', code))
+        self.assertTrue(verification_codes.is_verified('dave@example.com'))
+        verification_codes.consume('dave@example.com')
+        with self.assertRaisesMessage(verification_codes.VerificationError, 'No verification code'):
+            verification_codes.check('dave@example.com', code)
+
+    def test_expired_codes_are_refused_and_purged(self):
+        code = verification_codes.issue('dave@example.com')
+        EmailVerification.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        with self.assertRaisesMessage(verification_codes.VerificationError, 'expired'):
+            verification_codes.check('dave@example.com', code)
+        self.assertFalse(verification_codes.is_verified('dave@example.com'))
+        verification_codes.issue('erin@example.com')
+        self.assertEqual(verification_codes.purge_expired(batch_size=1), 1)
+        self.assertEqual(list(EmailVerification.objects.values_list('email', flat=True)), ['erin@example.com'])
+
+    @override_settings(EMAIL_CODE_MAX_ATTEMPTS=3)
+    def test_wrong_guesses_lock_the_code_until_a_new_one(self):
+        code = verification_codes.issue('dave@example.com')
+        with self.assertLogs('offers.verification_codes', 'WARNING'):
+            for _ in range(3):
+                with self.assertRaisesMessage(verification_codes.VerificationError, 'Invalid'):
+                    verification_codes.check('dave@example.com', self._wrong(code))
+        with self.assertRaisesMessage(verification_codes.VerificationError, 'Too many wrong codes'):
+            verification_codes.check('dave@example.com', code)
+        code = verification_codes.issue('dave@example.com')
+        self.assertTrue(verification_codes.check('dave@example.com', code))
+
+    @override_settings(EMAIL_CODE_SENDS_PER_EMAIL=2, EMAIL_CODE_SENDS_PER_IP=3, EMAIL_CODE_CHECKS_PER_IP=2)
+    def test_sends_and_checks_are_throttled(self):
+        verification_codes.issue('dave@example.com', ip='203.0.113.5')
+        verification_codes.issue('DAVE@example.com', ip='203.0.113.6')
+        with self.assertLogs('offers.verification_codes', 'WARNING'):
+            with self.assertRaises(verification_codes.Throttled):
+                verification_codes.issue('dave@example.com', ip='203.0.113.7')
+        verification_codes.issue('erin@example.com', ip='203.0.113.5')
+        verification_codes.issue('finn@example.com', ip='203.0.113.5')
+        with self.assertLogs('offers.verification_codes', 'WARNING'):
+            with self.assertRaises(verification_codes.Throttled):
+                verification_codes.issue('gail@example.com', ip='203.0.113.5')
+
+        code = verification_codes.issue('hana@example.com')
+        with self.assertLogs('offers.verification_codes', 'WARNING'):
+            with self.assertRaises(verification_codes.VerificationError):
+                verification_codes.check('hana@example.com', self._wrong(code), ip='198.51.100.1')
+            self.assertTrue(verification_codes.check('hana@example.com', code, ip='198.51.100.1'))
+            with self.assertRaises(verification_codes.Throttled):
+                verification_codes.check('hana@example.com', code, ip='198.51.100.1')
+        self.assertTrue(verification_codes.check('hana@example.com', code, ip='198.51.100.2'))
+
+
+class CaptchaTests(TestCase):
+    def _answer(self, challenge, right=True):
+        _, nonce, _ = challenge['token'].split('.')
+        correct = captcha._challenge(nonce)[1]
+        return {'captcha_token': challenge['token'], 'captcha_image': str(correct if right else (correct + 1) % len(challenge['tiles']))}
+
+    def test_challenge_shows_distinct_tiles_from_its_own_image(self):
+        challenge = captcha.issue(7)
+        self.assertEqual(len(challenge['tiles']), 6)
+        self.assertEqual(len({(tile['x'], tile['y']) for tile in challenge['tiles']}), 6)
+        self.assertTrue(challenge['description'].startswith('Select the '))
+        response = self.client.get(challenge['image_url'])
+        self.assertEqual((response.status_code, response['Content-Type']), (200, 'image/png'))
+        self.assertTrue(response['Cache-Control'].startswith('private'))
+        # Another challenge is drawn afresh, even where it shows the same shapes
+        self.assertNotEqual(self.client.get(captcha.issue(7)['image_url']).content, response.content)
+
+    def test_image_urls_are_signed_and_expire(self):
+        url = captcha.issue(7)['image_url']
+        forged = url[:-5] + ('1' if url[-5] == '0' else '0') + '.png'
+        self.assertEqual(self.client.get(forged).status_code, 404)
+        self.assertEqual(self.client.get('/captcha/garbage.png').status_code, 404)
+        with override_settings(CAPTCHA_TTL=-1):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_a_right_answer_is_accepted_once(self):
+        answer = self._answer(captcha.issue(7))
+        self.assertTrue(captcha.verify(answer, 7))
+        with self.assertLogs('offers.captcha', 'WARNING'):
+            self.assertFalse(captcha.verify(answer, 7))
+
+    def test_a_wrong_answer_uses_up_the_token(self):
+        challenge = captcha.issue(7)
+        self.assertFalse(captcha.verify(self._answer(challenge, right=False), 7))
+        with self.assertLogs('offers.captcha', 'WARNING'):
+            self.assertFalse(captcha.verify(self._answer(challenge), 7))
+
+    def test_used_tokens_are_recorded_in_one_query(self):
+        challenge = captcha.issue(7)
+        with self.assertNumQueries(1):
+            self.assertTrue(captcha.verify(self._answer(challenge), 7))
+        nonce = challenge['token'].split('.')[1]
+        self.assertTrue(UsedToken.objects.filter(key=f'{captcha.REPLAY_KIND}:{nonce}').exists())
+
+    def test_tokens_are_bound_to_scope_and_time(self):
+        answer = self._answer(captcha.issue(7))
+        self.assertFalse(captcha.verify(answer, 8))
+        forged = answer['captcha_token'][:-1] + ('1' if answer['captcha_token'].endswith('0') else '0')
+        self.assertFalse(captcha.verify({**answer, 'captcha_token': forged}, 7))
+        self.assertFalse(captcha.verify({'captcha_token': 'garbage'}, 7))
+        with override_settings(CAPTCHA_TTL=-1):
+            self.assertFalse(captcha.verify(answer, 7))
+        # None of the refusals above used the token up
+        self.assertTrue(captcha.verify(answer, 7))
+
+
+IMPORTTIME = """\
+import time: self [us] | cumulative | imported package
+import time:        50 |         50 |     numpy.core
+import time:       200 |        250 |   numpy
+import time:        40 |         40 |   offers.models
+import time:        30 |        320 | offers.ipintel
+import time:        10 |         10 |   json.decoder
+import time:        20 |         30 | json
+"""
+
+
+class StartupProfileTests(TestCase):
+    def test_parse_importtime_finds_each_importer(self):
+        self.assertEqual(startup.parse_importtime(IMPORTTIME), [
+            ('numpy.core', 50, 50, 'numpy'),
+            ('numpy', 200, 250, 'offers.ipintel'),
+            ('offers.models', 40, 40, 'offers.ipintel'),
+            ('offers.ipintel', 30, 320, None),
+            ('json.decoder', 10, 10, 'json'),
+            ('json', 20, 30, None),
+        ])
+
+    def test_summary_lists_third_party_imports_made_by_the_project(self):
+        summary = startup.summarize_imports(startup.parse_importtime(IMPORTTIME), top=2)
+        self.assertEqual(summary['modules'], 6)
+        self.assertEqual(summary['total_ms'], 0.3)
+        self.assertEqual(summary['packages_ms'], {'numpy': 0.2, 'offers': 0.1})
+        self.assertEqual(summary['project_imports_ms'], [{'module': 'numpy', 'imported_by': 'offers.ipintel', 'ms': 0.2}])
+
+    def test_command_profiles_a_fresh_interpreter(self):
+        out = io.StringIO()
+        call_command('startup_profile', '--runs', '1', '--phase', 'urls', '--json', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(set(report['phases_ms']), {'setup', 'urls'})
+        self.assertIn('offers', report['ready_ms'])
+        self.assertGreater(report['imports']['modules'], 100)
+
+    def test_urlconf_does_not_import_numpy_requests_or_view_only_subsystems(self):
+        probe = ('import sys, django; django.setup(); before = set(sys.modules); import offers.urls; '
+                 'print(" ".join(sorted(set(sys.modules) - before)))')
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'cashback_zone.settings'}
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', probe], capture_output=True, text=True,
+                                   env=env, cwd=str(settings.BASE_DIR), check=True)
+        loaded = set(completed.stdout.split())
+        self.assertIn('offers.views', loaded)
+        self.assertEqual({name for name in loaded if name.split('.')[0] in ('numpy', 'requests')}, set())
+        self.assertEqual(loaded & {'offers.fraud', 'offers.captcha', 'offers.lifecycle', 'offers.ops_health'}, set())
+        # requests itself comes with allauth's socialaccount app during setup; no project module imports it
+        self.assertEqual([(name, importer) for name, _, _, importer in startup.parse_importtime(completed.stderr)
+                          if name.split('.')[0] in ('numpy', 'requests') and startup._is_project(importer)], [])
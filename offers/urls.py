@@ -5,6 +5,7 @@ from django.conf.urls.static import static
 
 urlpatterns = [
     path('', views.index, name='home'),
+    path('search/', views.offer_search, name='offer_search'),
     path('dashboard/', views.user_dashboard, name='dashboard'),
     path('offer/<int:offer_id>/', views.offer_detail, name='offer_detail'),
     path('offer/<int:offer_id>/details/<int:referral_id>/', views.offer_detail, name='offer_detail_with_referral'),
@@ -20,6 +21,9 @@ urlpatterns = [
     path('send-verification-email/', views.send_verification_email, name='send_verification_email'),
     path('verify-email-code/', views.verify_email_code, name='verify_email_code'),
     path('postback/', views.postback, name='postback'),
+    path('metrics/', views.metrics, name='metrics'),
+    path('ops/', views.ops_health, name='ops_health'),
+    path('captcha/<str:key>.png', views.captcha_image, name='captcha_image'),
 ]
 
 urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
@@ -1,12 +1,12 @@
 import logging
-from pyexpat.errors import messages
+from django.contrib import messages
 from django.shortcuts import redirect
-import requests
-import random
 from django.core.mail import send_mail
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from .models import ApiUsage, ApiLog, MobileValidationCache, PendingVerification
+from .metrics import record_cache, registry, track_http
+from . import phone_validation
 
 logger = logging.getLogger(__name__)
 
@@ -55,15 +55,27 @@ def resend_verification_email(request):
 def validate_mobile_number(user, mobile_number):
     username = user.username if user else "anonymous"
 
+    # Numbers that cannot exist are rejected offline instead of spending a paid lookup
+    try:
+        mobile_number = phone_validation.normalize(mobile_number)
+    except phone_validation.InvalidNumber as e:
+        registry.inc('cashback_mobile_prevalidation_rejected_total', {}, help_text='Mobile numbers rejected before the validation APIs')
+        logger.info(f"Mobile number {mobile_number} rejected offline for user {username}: {e}")
+        return False, "Invalid mobile number"
+
+    # requests (with urllib3 and charset_normalizer) is only loaded once a lookup may be needed
+    import requests
+
     # Check cache first
     try:
         cached = MobileValidationCache.objects.get(mobile_number=mobile_number)
+        record_cache('mobile_validation', True)
         message = f"Mobile number {mobile_number} validation retrieved from cache for user {username}: {'Valid' if cached.is_valid else 'Invalid'}"
         logger.info(message)
         ApiLog.objects.create(api_name='cache', message=message, level='INFO')
         return cached.is_valid, "Valid mobile number" if cached.is_valid else "Invalid mobile number"
     except MobileValidationCache.DoesNotExist:
-        pass
+        record_cache('mobile_validation', False)
 
     try:
         api_usage, created = ApiUsage.objects.get_or_create(api_name='numverify')
@@ -74,7 +86,8 @@ def validate_mobile_number(user, mobile_number):
             return validate_with_abstract_api(user, mobile_number)
 
         url = f"https://apilayer.net/api/validate?access_key={settings.NUMVERIFY_API_KEY}&number={mobile_number}&country_code=&format=1"
-        response = requests.get(url, timeout=5)
+        with track_http('numverify'):
+            response = requests.get(url, timeout=5)
         response.raise_for_status()
 
         data = response.json()
@@ -102,16 +115,19 @@ def validate_mobile_number(user, mobile_number):
         return validate_with_abstract_api(user, mobile_number)
 
 def validate_with_abstract_api(user, mobile_number):
+    import requests
+
     username = user.username if user else "anonymous"
 
     try:
         cached = MobileValidationCache.objects.get(mobile_number=mobile_number)
+        record_cache('mobile_validation', True)
         message = f"Mobile number {mobile_number} validation retrieved from cache for user {username}: {'Valid' if cached.is_valid else 'Invalid'}"
         logger.info(message)
         ApiLog.objects.create(api_name='cache', message=message, level='INFO')
         return cached.is_valid, "Valid mobile number" if cached.is_valid else "Invalid mobile number"
     except MobileValidationCache.DoesNotExist:
-        pass
+        record_cache('mobile_validation', False)
 
     try:
         api_usage, created = ApiUsage.objects.get_or_create(api_name='abstract')
@@ -122,7 +138,8 @@ def validate_with_abstract_api(user, mobile_number):
             return False, "Verification pending due to API limits"
 
         url = f"https://phonevalidation.abstractapi.com/v1/?api_key={settings.ABSTRACT_API_KEY}&phone={mobile_number}"
-        response = requests.get(url, timeout=5)
+        with track_http('abstract'):
+            response = requests.get(url, timeout=5)
         response.raise_for_status()
 
         data = response.json()
@@ -0,0 +1,125 @@
+"""
+Email verification codes, kept in the EmailVerification table.
+
+One row per email holds the current code, its expiry, the number of wrong
+guesses and when it was verified, so a check is one lookup by the unique
+email. Issuing a new code replaces the row. Sending and checking are
+throttled per email and per client IP with cache counters that expire with
+EMAIL_CODE_THROTTLE_WINDOW, and expired rows are deleted in batches by
+purge_expired() (python manage.py purge_verification_codes).
+"""
+import logging
+import secrets
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+from django.utils import timezone
+
+from .models import EmailVerification
+
+logger = logging.getLogger(__name__)
+
+
+class VerificationError(Exception):
+    pass
+
+
+class Throttled(VerificationError):
+    pass
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _cache():
+    return caches[_setting('VERIFICATION_THROTTLE_CACHE', 'default')]
+
+
+def _throttle(action, limits):
+    """Count one `action` against each (scope, value, limit); raises Throttled past any limit."""
+    cache = _cache()
+    window = _setting('EMAIL_CODE_THROTTLE_WINDOW', 3600)
+    for scope, value, limit in limits:
+        if not value or not limit:
+            continue
+        key = f'verify-throttle:{action}:{scope}:{value}'
+        cache.add(key, 0, timeout=window)
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # Expired between add and incr: this is the first event of a new window
+            cache.add(key, 1, timeout=window)
+            count = 1
+        if count > limit:
+            logger.warning(f"Verification throttled: action={action}, {scope}={value}")
+            raise Throttled("Too many attempts. Please try again later.")
+
+
+def _normalize(email):
+    return email.strip().lower()
+
+
+def issue(email, ip=None):
+    """Create (or replace) the code for an email and return it; the caller sends it."""
+    email = _normalize(email)
+    _throttle('send', [
+        ('email', email, _setting('EMAIL_CODE_SENDS_PER_EMAIL', 5)),
+        ('ip', ip, _setting('EMAIL_CODE_SENDS_PER_IP', 20)),
+    ])
+    code = f'{secrets.randbelow(10 ** 6):06d}'
+    EmailVerification.objects.update_or_create(email=email, defaults={
+        'code': code,
+        'expires_at': timezone.now() + timezone.timedelta(seconds=_setting('EMAIL_CODE_TTL', 600)),
+        'attempts': 0,
+        'verified_at': None,
+    })
+    return code
+
+
+def check(email, code, ip=None):
+    """Verify a code for an email; raises VerificationError with a message for the user.
+
+    A correct code marks the email verified until the row expires (signup
+    reads that with is_verified()); checking it again is accepted.
+    """
+    email = _normalize(email)
+    _throttle('check', [('ip', ip, _setting('EMAIL_CODE_CHECKS_PER_IP', 50))])
+    now = timezone.now()
+    row = EmailVerification.objects.filter(email=email).values('id', 'code', 'expires_at', 'attempts', 'verified_at').first()
+    if row is None:
+        raise VerificationError("No verification code found for this email.")
+    if row['expires_at'] <= now:
+        raise VerificationError("Verification code has expired.")
+    if row['attempts'] >= _setting('EMAIL_CODE_MAX_ATTEMPTS', 5):
+        raise VerificationError("Too many wrong codes. Please request a new one.")
+    if not secrets.compare_digest(row['code'], str(code).strip()):
+        EmailVerification.objects.filter(id=row['id']).update(attempts=F('attempts') + 1)
+        logger.warning(f"Invalid verification code for {email}: attempt {row['attempts'] + 1}")
+        raise VerificationError("Invalid verification code.")
+    if row['verified_at'] is None:
+        EmailVerification.objects.filter(id=row['id']).update(verified_at=now)
+    return True
+
+
+def is_verified(email):
+    return EmailVerification.objects.filter(
+        email=_normalize(email), verified_at__isnull=False, expires_at__gt=timezone.now(),
+    ).exists()
+
+
+def consume(email):
+    """Forget the code once the verification has been used."""
+    EmailVerification.objects.filter(email=_normalize(email)).delete()
+
+
+def purge_expired(batch_size=1000):
+    """Delete expired rows in batches of batch_size (short transactions); returns the number deleted."""
+    now = timezone.now()
+    total = 0
+    while True:
+        ids = list(EmailVerification.objects.filter(expires_at__lte=now).values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return total
+        total += EmailVerification.objects.filter(id__in=ids).delete()[0]
@@ -2,51 +2,175 @@ from datetime import datetime, timedelta, timezone
 from email import utils
 from django.conf import settings
 from django.shortcuts import render, get_object_or_404, redirect
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse, JsonResponse
 from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib import messages
-from .models import AdBanner, ApiLog, ApiUsage, Offer, Referral, ReferralClick, TutorialVideo, UserProfile, PendingVerification, ContactInfo, GoogleFormSubmission, ConversionProof
+from .models import AdBanner, Offer, Referral, ReferralClick, TutorialVideo, UserProfile, PendingVerification, ContactInfo, GoogleFormSubmission, ConversionProof
 from django.utils.dateparse import parse_datetime
 import json
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
-from allauth.account.models import EmailAddress
-from allauth.account.views import EmailView
-from .forms import ContactInfoForm, CustomSignupForm, UpdateMobileForm
+from .forms import ContactInfoForm, UpdateMobileForm
 from django.db import IntegrityError
-import random
+from django.db.models import F
 from django_ratelimit.decorators import ratelimit
 import logging
 from django.utils.http import urlsafe_base64_decode
 from django.utils.encoding import force_str
 from django.contrib.auth.tokens import default_token_generator
 from django.contrib.auth.models import User
-from allauth.account.views import SignupView
 from django.core.mail import send_mail
-import string
-import time
-
-# CAPTCHA options (simple image-based CAPTCHA with descriptions)
-CAPTCHA_OPTIONS = [
-    {'description': 'Select the image of a tree', 'correct': 'tree.jpg', 'images': ['tree.jpg', 'car.jpg', 'dog.jpg']},
-    {'description': 'Select the image of a car', 'correct': 'car.jpg', 'images': ['tree.jpg', 'car.jpg', 'dog.jpg']},
-    {'description': 'Select the image of a dog', 'correct': 'dog.jpg', 'images': ['tree.jpg', 'car.jpg', 'dog.jpg']},
-]
+from django.core.paginator import Paginator
+# Already loaded with the app registry (signals, forms, admin). Subsystems only
+# some views need (fraud, captcha, lifecycle, postback_auth, ops_health) are
+# imported inside them, so loading the URLconf does not import them.
+from .search import FACETS
+from .ledger import get_balance, post_referral_conversion
+from .ranking import assign_variant, rank_offers, rank_search
+from . import funnel, ipintel, referral_graph, verification_codes
+from itertools import islice
 
 logger = logging.getLogger(__name__)
 
 def get_client_ip(request):
-    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-    if x_forwarded_for:
-        ip = x_forwarded_for.split(',')[0]
+    # X-Forwarded-For is only trusted as far as the TRUSTED_PROXIES chain goes
+    return ipintel.client_ip(request.META)
+
+def is_duplicate_click(referral, ip_address):
+    """True if this IP already clicked the referral within the last 24 hours."""
+    time_threshold = datetime.now(timezone.utc) - timedelta(hours=24)
+    return ReferralClick.objects.filter(
+        referral=referral,
+        ip_address=ip_address,
+        clicked_at__gte=time_threshold
+    ).exists()
+
+def record_click(referral, ip_address, session_key, verdict, working_state=None, offer=None):
+    """Store a unique click; flagged clicks are kept for review but not counted."""
+    from . import lifecycle
+
+    if verdict.action == 'allow':
+        referral.click_count += 1
+        if working_state:
+            referral.working_state = working_state
+        referral.save()
+    country, asn = ipintel.lookup(ip_address)
+    ReferralClick.objects.create(
+        referral=referral,
+        ip_address=ip_address,
+        session_key=session_key,
+        fraud_score=verdict.score,
+        flagged=verdict.action == 'flag',
+        country=country,
+        asn=asn,
+    )
+    if verdict.action == 'allow' and offer is not None:
+        lifecycle.record_click(offer)
+    if verdict.action == 'flag':
+        logger.warning("Suspicious click flagged", extra={'event': 'click_flagged', 'referral_id': referral.id, 'offer_id': referral.offer_id, 'ip': ip_address, 'fraud_score': round(verdict.score, 3), 'reasons': verdict.reasons})
+
+def log_discarded_click(referral, ip_address, verdict):
+    logger.warning("Suspicious click discarded", extra={'event': 'click_discarded', 'referral_id': referral.id, 'offer_id': referral.offer_id, 'ip': ip_address, 'fraud_score': round(verdict.score, 3), 'reasons': verdict.reasons})
+
+def build_referral_redirect_url(offer, referral_id):
+    """Append the referral id to offer.link as the advertiser's next free sub-id parameter."""
+    if offer.advertiser:
+        parsed_url = urlparse(offer.link)
+        query_params = parse_qs(parsed_url.query)
+
+        prefix = offer.advertiser.query_param_prefix
+        i = 1
+        param_name = f"{prefix}{i}"
+        while param_name in query_params:
+            i += 1
+            param_name = f"{prefix}{i}"
+        
+        query_params[param_name] = [str(referral_id)]
+        new_query = urlencode(query_params, doseq=True)
+
+        redirect_url = urlunparse((
+            parsed_url.scheme,
+            parsed_url.netloc,
+            parsed_url.path,
+            parsed_url.params,
+            new_query,
+            parsed_url.fragment
+        ))
     else:
-        ip = request.META.get('REMOTE_ADDR')
-    return ip
+        parsed_url = urlparse(offer.link)
+        query_params = parse_qs(parsed_url.query)
+
+        i = 1
+        param_name = 'aff_sub1'
+        if param_name in query_params:
+            i += 1
+            param_name = f'aff_sub{i}'
+        
+        query_params[param_name] = [str(referral_id)]
+        new_query = urlencode(query_params, doseq=True)
+
+        redirect_url = urlunparse((
+            parsed_url.scheme,
+            parsed_url.netloc,
+            parsed_url.path,
+            parsed_url.params,
+            new_query,
+            parsed_url.fragment
+        ))
+    return redirect_url
+
+OFFERS_PER_PAGE = 24
+RECOMMENDED_OFFERS = 6
+
+def _search_offer_page(request):
+    query = request.GET.get('q', '').strip()
+    filters = {facet: request.GET.get(facet) for facet in FACETS}
+    variant, offer_ids, facets = rank_search(request, query, filters)
+    page = Paginator(offer_ids, OFFERS_PER_PAGE).get_page(request.GET.get('page'))
+    offers_by_id = Offer.objects.select_related('advertiser').in_bulk(list(page.object_list))
+    offers = [offers_by_id[offer_id] for offer_id in page.object_list if offer_id in offers_by_id]
+    return query, filters, facets, page, offers, variant
 
 def index(request):
-    offers = Offer.objects.filter(is_active='active')
-    return render(request, 'index.html', {'offers': offers})
+    query, filters, facets, page, offers, variant = _search_offer_page(request)
+    # Filter links keep the other active filters and the query
+    params = request.GET.copy()
+    params.pop('page', None)
+    return render(request, 'index.html', {
+        'offers': offers,
+        'page_obj': page,
+        'query': query,
+        'filters': filters,
+        'facets': facets,
+        'querystring': params.urlencode(),
+        'ranking_variant': variant,
+    })
+
+def offer_search(request):
+    query, filters, facets, page, offers, variant = _search_offer_page(request)
+    return JsonResponse({
+        'query': query,
+        'ranking_variant': variant,
+        'filters': {facet: value for facet, value in filters.items() if value},
+        'count': page.paginator.count,
+        'page': page.number,
+        'num_pages': page.paginator.num_pages,
+        'results': [
+            {
+                'id': offer.id,
+                'name': offer.name,
+                'reward': offer.reward,
+                'category': offer.category,
+                'conversion_type': offer.conversion_type,
+                'advertiser': offer.advertiser.name if offer.advertiser else None,
+                'url': reverse('offer_detail', kwargs={'offer_id': offer.id}),
+            }
+            for offer in offers
+        ],
+        'facets': facets,
+    })
 
 def offer_info(request, offer_id):
     offer = get_object_or_404(Offer, id=offer_id)
@@ -161,6 +285,9 @@ def submit_conversion_proof(request, offer_id):
 
 # Offer Detail View
 def offer_detail(request, offer_id, referral_id=None):
+    from . import captcha as captcha_challenge
+    from .fraud import click_fraud_engine
+
     offer = get_object_or_404(Offer, id=offer_id)
     referral_url = None
     offer_referral = None
@@ -183,30 +310,25 @@ def offer_detail(request, offer_id, referral_id=None):
             # Check for unique click
             ip_address = get_client_ip(request)
             session_key = request.session.session_key or request.session.create()
-            time_threshold = datetime.now(timezone.utc) - timedelta(hours=24)
-            click_exists = ReferralClick.objects.filter(
-                referral=referral,
-                ip_address=ip_address,
-                clicked_at__gte=time_threshold
-            ).exists()
-
-            if not click_exists:
-                referral.click_count += 1
-                referral.save()
-                ReferralClick.objects.create(
-                    referral=referral,
-                    ip_address=ip_address,
-                    session_key=session_key
-                )
-                logger.info(f"Unique click recorded: referral_id={referral_id}, clicks={referral.click_count}, client_ip={ip_address}")
+            click_exists = is_duplicate_click(referral, ip_address)
+            verdict = click_fraud_engine.score_click(ip_address, session_key, referral.id)
+
+            if not click_exists and verdict.action == 'discard':
+                log_discarded_click(referral, ip_address, verdict)
+            elif not click_exists:
+                record_click(referral, ip_address, session_key, verdict, offer=offer)
+                logger.info("Unique click recorded", extra={'event': 'click', 'referral_id': referral.id, 'offer_id': offer.id, 'clicks': referral.click_count, 'ip': ip_address, 'fraud_score': round(verdict.score, 3)})
             else:
-                logger.info(f"Non-unique click ignored: referral_id={referral_id}, client_ip={ip_address}")
+                logger.info("Non-unique click ignored", extra={'event': 'click_duplicate', 'referral_id': referral.id, 'offer_id': offer.id, 'ip': ip_address})
 
             offer_referral = referral
             referral_url = request.build_absolute_uri(
                 reverse('offer_detail_with_referral', kwargs={'offer_id': offer.id, 'referral_id': referral.id})
             )
             messages.info(request, f"You were referred by {referral.user.username if referral.user else 'an anonymous user'}.")
+            if referral.user_id and not request.user.is_authenticated:
+                # Signing up from here makes this visitor part of the referrer's downline
+                request.session[referral_graph.SESSION_KEY] = referral.id
         except Referral.DoesNotExist:
             messages.error(request, "Invalid referral link.")
 
@@ -228,17 +350,12 @@ def offer_detail(request, offer_id, referral_id=None):
         email_verified = request.user.userprofile.email_verified
         mobile_verified = request.user.userprofile.mobile_verified
 
-        # Check if contact info is submitted
-        contact_info_submitted = ContactInfo.objects.filter(user=request.user, offer=offer).exists()
-
-        # Check if Google Form is completed
-        google_form_completed = GoogleFormSubmission.objects.filter(user=request.user, offer=offer).exists()
-
-        # Check if conversion proof is submitted
-        proof_submitted = ConversionProof.objects.filter(user=request.user, offer=offer).exists()
-        if proof_submitted:
-            latest_proof = ConversionProof.objects.filter(user=request.user, offer=offer).latest('submitted_at')
-            proof_status = latest_proof.status
+        # Contact info, Google Form and conversion proof progress: one cached funnel state
+        state = funnel.state(offer.id, user_id=request.user.id)
+        contact_info_submitted = state.contact_info_submitted
+        google_form_completed = state.google_form_completed
+        proof_submitted = state.proof_submitted
+        proof_status = state.proof_status or None
 
         # Profile info for user section
         profile_info = {
@@ -252,25 +369,18 @@ def offer_detail(request, offer_id, referral_id=None):
         if not request.session.session_key:
             request.session.create()
         visitor_id = request.session.session_key
-        google_form_completed = GoogleFormSubmission.objects.filter(visitor_identifier=visitor_id, offer=offer).exists()
+        google_form_completed = funnel.state(offer.id, visitor_identifier=visitor_id).google_form_completed
 
-    # Generate CAPTCHA if required
+    # Signed CAPTCHA challenge if required; nothing is stored until it is answered
     if offer.requires_contact_info and not contact_info_submitted:
-        captcha_id = request.session.get('captcha_id')
-        if not captcha_id:
-            captcha_id = random.randint(0, len(CAPTCHA_OPTIONS) - 1)
-            request.session['captcha_id'] = captcha_id
-            request.session['captcha_correct'] = CAPTCHA_OPTIONS[captcha_id]['correct']
-        captcha = CAPTCHA_OPTIONS[captcha_id]
+        captcha = captcha_challenge.issue(offer.id)
 
     if request.method == 'POST' and request.user.is_authenticated:
         form = ContactInfoForm(request.POST)
         if form.is_valid():
             # Verify CAPTCHA
             if captcha:
-                selected_image = request.POST.get('captcha_image')
-                correct_image = request.session.get('captcha_correct')
-                if selected_image != correct_image:
+                if not captcha_challenge.verify(request.POST, offer.id):
                     messages.error(request, "CAPTCHA verification failed. Please try again.")
                     return render(request, 'offer_detail.html', {
                         'offer': offer,
@@ -286,16 +396,13 @@ def offer_detail(request, offer_id, referral_id=None):
                         'tutorial_videos': tutorial_videos,
                         'ad_banners': ad_banners,
                         'captcha': captcha,
+                        'fragment_cache_timeout': settings.OFFER_FRAGMENT_CACHE_TIMEOUT,
                         'referral_message': referral_message,
                         'profile_info': profile_info if request.user.is_authenticated else None,
                         'profile_level': profile_level if request.user.is_authenticated else None,
                         'contact_form': form,
                     })
 
-            # Clear CAPTCHA session data
-            request.session.pop('captcha_id', None)
-            request.session.pop('captcha_correct', None)
-
             contact_info = form.save(commit=False)
             contact_info.user = request.user
             contact_info.offer = offer
@@ -332,6 +439,7 @@ def offer_detail(request, offer_id, referral_id=None):
         'tutorial_videos': tutorial_videos,
         'ad_banners': ad_banners,
         'captcha': captcha,
+        'fragment_cache_timeout': settings.OFFER_FRAGMENT_CACHE_TIMEOUT,
         'referral_message': referral_message,
         'profile_info': profile_info if request.user.is_authenticated else None,
         'profile_level': profile_level if request.user.is_authenticated else None,
@@ -340,28 +448,55 @@ def offer_detail(request, offer_id, referral_id=None):
 
 @csrf_exempt
 def postback(request):
+    from . import lifecycle
+    from .fraud import click_fraud_engine
+    from .postback_auth import PostbackAuthError, verify_postback
+
     # Ensure this is a POST request from an advertiser
     if request.method != 'POST':
         logger.warning(f"Invalid postback request: method={request.method}, client_ip={request.META.get('REMOTE_ADDR')}")
         return HttpResponse("Invalid request method", status=400)
 
-    # Validate the request (e.g., check for an API key or specific parameters)
-    api_key = request.POST.get('api_key')  # Example: Require an API key
-    if not api_key or api_key != 'your_secret_api_key':  # Replace with your actual validation
-        logger.warning(f"Invalid postback request: missing or incorrect API key, client_ip={request.META.get('REMOTE_ADDR')}")
+    try:
+        advertiser_id = verify_postback(request.POST)
+    except PostbackAuthError as e:
+        logger.warning(f"Unauthorized postback: {e}, advertiser={request.POST.get('advertiser')}, client_ip={request.META.get('REMOTE_ADDR')}")
         return HttpResponse("Unauthorized", status=401)
 
-    referral_id = request.GET.get('referral_id') or request.POST.get('referral_id')
-    if not referral_id:
+    referral_id = request.POST.get('referral_id', '')
+    if not referral_id.isdigit():
         logger.warning(f"Postback missing referral_id, client_ip={request.META.get('REMOTE_ADDR')}")
         return HttpResponse("Missing referral_id", status=400)
 
+    # 'converted' credits the referring user's cashback (see offers.ledger)
+    state = request.POST.get('state') or 'clicked'
+    if state not in ('clicked', 'converted'):
+        logger.warning(f"Postback with invalid state: state={state}, referral_id={referral_id}, client_ip={request.META.get('REMOTE_ADDR')}")
+        return HttpResponse("Invalid state", status=400)
+
     try:
-        referral = get_object_or_404(Referral, id=referral_id)
-        referral.click_count += 1
-        referral.working_state = 'clicked'
-        referral.save()
-        logger.info(f"Postback triggered: referral_id={referral_id}, state=clicked, clicks={referral.click_count}, client_ip={request.META.get('REMOTE_ADDR')}")
+        # One UPDATE, scoped to the advertiser's own offers; update() skips
+        # auto_now, so updated_at (the conversion time) is set explicitly.
+        # Converted referrals keep their state and conversion time (a second
+        # UPDATE only counts the postback), so a re-sent 'converted' is
+        # counted (cashback, caps, fraud) once, on the transition.
+        referrals = Referral.objects.filter(id=referral_id, offer__advertiser_id=advertiser_id)
+        changed = referrals.exclude(working_state='converted').update(
+            click_count=F('click_count') + 1,
+            working_state=state,
+            updated_at=datetime.now(timezone.utc),
+        )
+        updated = changed or referrals.update(click_count=F('click_count') + 1)
+        if not updated:
+            logger.warning(f"Postback for unknown referral: referral_id={referral_id}, advertiser={advertiser_id}, client_ip={request.META.get('REMOTE_ADDR')}")
+            return HttpResponse("Referral not found", status=404)
+        if state == 'converted' and changed:
+            click_fraud_engine.record_conversion(int(referral_id))
+            # update() sends no post_save, so credit the cashback here
+            referral = Referral.objects.select_related('offer').get(id=referral_id)
+            post_referral_conversion(referral)
+            lifecycle.record_conversion(referral.offer)
+        logger.info("Postback triggered", extra={'event': 'postback', 'referral_id': int(referral_id), 'advertiser_id': advertiser_id, 'state': state, 'ip': request.META.get('REMOTE_ADDR')})
         return HttpResponse("Postback processed", status=200)
     except Exception as e:
         logger.error(f"Postback error: {str(e)}, referral_id={referral_id}, client_ip={request.META.get('REMOTE_ADDR')}")
@@ -432,53 +567,23 @@ def user_dashboard(request):
         logger.error(f"Error calculating referral statistics for user {user.username}: {str(e)}")
         total_referrals = clicked_referrals = converted_referrals = 0
 
+    # Balance snapshot maintained by offers.ledger; never summed from the ledger here
+    cashback_balance = get_balance(user)
+    downline = referral_graph.downline(user)
+
+    # Ranked offers the user has not referred yet, personalized by their categories
+    referred_offer_ids = {referral.offer_id for referral in referrals}
+    _, ranked_ids = rank_offers(request)
+    recommended_ids = list(islice((offer_id for offer_id in ranked_ids if offer_id not in referred_offer_ids), RECOMMENDED_OFFERS))
+    recommended_by_id = Offer.objects.in_bulk(recommended_ids)
+    recommended_offers = [recommended_by_id[offer_id] for offer_id in recommended_ids if offer_id in recommended_by_id]
+
     try:
         pending_verification = PendingVerification.objects.filter(user=user, is_processed=False).exists()
     except Exception as e:
         logger.error(f"Error checking pending verification for user {user.username}: {str(e)}")
         pending_verification = False
 
-    # Admin-specific data
-    api_status = {}
-    api_config = {}
-    api_logs = []
-    if user.is_staff:
-        # API Status
-        try:
-            numverify_usage = ApiUsage.objects.get(api_name='numverify')
-            abstract_usage = ApiUsage.objects.get(api_name='abstract')
-            api_status = {
-                'numverify': {
-                    'status': 'active' if not numverify_usage.is_limit_exceeded(100) else 'inactive',
-                    'request_count': numverify_usage.request_count,
-                    'limit': 100,
-                },
-                'abstract': {
-                    'status': 'active' if not abstract_usage.is_limit_exceeded(100) else 'inactive',
-                    'request_count': abstract_usage.request_count,
-                    'limit': 100,
-                },
-            }
-        except Exception as e:
-            logger.error(f"Error fetching API status for admin {user.username}: {str(e)}")
-            api_status = {
-                'numverify': {'status': 'unknown', 'request_count': 0, 'limit': 100},
-                'abstract': {'status': 'unknown', 'request_count': 0, 'limit': 100},
-            }
-
-        # API Configuration
-        api_config = {
-            'numverify_key': settings.NUMVERIFY_API_KEY,
-            'abstract_key': settings.ABSTRACT_API_KEY,
-            'request_limit': 100,
-        }
-
-        # API Logs (last 10 entries)
-        try:
-            api_logs = ApiLog.objects.all().order_by('-timestamp')[:10]
-        except Exception as e:
-            logger.error(f"Error fetching API logs for admin {user.username}: {str(e)}")
-
     context = {
         'profile_info': profile_info,
         'profile_level': user_profile.profile_level,
@@ -490,11 +595,11 @@ def user_dashboard(request):
         'total_referrals': total_referrals,
         'clicked_referrals': clicked_referrals,
         'converted_referrals': converted_referrals,
+        'cashback_balance': cashback_balance,
+        'downline': downline,
+        'recommended_offers': recommended_offers,
         'referrals': referrals,
         'referral_urls': referral_urls,
-        'api_status': api_status,
-        'api_config': api_config,
-        'api_logs': api_logs,
     }
 
     return render(request, 'dashboard.html', context)
@@ -502,16 +607,25 @@ def user_dashboard(request):
 @ratelimit(key='ip', rate='100/5m', method='GET', block=True)
 @ratelimit(key='ip', rate='100/5m', method='POST', block=True)
 def grab_offer(request, offer_id, referral_id=None):
+    from . import captcha as captcha_challenge, lifecycle
+    from .fraud import click_fraud_engine
+
     offer = get_object_or_404(Offer, id=offer_id)
     redirect_url = offer.link
 
+    # Paused, out-of-schedule or capped offers take no more grabs
+    if request.method == 'POST' and not lifecycle.accepting_traffic(offer):
+        logger.info("Offer not accepting traffic", extra={'event': 'grab_offer_paused', 'referral_id': referral_id, 'offer_id': offer.id, 'ip': get_client_ip(request)})
+        messages.error(request, 'This offer is not available right now.')
+        return redirect('offer_detail', offer_id=offer.id)
+
     # Initialize referral
     if referral_id:
         try:
             referral = Referral.objects.get(id=referral_id)
         except Referral.DoesNotExist:
             referral = None
-            logger.warning(f"Referral with id {referral_id} not found, client_ip={get_client_ip(request)}")
+            logger.warning("Referral not found", extra={'event': 'grab_offer_invalid_referral', 'referral_id': referral_id, 'offer_id': offer_id, 'ip': get_client_ip(request)})
     else:
         referral = None
 
@@ -522,26 +636,15 @@ def grab_offer(request, offer_id, referral_id=None):
     # Check if this IP has clicked this referral within the last 24 hours
     click_exists = False
     if referral:
-        time_threshold = datetime.now(timezone.utc) - timedelta(hours=24)
-        click_exists = ReferralClick.objects.filter(
-            referral=referral,
-            ip_address=ip_address,
-            clicked_at__gte=time_threshold
-        ).exists()
+        click_exists = is_duplicate_click(referral, ip_address)
 
     if offer.requires_contact_info:
         if request.method == 'POST':
             # Validate CAPTCHA
-            selected_image = request.POST.get('captcha_image')
-            correct_image = request.session.get('captcha_correct')
-            if selected_image != correct_image:
+            if not captcha_challenge.verify(request.POST, offer.id):
                 messages.error(request, 'CAPTCHA verification failed. Please try again.')
                 return redirect('offer_detail', offer_id=offer.id)
 
-            # Clear CAPTCHA session data
-            request.session.pop('captcha_id', None)
-            request.session.pop('captcha_correct', None)
-
             name = request.POST.get('name')
             email = request.POST.get('email')
             mobile = request.POST.get('mobile')
@@ -577,17 +680,13 @@ def grab_offer(request, offer_id, referral_id=None):
 
                 messages.success(request, 'Offer grabbed successfully! Your contact info has been saved.')
                 
-                # Increment click_count only for unique clicks within 24 hours
-                if referral and not click_exists:
-                    referral.click_count += 1
-                    referral.working_state = 'clicked'
-                    referral.save()
-                    ReferralClick.objects.create(
-                        referral=referral,
-                        ip_address=ip_address,
-                        session_key=session_key
-                    )
-                    logger.info(f"Offer grabbed: referral_id={referral_id}, state=clicked, clicks={referral.click_count}, client_ip={ip_address}")
+                # Count only unique clicks within 24 hours that pass fraud scoring
+                verdict = click_fraud_engine.score_click(ip_address, session_key, referral.id) if referral else None
+                if referral and not click_exists and verdict.action == 'discard':
+                    log_discarded_click(referral, ip_address, verdict)
+                elif referral and not click_exists:
+                    record_click(referral, ip_address, session_key, verdict, working_state='clicked', offer=offer)
+                    logger.info("Offer grabbed", extra={'event': 'grab_offer', 'referral_id': referral.id, 'offer_id': offer.id, 'state': 'clicked', 'clicks': referral.click_count, 'ip': ip_address, 'ranking_variant': assign_variant(request)})
                 
                 redirect_url = offer.link if offer.link else reverse('offer_detail', kwargs={'offer_id': offer.id})
             except IntegrityError as e:
@@ -605,82 +704,25 @@ def grab_offer(request, offer_id, referral_id=None):
             return redirect('offer_detail', offer_id=offer_id)
     else:
         if request.method == 'POST':
-            # Validate CAPTCHA for "Grab Now" action
-            selected_image = request.POST.get('captcha_image')
-            correct_image = request.session.get('captcha_correct')
-            if selected_image != correct_image:
-                messages.error(request, 'CAPTCHA verification failed. Please try again.')
-                return redirect('offer_detail', offer_id=offer.id)
-
-            # Clear CAPTCHA session data
-            request.session.pop('captcha_id', None)
-            request.session.pop('captcha_correct', None)
-
-            # Increment click_count only for unique clicks within 24 hours
-            if referral and not click_exists:
-                referral.click_count += 1
-                referral.working_state = 'clicked'
-                referral.save()
-                ReferralClick.objects.create(
-                    referral=referral,
-                    ip_address=ip_address,
-                    session_key=session_key
-                )
-                logger.info(f"Offer grabbed: referral_id={referral_id}, state=clicked, clicks={referral.click_count}, client_ip={ip_address}")
+            # Count only unique clicks within 24 hours that pass fraud scoring
+            verdict = click_fraud_engine.score_click(ip_address, session_key, referral.id) if referral else None
+            if referral and not click_exists and verdict.action == 'discard':
+                log_discarded_click(referral, ip_address, verdict)
+            elif referral and not click_exists:
+                record_click(referral, ip_address, session_key, verdict, working_state='clicked', offer=offer)
+                logger.info("Offer grabbed", extra={'event': 'grab_offer', 'referral_id': referral.id, 'offer_id': offer.id, 'state': 'clicked', 'clicks': referral.click_count, 'ip': ip_address, 'ranking_variant': assign_variant(request)})
             else:
-                logger.info(f"Offer grabbed without referral or already clicked: offer_id={offer_id}, client_ip={ip_address}")
+                logger.info("Offer grabbed without referral or already clicked", extra={'event': 'grab_offer_duplicate', 'referral_id': referral_id, 'offer_id': offer_id, 'ip': ip_address})
         else:
             # Do not increment click_count on GET requests (page loads)
-            logger.info(f"GET request to grab_offer: offer_id={offer_id}, referral_id={referral_id}, client_ip={ip_address}")
+            logger.info("GET request to grab_offer", extra={'event': 'grab_offer_view', 'referral_id': referral_id, 'offer_id': offer_id, 'ip': ip_address})
             if referral_id:
                 return redirect('offer_detail_with_referral', offer_id=offer_id, referral_id=referral_id)
             return redirect('offer_detail', offer_id=offer_id)
 
     # Modify redirect URL with referral parameters
     if referral and offer.link:
-        if offer.advertiser:
-            parsed_url = urlparse(offer.link)
-            query_params = parse_qs(parsed_url.query)
-
-            prefix = offer.advertiser.query_param_prefix
-            i = 1
-            param_name = f"{prefix}{i}"
-            while param_name in query_params:
-                i += 1
-                param_name = f"{prefix}{i}"
-            
-            query_params[param_name] = [str(referral_id)]
-            new_query = urlencode(query_params, doseq=True)
-
-            redirect_url = urlunparse((
-                parsed_url.scheme,
-                parsed_url.netloc,
-                parsed_url.path,
-                parsed_url.params,
-                new_query,
-                parsed_url.fragment
-            ))
-        else:
-            parsed_url = urlparse(offer.link)
-            query_params = parse_qs(parsed_url.query)
-
-            i = 1
-            param_name = 'aff_sub1'
-            if param_name in query_params:
-                i += 1
-                param_name = f'aff_sub{i}'
-            
-            query_params[param_name] = [str(referral_id)]
-            new_query = urlencode(query_params, doseq=True)
-
-            redirect_url = urlunparse((
-                parsed_url.scheme,
-                parsed_url.netloc,
-                parsed_url.path,
-                parsed_url.params,
-                new_query,
-                parsed_url.fragment
-            ))
+        redirect_url = build_referral_redirect_url(offer, referral_id)
 
     return redirect(redirect_url)
 
@@ -693,9 +735,7 @@ def verify_email(request, uidb64, token):
         user = None
 
     if user is not None and default_token_generator.check_token(user, token):
-        user_profile = user.userprofile
-        user_profile.email_verified = True
-        user_profile.save()
+        UserProfile.objects.update_for(user, email_verified=True)
         messages.success(request, "Your email has been verified successfully!")
         logger.info(f"Email verified for user {user.username}")
     else:
@@ -727,21 +767,12 @@ def send_verification_email(request):
         if not email:
             return JsonResponse({"status": "error", "message": "Email is required."}, status=400)
 
-        # Generate a random 6-digit code
-        verification_code = ''.join(random.choices(string.digits, k=6))
-
-        # Initialize the verification_codes dictionary in the session if it doesn't exist
-        if 'verification_codes' not in request.session:
-            request.session['verification_codes'] = {}
-
-        # Store the code in the session, keyed by email
-        request.session['verification_codes'][email] = {
-            'code': verification_code,
-            'timestamp': int(time.time()),  # Store the timestamp for expiration
-        }
-        request.session.modified = True  # Ensure the session is saved
+        try:
+            verification_code = verification_codes.issue(email, ip=get_client_ip(request))
+        except verification_codes.Throttled as e:
+            return JsonResponse({"status": "error", "message": str(e)}, status=429)
 
-        logger.info(f"Sending verification code {verification_code} to {email}")
+        logger.info(f"Sending verification code to {email}")
 
         try:
             # Send the email
@@ -768,77 +799,30 @@ def verify_email_code(request):
         if not email or not code:
             return JsonResponse({"status": "error", "message": "Email and code are required."}, status=400)
 
-        # Retrieve the verification codes dictionary from the session
-        verification_codes = request.session.get('verification_codes', {})
-        stored_data = verification_codes.get(email)
-
-        if not stored_data:
-            logger.warning(f"No verification code found for email {email}")
-            return JsonResponse({"status": "error", "message": "No verification code found for this email."}, status=400)
-
-        stored_code = stored_data['code']
-        timestamp = stored_data['timestamp']
-        current_time = int(time.time())
-
-        logger.info(f"Verifying code {code} for {email}, stored code: {stored_code}")
-
-        # Check if the code has expired (e.g., 10 minutes = 600 seconds)
-        if current_time - timestamp > 600:
-            del verification_codes[email]
-            request.session['verification_codes'] = verification_codes
-            request.session.modified = True
-            logger.warning(f"Verification code expired for {email}")
-            return JsonResponse({"status": "error", "message": "Verification code has expired."}, status=400)
-
-        if code == stored_code:
-            # Remove the code from the session
-            del verification_codes[email]
-            request.session['verification_codes'] = verification_codes
-            request.session.modified = True
-
-            if is_signup:
-                # For signup, just confirm the code is valid; user creation happens later
-                logger.info(f"Email {email} verification successful for signup")
-                return JsonResponse({"status": "success", "message": "Email verified successfully!"})
-            else:
-                # For other flows (e.g., offer_detail.html), update the user's email_verified status
-                try:
-                    user = User.objects.get(email=email)
-                    user.userprofile.email_verified = True
-                    user.userprofile.save()
-                    logger.info(f"Email {email} verified successfully for existing user")
-                    return JsonResponse({"status": "success", "message": "Email verified successfully!"})
-                except User.DoesNotExist:
-                    logger.error(f"User with email {email} does not exist")
-                    return JsonResponse({"status": "error", "message": "User with this email does not exist."}, status=400)
-        logger.warning(f"Invalid code {code} for {email}, expected {stored_code}")
-        return JsonResponse({"status": "error", "message": "Invalid verification code."}, status=400)
+        try:
+            verification_codes.check(email, code, ip=get_client_ip(request))
+        except verification_codes.Throttled as e:
+            return JsonResponse({"status": "error", "message": str(e)}, status=429)
+        except verification_codes.VerificationError as e:
+            logger.warning(f"Email verification failed for {email}: {e}")
+            return JsonResponse({"status": "error", "message": str(e)}, status=400)
+
+        if is_signup:
+            # For signup, the verified code is read (and consumed) when the account is created
+            logger.info(f"Email {email} verification successful for signup")
+            return JsonResponse({"status": "success", "message": "Email verified successfully!"})
+        # For other flows (e.g., offer_detail.html), update the user's email_verified status
+        try:
+            user = User.objects.get(email=email)
+        except User.DoesNotExist:
+            logger.error(f"User with email {email} does not exist")
+            return JsonResponse({"status": "error", "message": "User with this email does not exist."}, status=400)
+        UserProfile.objects.update_for(user, email_verified=True)
+        verification_codes.consume(email)
+        logger.info(f"Email {email} verified successfully for existing user")
+        return JsonResponse({"status": "success", "message": "Email verified successfully!"})
     return JsonResponse({"status": "error", "message": "Invalid request."}, status=400)
 
-class CustomEmailView(EmailView):
-    def post(self, request, *args, **kwargs):
-        response = super().post(request, *args, **kwargs)
-        if 'email' in request.POST and request.POST.get('action') == 'add_email':
-            email = request.POST['email']
-            email_address = EmailAddress.objects.filter(user=request.user, email=email).first()
-            if email_address:
-                email_address.verified = False
-                email_address.save()
-                user_profile = request.user.userprofile
-                user_profile.email_verified = False
-                user_profile.save()
-                send_verification_email(request.user, request)
-                messages.info(request, "A verification email has been sent to your new email address.")
-        return response
-
-class CustomSignupView(SignupView):
-    form_class = CustomSignupForm
-
-    def get_form_kwargs(self):
-        kwargs = super().get_form_kwargs()
-        kwargs['request'] = self.request
-        return kwargs
-    
 @login_required
 def retry_mobile_verification(request):
     user = request.user
@@ -852,14 +836,43 @@ def retry_mobile_verification(request):
         from offers.utils import validate_mobile_number
         is_valid, message = validate_mobile_number(user, pending.mobile_number)
         if is_valid:
-            user.userprofile.mobile_verified = True
-            user.userprofile.save()
+            UserProfile.objects.update_for(user, mobile_verified=True)
             pending.is_processed = True
-            pending.save()
+            pending.save(update_fields=['is_processed'])
             messages.success(request, "Mobile number verified successfully!")
         else:
             messages.error(request, f"Verification failed: {message}")
     except Exception as e:
         logger.error(f"Error retrying mobile verification for user {user.username}: {str(e)}")
         messages.error(request, "An error occurred while retrying verification. Please try again later.")
-    return redirect('dashboard')
\ No newline at end of file
+    return redirect('dashboard')
+
+def metrics(request):
+    from .metrics import registry
+
+    if not (request.user.is_staff or get_client_ip(request) in settings.METRICS_ALLOWED_IPS):
+        return HttpResponse("Forbidden", status=403)
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@staff_member_required
+def ops_health(request):
+    from . import ops_health as ops_health_snapshot
+
+    # Database figures come from the snapshot only; the page never aggregates live
+    return render(request, 'ops_health.html', {
+        'snapshot': ops_health_snapshot.snapshot(),
+        'interval': getattr(settings, 'OPS_SNAPSHOT_INTERVAL', 60),
+        'view_latency': ops_health_snapshot.view_latency(),
+        'log_queue_depth': ops_health_snapshot.log_queue_depth(),
+    })
+
+def captcha_image(request, key):
+    from . import captcha as captcha_challenge
+
+    # Drawn per challenge, and only for keys issued here that have not expired
+    png = captcha_challenge.image_png(key)
+    if png is None:
+        return HttpResponse(status=404)
+    response = HttpResponse(png, content_type='image/png')
+    response['Cache-Control'] = f'private, max-age={settings.CAPTCHA_TTL}'
+    return response